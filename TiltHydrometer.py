@@ -1,8 +1,12 @@
-import datetime
+import json
+import time
 from typing import Dict
+from array import array
 from collections import deque
 from decimal import Decimal
 
+import metrics
+
 
 class TiltHydrometer:
     # These are all the UUIDs currently available as Tilt colors
@@ -21,28 +25,51 @@ class TiltHydrometer:
     # color_lookup is created at first use in color_lookup
     color_lookup_table = {}  # type: Dict[str, str]
     color_lookup_table_no_dash = {}  # type: Dict[str, str]
+    # The raw 16 byte UUIDs as broadcast by the Tilt, used by the fast-path decoder in tilt_decoder
+    color_lookup_table_bytes = {bytes.fromhex(uuid.replace("-", "")): color
+                                for color, uuid in tilt_colors.items()}  # type: Dict[bytes, str]
+
+    # Each hydrometer only holds integers (raw sensor values and running sums) - Decimals are only created when the
+    # values are serialized. __slots__ keeps the per-hydrometer footprint small when tracking many hydrometers.
+    __slots__ = ('color', 'mac', 'smoothing_window', '_gravity_ring', '_temp_ring', '_ring_pos', '_ring_count',
+                 'gravity_sum', 'temp_sum', 'cache_expiry_ns', 'last_value_received_ns', 'sensor_gravity',
+                 'sensor_temp', 'rssi', 'sends_battery', 'weeks_on_battery', 'firmware_version', 'tilt_pro',
+                 'temp_format', 'version', '_cached_version', '_cached_dict', '_cached_json', 'flushed_gravity',
+                 'flushed_temp', 'gravity_smoother', 'temp_smoother')
 
-    def __init__(self, color: str):
+    def __init__(self, color: str, mac: str or None = None):
         if color not in self.tilt_colors:
             raise ValueError("Invalid color specified")
 
         self.color = color  # type: str
+        # The MAC address distinguishes multiple Tilts of the same color (formatted as aa:bb:cc:dd:ee:ff)
+        self.mac = mac  # type: str or None
 
         # The smoothing_window is set in the TiltConfiguration object - just defaulting it here for now
         self.smoothing_window = 60  # type: int
-        self.gravity_list = deque(maxlen=self.smoothing_window)  # type: deque[float]
-        self.temp_list = deque(maxlen=self.smoothing_window)  # type: deque[int]
+        # The smoothing window is a pair of ring buffers holding the raw integer sensor values (e.g. 1050 for 1.050 on
+        # a Tilt Classic, or 10500 on a Tilt Pro) and we keep a running sum of each so that the smoothed values can be
+        # calculated in O(1)
+        self._gravity_ring = array('H', bytes(2 * self.smoothing_window))  # type: array
+        self._temp_ring = array('H', bytes(2 * self.smoothing_window))  # type: array
+        self._ring_pos = 0  # type: int
+        self._ring_count = 0  # type: int
+        self.gravity_sum = 0  # type: int
+        self.temp_sum = 0  # type: int
+        # If set (see set_smoothing), the smoothed values come from these instead of the mean of the window
+        self.gravity_smoother = None  # type: smoothing.Smoother or None
+        self.temp_smoother = None  # type: smoothing.Smoother or None
 
-        self.last_value_received = datetime.datetime.now() - self._cache_expiry_seconds()  # type: datetime.datetime
+        # When the last reading was received, from time.monotonic_ns() so that expiry isn't thrown off if the clock is
+        # stepped (e.g. by NTP on a freshly booted Pi). The expiry threshold only depends on the smoothing window, so
+        # it is only calculated once.
+        self.cache_expiry_ns = self._cache_expiry_ns()  # type: int
+        self.last_value_received_ns = time.monotonic_ns() - self.cache_expiry_ns  # type: int
 
-        # raw_gravity and raw_temp are the values we get from the Tilt (Note - Temp is always in Fahrenheit)
-        self.raw_gravity = Decimal(0.0)  # type: Decimal
-        self.raw_temp = Decimal(0.0)  # type: Decimal
-
-        # gravity and temp have calibration applied in theory
-        # For now, we are not applying calibration -- it's up to the target system to do that
-        self.gravity = Decimal(0.0)  # type: Decimal
-        self.temp = Decimal(0.0)  # type: Decimal
+        # sensor_gravity and sensor_temp are the values we get from the Tilt, as integers (Note - Temp is always in
+        # Fahrenheit). raw_gravity/raw_temp scale these to Decimals.
+        self.sensor_gravity = 0  # type: int
+        self.sensor_temp = 0  # type: int
 
         self.rssi = 0  # type: int
 
@@ -56,48 +83,148 @@ class TiltHydrometer:
 
         self.temp_format = 'F'  # Defaulting to Fahrenheit as that's what the Tilt sends
 
+        # version is incremented every time the readings change. to_dict() and to_json() cache their output against it,
+        # so hydrometers that haven't sent anything new since the last snapshot cost nothing to serialize.
+        self.version = 0  # type: int
+        self._cached_version = -1  # type: int
+        self._cached_dict = None  # type: dict or None
+        self._cached_json = None  # type: bytes or None
+
+        # The sensor values as of the last snapshot sent to the data targets, used to detect significant changes that
+        # should be sent immediately rather than waiting for the next scheduled send
+        self.flushed_gravity = 0  # type: int
+        self.flushed_temp = 0  # type: int
+
     def __str__(self):
         return self.color
 
-    def _cache_expiry_seconds(self) -> datetime.timedelta:
+    @property
+    def raw_gravity(self) -> Decimal:
+        return Decimal(self.sensor_gravity) / (10000 if self.tilt_pro else 1000)
+
+    @property
+    def raw_temp(self) -> Decimal:
+        return Decimal(self.sensor_temp) / 10 if self.tilt_pro else Decimal(self.sensor_temp)
+
+    # gravity and temp have calibration applied in theory
+    # For now, we are not applying calibration -- it's up to the target system to do that
+    @property
+    def gravity(self) -> Decimal:
+        return self.raw_gravity
+
+    @property
+    def temp(self) -> Decimal:
+        return self.raw_temp
+
+    def _window_values(self, ring: array) -> deque:
+        # Returns the values in a ring buffer, oldest first
+        if self._ring_count < self.smoothing_window:
+            return deque(ring[:self._ring_count], maxlen=self.smoothing_window)
+        return deque(ring[self._ring_pos:] + ring[:self._ring_pos], maxlen=self.smoothing_window)
+
+    @property
+    def gravity_list(self) -> deque:
+        """The raw sensor gravity values in the smoothing window, oldest first"""
+        return self._window_values(self._gravity_ring)
+
+    @property
+    def temp_list(self) -> deque:
+        """The raw sensor temp values in the smoothing window, oldest first"""
+        return self._window_values(self._temp_ring)
+
+    def set_smoothing(self, smoothing_window: int, gravity_smoother=None, temp_smoother=None,
+                      keep_readings: bool = False):
+        """Change the size of the smoothing window, and optionally smooth readings with something other than the mean
+        of the window (see smoothing.Strategy). Any readings so far are discarded, unless keep_readings is set - then
+        the (newest) readings in the old window are carried over to the new one."""
+        self.version += 1  # The smoothed values (and smoothing_window) in to_dict() have changed
+        gravity_values, temp_values = (self.gravity_list, self.temp_list) if keep_readings else ((), ())
+        self.smoothing_window = smoothing_window
+        self._gravity_ring = array('H', bytes(2 * smoothing_window))
+        self._temp_ring = array('H', bytes(2 * smoothing_window))
+        self.gravity_smoother = gravity_smoother
+        self.temp_smoother = temp_smoother
+        self._clear_lists()
+        self.cache_expiry_ns = self._cache_expiry_ns()
+
+        gravity_values = list(gravity_values)[-smoothing_window:]
+        temp_values = list(temp_values)[-smoothing_window:]
+        for pos, (sensor_gravity, sensor_temp) in enumerate(zip(gravity_values, temp_values)):
+            self._gravity_ring[pos] = sensor_gravity
+            self._temp_ring[pos] = sensor_temp
+        self._ring_count = len(gravity_values)
+        self._ring_pos = self._ring_count % smoothing_window
+        self.gravity_sum = sum(gravity_values)
+        self.temp_sum = sum(temp_values)
+        if gravity_smoother is not None and len(gravity_values) > 0:
+            gravity_smoother.seed(gravity_values, self.last_value_received_ns)
+            temp_smoother.seed(temp_values, self.last_value_received_ns)
+
+    def _cache_expiry_ns(self) -> int:
         # Assume we get 1 out of every 4 readings
-        return datetime.timedelta(seconds=(self.smoothing_window * 1.2 * 4))
+        return int(self.smoothing_window * 1.2 * 4 * 1_000_000_000)
 
-    def expired(self) -> bool:
+    def expired(self, now_ns: int or None = None) -> bool:
         """Returns true if the Tilt has not checked in recently, and the cached data should be considered no longer
-        valid"""
-        return self.last_value_received <= datetime.datetime.now() - self._cache_expiry_seconds()
+        valid. now_ns (from time.monotonic_ns()) can be passed in when checking many hydrometers at once."""
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        return self.last_value_received_ns <= now_ns - self.cache_expiry_ns
+
+    def _clear_lists(self):
+        # The ring buffers don't need zeroing - only the first _ring_count values are ever read
+        self._ring_pos = 0
+        self._ring_count = 0
+        self.gravity_sum = 0
+        self.temp_sum = 0
+        if self.gravity_smoother is not None:
+            self.gravity_smoother.clear()
+            self.temp_smoother.clear()
 
-    def _add_to_list(self, gravity, temp):
+    def _add_to_list(self, sensor_gravity: int, sensor_temp: int):
         # This adds a gravity/temp value to the list for smoothing/averaging
-        if self.expired():
+        now_ns = time.monotonic_ns()
+        if self.last_value_received_ns <= now_ns - self.cache_expiry_ns:
             # The cache expired (we lost contact with the Tilt for too long). Clear the lists.
-            self.gravity_list.clear()
-            self.temp_list.clear()
+            self._clear_lists()
+
+        pos = self._ring_pos
+        if self._ring_count >= self.smoothing_window:
+            # The window is full - the value we're about to overwrite needs to come out of the running sum
+            self.gravity_sum -= self._gravity_ring[pos]
+            self.temp_sum -= self._temp_ring[pos]
+        else:
+            self._ring_count += 1
 
-        # Thankfully, deque enforces queue length, so all we need to do is add the value
-        self.last_value_received = datetime.datetime.now()
-        self.gravity_list.append(gravity)
-        self.temp_list.append(temp)
+        self.last_value_received_ns = now_ns
+        self._gravity_ring[pos] = sensor_gravity
+        self._temp_ring[pos] = sensor_temp
+        self.gravity_sum += sensor_gravity
+        self.temp_sum += sensor_temp
+        pos += 1
+        self._ring_pos = 0 if pos >= self.smoothing_window else pos
+        if self.gravity_smoother is not None:
+            self.gravity_smoother.add(sensor_gravity, now_ns)
+            self.temp_smoother.add(sensor_temp, now_ns)
 
     def process_decoded_values(self, sensor_gravity: int, sensor_temp: int, rssi: int, tx_pwr: int):
+        self.version += 1
+
         if sensor_temp == 999:
             # For the latest Tilts, this is now actually a special code indicating that the gravity is the version info.
             # Regardless of whether we end up doing anything with that information, we definitely do not want to add it
             # to the list
             self.firmware_version = sensor_gravity
+            metrics.hydrometer_firmware_reports.value += 1
             return
 
-        if sensor_gravity >= 5000:
-            # Tilt Pro support
-            self.tilt_pro = True
-            self.raw_gravity = Decimal(sensor_gravity) / 10000
-            self.raw_temp = Decimal(sensor_temp) / 10
-        else:
-            # Tilt "Classic" support
-            self.tilt_pro = False
-            self.raw_gravity = Decimal(sensor_gravity) / 1000
-            self.raw_temp = Decimal(sensor_temp)
+        tilt_pro = sensor_gravity >= 5000  # Tilt Pro support
+        if tilt_pro != self.tilt_pro:
+            # The smoothing lists hold raw sensor values, which are scaled differently for Pros and Classics
+            self._clear_lists()
+        self.tilt_pro = tilt_pro
+        self.sensor_gravity = sensor_gravity
+        self.sensor_temp = sensor_temp
 
         # v3 Tilts send battery age in weeks using the tx_pwr field, but they have a hack in place to maintain
         # compatibility with iPhones where they alternate sending "197" (unsigned) or "-59" (signed) with the actual
@@ -109,27 +236,41 @@ class TiltHydrometer:
             self.weeks_on_battery = tx_pwr
 
         # For now, we aren't calibrating either gravity or temp inside this daemon. It's up to the system we are
-        # communicating with (e.g. Fermentrack) to apply any necessary calibration.
-        self.gravity = self.raw_gravity
-        self.temp = self.raw_temp
-
+        # communicating with (e.g. Fermentrack) to apply any necessary calibration. If we ever start applying
+        # calibration, we want to smooth the calibrated values, not the raw values.
         self.rssi = rssi
-        # If we ever start applying calibration, we want to smooth the calibrated values, not the raw values
-        self._add_to_list(self.gravity, self.temp)
+        self._add_to_list(sensor_gravity, sensor_temp)
+        metrics.hydrometer_readings.value += 1
+
+    def process_duplicate(self, rssi: int):
+        """Called when an advertisement that has already been processed is received again (e.g. by a second bluetooth
+        adapter). The reading isn't counted twice, but we keep whichever signal strength was best."""
+        if rssi > self.rssi:
+            self.rssi = rssi
+            self.version += 1
 
     @staticmethod
-    def _average_deque(d: deque) -> float:
-        if len(d) <= 0:
-            return 0.0
-        return sum(d) / len(d)
+    def _average_sum(total: int, count: int) -> int:
+        """Returns total / count, rounded (half to even, the same as Decimal.quantize) to an integer"""
+        if count <= 0:
+            return 0
+        quotient, remainder = divmod(total, count)
+        if remainder * 2 > count or (remainder * 2 == count and quotient % 2 == 1):
+            quotient += 1
+        return quotient
 
     def smoothed_gravity(self) -> Decimal:
-        # Return the average gravity in gravity_list
-        return Decimal(self._average_deque(self.gravity_list)).quantize(Decimal('.0001' if self.tilt_pro else '.001'))
+        # Return the average gravity in the smoothing window. As we're averaging raw sensor values, the result is
+        # already at the precision of the sensor - we just need to scale it.
+        if self.gravity_smoother is not None:
+            return Decimal(self.gravity_smoother.value()).scaleb(-4 if self.tilt_pro else -3)
+        return Decimal(self._average_sum(self.gravity_sum, self._ring_count)).scaleb(-4 if self.tilt_pro else -3)
 
     def smoothed_temp(self) -> Decimal:
-        # Return the average temp in temp_list
-        return Decimal(self._average_deque(self.temp_list)).quantize(Decimal('.1' if self.tilt_pro else '1.'))
+        # Return the average temp in the smoothing window
+        if self.temp_smoother is not None:
+            return Decimal(self.temp_smoother.value()).scaleb(-1 if self.tilt_pro else 0)
+        return Decimal(self._average_sum(self.temp_sum, self._ring_count)).scaleb(-1 if self.tilt_pro else 0)
 
     @classmethod
     def color_lookup(cls, color):
@@ -143,10 +284,26 @@ class TiltHydrometer:
     def print_data(self):
         print("{} Tilt: {} ({}) / {} F".format(self.color, self.smoothed_gravity(), self.gravity, self.temp))
 
-    def to_dict(self):
-        """Return a JSON-serializable dictionary representation of the object"""
-        return {
+    def mark_flushed(self):
+        """Record the current readings as having been included in a snapshot sent to the data targets"""
+        self.flushed_gravity = self.sensor_gravity
+        self.flushed_temp = self.sensor_temp
+
+    def changed_since_flush(self, gravity_delta: int, temp_delta: int) -> bool:
+        """Returns true if the latest readings differ from those last sent by at least the given deltas (in raw sensor
+        units)"""
+        return (abs(self.sensor_gravity - self.flushed_gravity) >= gravity_delta or
+                abs(self.sensor_temp - self.flushed_temp) >= temp_delta)
+
+    def to_dict(self) -> dict:
+        """Return a JSON-serializable dictionary representation of the object. The dict is cached until the next reading
+        is processed, so it is shared between callers and must not be modified."""
+        if self._cached_version == self.version:
+            return self._cached_dict
+
+        self._cached_dict = {
             "color": self.color,
+            "mac": self.mac,
             "raw_gravity": str(self.raw_gravity),
             # "gravity": str(self.gravity),
             "raw_temp": str(self.raw_temp),
@@ -162,4 +319,13 @@ class TiltHydrometer:
             "smoothed_temp": str(self.smoothed_temp()),
             "smoothing_window": self.smoothing_window,
             "temp_format": self.temp_format,
-        }
\ No newline at end of file
+        }
+        self._cached_json = None
+        self._cached_version = self.version
+        return self._cached_dict
+
+    def to_json(self) -> bytes:
+        """Return to_dict() encoded as JSON, cached until the next reading is processed"""
+        if self._cached_version != self.version or self._cached_json is None:
+            self._cached_json = json.dumps(self.to_dict()).encode()
+        return self._cached_json
@@ -0,0 +1,42 @@
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class BeaconDeduplicator:
+    """Detects the same advertisement being received more than once - e.g. when several bluetooth adapters are in range
+    of the same Tilt - so that it isn't counted twice in the smoothing window.
+
+    Advertisements are keyed on the MAC address and payload. A repeat of the same key within window seconds of it first
+    being seen is a duplicate. The window needs to be much shorter than the interval the Tilt advertises at, as a Tilt
+    broadcasts the same reading several times in a row."""
+
+    DEFAULT_WINDOW = 0.25  # seconds
+
+    def __init__(self, window: float = DEFAULT_WINDOW):
+        self.window = window  # type: float
+        # key -> the time it was first seen, oldest first - see _expire()
+        self.seen = OrderedDict()  # type: OrderedDict[Hashable, float]
+
+    def __len__(self):
+        return len(self.seen)
+
+    def _expire(self, now: float):
+        seen = self.seen
+        while len(seen) > 0:
+            key, first_seen = next(iter(seen.items()))
+            if now - first_seen < self.window:
+                return
+            seen.popitem(last=False)
+
+    def is_duplicate(self, key: Hashable, now: float or None = None) -> bool:
+        """Returns True if key has been seen within the window, otherwise records it as seen and returns False"""
+        if now is None:
+            now = time.monotonic()
+        first_seen = self.seen.get(key)
+        if first_seen is not None and now - first_seen < self.window:
+            return True
+        self.seen[key] = now
+        self.seen.move_to_end(key)
+        self._expire(now)
+        return False
@@ -0,0 +1,139 @@
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+import tilt_decoder
+
+# A single-producer, single-consumer ring buffer of decoded Tilt beacons in shared memory, used to hand beacons from the
+# ingestion process (which only reads and decodes HCI frames) to the pipeline process (which owns the hydrometers and
+# data targets) when running with TILTBRIDGE_JR_SPLIT_PROCESSES.
+#
+# Each side only ever writes its own fields: the writer owns the write index, the overflow count, its heartbeat and the
+# ingestion counters; the reader owns the read index and its heartbeat; the supervisor owns the restart counts. The
+# indexes count every record ever written/read, so the ring is full when they are `capacity` apart, and a record's slot
+# is its index modulo the capacity. The writer stores the record before advancing the write index, so the reader never
+# sees a slot that is still being written.
+#
+# If the reader falls behind (e.g. the pipeline process has hung, and is about to be restarted) the writer drops new
+# beacons rather than waiting, so the ingestion process never blocks.
+
+# The header is a series of unsigned 64 bit fields, followed by the ingestion process's frame counters (see
+# INGEST_COUNTERS)
+_HEADER_FIELDS = ('write_index', 'read_index', 'capacity', 'overflows', 'writer_heartbeat', 'reader_heartbeat',
+                  'ingest_restarts', 'pipeline_restarts')
+# Frame counters kept by the ingestion process, published so the pipeline process can serve them with its own metrics
+INGEST_COUNTERS = ('frames_received', 'frames_not_tilt', 'frames_fallback', 'frames_fallback_rejected',
+                   'decode_cache_hits', 'decode_cache_misses', 'scan_rescans', 'scan_reopens')
+_FIELD = struct.Struct('<Q')
+_OFFSETS = {name: i * _FIELD.size for i, name in enumerate(_HEADER_FIELDS)}
+_WRITE_INDEX = _OFFSETS['write_index']
+_READ_INDEX = _OFFSETS['read_index']
+_COUNTERS = struct.Struct(f"<{len(INGEST_COUNTERS)}Q")
+_COUNTERS_OFFSET = len(_HEADER_FIELDS) * _FIELD.size
+HEADER_SIZE = _COUNTERS_OFFSET + _COUNTERS.size
+
+# uuid, mac, temp, gravity, tx_pwr, rssi - padded to 32 bytes
+RECORD = struct.Struct('<16s6sHHBb4x')
+
+DEFAULT_CAPACITY = 4096  # About an hour of beacons from a dozen Tilts, in 128KB
+
+
+class BeaconRing:
+    """A ring buffer of decoded Tilt beacons in a named shared memory block. Create it in the supervising process with
+    create(), and attach to it by name in the writer and reader processes with attach()."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False):
+        self.shm = shm  # type: shared_memory.SharedMemory
+        # Only the process that created the block unlinks it
+        self.owner = owner  # type: bool
+        self.buf = shm.buf  # type: memoryview
+        self.capacity = self._get('capacity')  # type: int
+        self.mask = self.capacity - 1  # type: int
+        # Each side's copy of the index it owns, so it never has to be read back from shared memory
+        self.write_index = self._get('write_index')  # type: int
+        self.read_index = self._get('read_index')  # type: int
+
+    @classmethod
+    def create(cls, capacity: int = DEFAULT_CAPACITY) -> 'BeaconRing':
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError(f"Ring capacity must be a power of two, not {capacity}")
+        shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * RECORD.size)
+        shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        _FIELD.pack_into(shm.buf, _OFFSETS['capacity'], capacity)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> 'BeaconRing':
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _get(self, field: str) -> int:
+        return _FIELD.unpack_from(self.buf, _OFFSETS[field])[0]
+
+    def _set(self, field: str, value: int):
+        _FIELD.pack_into(self.buf, _OFFSETS[field], value)
+
+    def put(self, frame: tilt_decoder.TiltFrame) -> bool:
+        """Add a decoded beacon (writer only). Returns False (and counts an overflow) if the ring is full."""
+        write_index = self.write_index
+        if write_index - _FIELD.unpack_from(self.buf, _READ_INDEX)[0] >= self.capacity:
+            self._set('overflows', self._get('overflows') + 1)
+            return False
+        RECORD.pack_into(self.buf, HEADER_SIZE + (write_index & self.mask) * RECORD.size, *frame)
+        self.write_index = write_index + 1
+        _FIELD.pack_into(self.buf, _WRITE_INDEX, self.write_index)
+        return True
+
+    def read(self) -> List[tilt_decoder.TiltFrame]:
+        """Remove and return every beacon waiting in the ring (reader only)"""
+        read_index = self.read_index
+        write_index = _FIELD.unpack_from(self.buf, _WRITE_INDEX)[0]
+        if write_index == read_index:
+            return []
+        buf, mask, unpack_from = self.buf, self.mask, RECORD.unpack_from
+        frames = [unpack_from(buf, HEADER_SIZE + (index & mask) * RECORD.size)
+                  for index in range(read_index, write_index)]
+        self.read_index = write_index
+        _FIELD.pack_into(buf, _READ_INDEX, write_index)
+        return frames
+
+    def __len__(self):
+        return self._get('write_index') - self._get('read_index')
+
+    @property
+    def overflows(self) -> int:
+        return self._get('overflows')
+
+    def beat(self, side: str):
+        """Record that the writer/reader is still alive (see Supervisor)"""
+        self._set(f"{side}_heartbeat", time.monotonic_ns())
+
+    def heartbeat(self, side: str) -> int:
+        """The time.monotonic_ns() of the writer/reader's last heartbeat, or 0 if it hasn't sent one yet"""
+        return self._get(f"{side}_heartbeat")
+
+    def count_restart(self, process: str):
+        """Count a restart of the ingest/pipeline process (supervisor only)"""
+        field = f"{process}_restarts"
+        self._set(field, self._get(field) + 1)
+
+    def restarts(self, process: str) -> int:
+        return self._get(f"{process}_restarts")
+
+    def publish_counters(self, values: Tuple[int, ...]):
+        """Publish the ingestion process's frame counters, in the order of INGEST_COUNTERS (writer only)"""
+        _COUNTERS.pack_into(self.buf, _COUNTERS_OFFSET, *values)
+
+    def counters(self) -> Tuple[int, ...]:
+        return _COUNTERS.unpack_from(self.buf, _COUNTERS_OFFSET)
+
+    def close(self):
+        """Detach from the shared memory block, removing it if this process created it"""
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,227 @@
+"""Fermentrack target bandwidth benchmark
+
+Sends a stream of snapshots from a few simulated hydrometers to a local stand-in for Fermentrack, with each combination
+of connection reuse, delta encoding and gzip, and reports the bytes on the wire (HTTP requests and responses, excluding
+TCP/TLS overhead), the number of TCP connections opened and requests/sec. No network or Fermentrack install is needed.
+
+Run from the repository root with:  python -m benchmarks.bench_fermentrack [--sends N] [--tilts N]
+"""
+import argparse
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+from typing import Dict, List
+
+import data_targets.legacy_fermentrack_target as legacy_fermentrack_target
+from TiltHydrometer import TiltHydrometer
+from data_targets.delta_encoder import DeltaEncoder
+from data_targets.legacy_fermentrack_target import LegacyFermentrackTarget
+from data_targets.snapshot import Snapshot
+
+
+class Counting:
+    """Wraps a socket file, counting the bytes read from or written to it"""
+
+    def __init__(self, file, stats: Dict[str, int], key: str):
+        self.file = file
+        self.stats = stats
+        self.key = key
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self.stats[self.key] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.file.readline(*args)
+        self.stats[self.key] += len(data)
+        return data
+
+    def write(self, data):
+        self.stats[self.key] += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts Fermentrack payloads (full or delta, optionally gzipped), advertising gzip support like a server that
+    implements RFC 7694 would"""
+    protocol_version = 'HTTP/1.1'  # Keep connections open between requests
+    # Send each response in one write - the headers and body in separate packets would stall on delayed ACKs
+    wbufsize = 4096
+
+    def setup(self):
+        super().setup()
+        stats = self.server.stats
+        stats['connections'] += 1
+        self.rfile = Counting(self.rfile, stats, 'bytes_sent')
+        self.wfile = Counting(self.wfile, stats, 'bytes_received')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        payload = json.loads(body)
+        state = self.server.state
+        if not payload.get('delta'):
+            state.clear()
+        for tilt in payload['tilts']:
+            state.setdefault((tilt['color'], tilt['mac']), {}).update(tilt)
+        self.server.stats['requests'] += 1
+
+        response = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.send_header('Accept-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.stats = {'connections': 0, 'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+        # The latest fields of each hydrometer, as merged from the payloads received
+        self.state = {}  # type: Dict[tuple, dict]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/tiltbridge/"
+
+
+class NewConnectionTarget(LegacyFermentrackTarget):
+    """Opens a new connection for every request, the same as requests.post() without a Session"""
+
+    def _post(self, url: str, data: bytes) -> bool:
+        try:
+            return super()._post(url, data)
+        finally:
+            self.session.close()
+            self.session = None
+
+
+class SimulatedClock:
+    """Stands in for the time module in the target, so periodic resyncs happen at the same point in the stream of
+    snapshots as they would when sending every send_frequency seconds"""
+
+    def __init__(self):
+        self.now_ns = 0
+
+    def monotonic_ns(self) -> int:
+        return self.now_ns
+
+
+def readings(tilt_count: int, sends: int, seed: int = 1) -> List[List[tuple]]:
+    """A reproducible stream of readings - for each send, the (gravity, temp, rssi) of every hydrometer that sent a
+    beacon since the last one. Gravity drifts slowly, temperature rarely changes, and RSSI is noisy."""
+    rng = random.Random(seed)
+    state = [[1060 - i * 5, 68, -70 - i * 3] for i in range(tilt_count)]
+    stream = []
+    for _ in range(sends):
+        batch = []
+        for i, tilt_state in enumerate(state):
+            if rng.random() < 0.3:
+                continue  # No beacon from this hydrometer since the last send
+            if rng.random() < 0.1:
+                tilt_state[0] -= 1
+            if rng.random() < 0.05:
+                tilt_state[1] += rng.choice((-1, 1))
+            batch.append((i, tilt_state[0], tilt_state[1], tilt_state[2] + rng.randint(-3, 3)))
+        stream.append(batch)
+    return stream
+
+
+def run(target: LegacyFermentrackTarget, tilt_count: int, stream: List[List[tuple]], send_frequency: float) -> dict:
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    target.enabled = True
+    target.target_url = server.url
+
+    tilts = {}
+    for i, color in enumerate(list(TiltHydrometer.tilt_colors)[:tilt_count]):
+        tilts[color] = TiltHydrometer(color, f"aa:bb:cc:dd:ee:{i:02x}")
+    colors = list(tilts)
+
+    previous = None
+    clock = SimulatedClock()
+    legacy_fermentrack_target.time = clock
+    start = time.perf_counter()
+    try:
+        for batch in stream:
+            for i, gravity, temp, rssi in batch:
+                tilts[colors[i]].process_decoded_values(gravity, temp, rssi, 197)
+            snapshot = Snapshot.build(tilts, previous)
+            if snapshot is not previous:
+                target._send(snapshot)
+            previous = snapshot
+            clock.now_ns += int(send_frequency * 1e9)
+    finally:
+        legacy_fermentrack_target.time = time
+    elapsed = time.perf_counter() - start
+
+    if target.session is not None:
+        target.session.close()
+    server.shutdown()
+    server.server_close()
+    target.executor.shutdown()
+
+    # Whatever was sent, the server should have ended up with the latest readings
+    assert server.state == {(tilt.color, tilt.mac): tilt.to_dict() for tilt in tilts.values()}
+    stats = dict(server.stats)
+    stats['elapsed_s'] = elapsed
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bandwidth used sending to Fermentrack")
+    parser.add_argument('--sends', type=int, default=1000, help="Number of snapshots to send")
+    parser.add_argument('--tilts', type=int, default=4, help="Number of hydrometers")
+    parser.add_argument('--send-frequency', type=float, default=3,
+                        help="Simulated seconds between sends (for delta encoding resyncs)")
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+    stream = readings(args.tilts, args.sends)
+
+    def target(cls=LegacyFermentrackTarget, gzip_enabled: bool or None = False, delta: bool = False):
+        t = cls()
+        t.gzip = gzip_enabled
+        t.delta = DeltaEncoder(int(LegacyFermentrackTarget.RESYNC_INTERVAL.total_seconds() * 1e9)) if delta else None
+        return t
+
+    variants = {
+        'new connection per send': target(NewConnectionTarget),
+        'keep-alive': target(),
+        'keep-alive + gzip': target(gzip_enabled=None),
+        'keep-alive + delta': target(delta=True),
+        'keep-alive + delta + gzip': target(gzip_enabled=None, delta=True),
+    }
+    results = {name: run(t, args.tilts, stream, args.send_frequency) for name, t in variants.items()}
+
+    print(f"{args.sends} snapshots of {args.tilts} hydrometers, every {args.send_frequency:g}s")
+    print(f"{'':<28}{'requests':>10}{'conns':>8}{'sent/req':>10}{'recv/req':>10}{'total KiB':>11}{'req/s':>9}")
+    for name, stats in results.items():
+        requests = max(stats['requests'], 1)
+        print(f"{name:<28}{stats['requests']:>10}{stats['connections']:>8}{stats['bytes_sent'] / requests:>10.0f}"
+              f"{stats['bytes_received'] / requests:>10.0f}"
+              f"{(stats['bytes_sent'] + stats['bytes_received']) / 1024:>11.1f}"
+              f"{stats['requests'] / stats['elapsed_s']:>9.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
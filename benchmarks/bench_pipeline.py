@@ -0,0 +1,211 @@
+"""Pipeline throughput benchmark
+
+Replays a capture file (recorded by setting TILTBRIDGE_JR_CAPTURE_FILE) or a synthetic mix of Tilt Classic/Pro frames
+and non-Tilt noise through process_ble_beacon - decoding, TiltHydrometer smoothing and data target dispatch - and
+reports beacons/sec, per-stage latency percentiles and allocations. No bluetooth adapter is needed.
+
+Run from the repository root with:  python -m benchmarks.bench_pipeline [--capture FILE] [--frames N] [--realtime]
+                                    [--no-decode-cache]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import tracemalloc
+from typing import Callable, List
+
+import ble_capture
+import data_targets.data_target_handler as data_target_handler
+import metrics
+import tilt_decoder
+import tiltbridge_junior
+from data_targets.data_target import DataTarget
+from data_targets.legacy_fermentrack_target import LegacyFermentrackTarget
+from hydrometer_registry import HydrometerRegistry
+from TiltHydrometer import TiltHydrometer
+
+
+class NullTarget(DataTarget):
+    """Data target that serializes snapshots the same way a real target would, but doesn't send them anywhere"""
+    name = "Benchmark Target"
+
+    def load_config(self):
+        self.enabled = True
+
+    async def send(self, snapshot):
+        LegacyFermentrackTarget.encode_payload(snapshot)
+
+
+class UncachedDecoder:
+    """Stands in for tiltbridge_junior.decode_cache, decoding every frame from scratch"""
+    decode = staticmethod(tilt_decoder.decode_tilt_frame)
+
+    def clear(self):
+        pass
+
+
+class StageTimer:
+    """Records the latency of every call to a wrapped function"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = []  # type: List[int]
+
+    def wrap(self, func: Callable) -> Callable:
+        samples = self.samples
+        perf_counter_ns = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(perf_counter_ns() - start)
+        return timed
+
+    def wrap_async(self, func: Callable) -> Callable:
+        samples = self.samples
+        perf_counter_ns = time.perf_counter_ns
+
+        async def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples.append(perf_counter_ns() - start)
+        return timed
+
+    def percentiles(self) -> dict:
+        if len(self.samples) <= 0:
+            return {'count': 0}
+        samples = sorted(self.samples)
+
+        def pct(p: float) -> float:
+            return samples[min(len(samples) - 1, int(len(samples) * p))] / 1000
+
+        return {'count': len(samples), 'p50_us': pct(0.5), 'p90_us': pct(0.9), 'p99_us': pct(0.99),
+                'max_us': samples[-1] / 1000}
+
+
+async def run_pipeline(frames: List[ble_capture.CapturedFrame], realtime: bool, send_frequency: float) -> float:
+    """Replay the frames through process_ble_beacon with a fresh set of hydrometers and a NullTarget. Returns the
+    elapsed time in seconds."""
+    tiltbridge_junior.tilts = HydrometerRegistry()
+    tiltbridge_junior.decode_cache.clear()
+    target = NullTarget()
+    target.load_config()
+    target.send_frequency = datetime.timedelta(seconds=send_frequency)
+    data_target_handler.targets = [target]
+    data_target_handler.last_snapshot = None
+    handler_task = asyncio.create_task(data_target_handler.run(tiltbridge_junior.tilts))
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await ble_capture.replay(frames, tiltbridge_junior.process_ble_beacon, realtime=realtime)
+    elapsed = time.perf_counter() - start
+
+    # Send whatever is left, so the flush and send stages are measured even if the replay finished within one interval
+    data_target_handler.flush(tiltbridge_junior.tilts, force=True)
+    await asyncio.sleep(0)
+    handler_task.cancel()
+    await asyncio.gather(handler_task, return_exceptions=True)
+    return elapsed
+
+
+def measure_stages(frames: List[ble_capture.CapturedFrame], realtime: bool, send_frequency: float) -> List[StageTimer]:
+    """Replay the frames with each stage of the pipeline wrapped in a StageTimer"""
+    stages = {
+        'frame (total)': StageTimer('frame (total)'),
+        'decode': StageTimer('decode'),
+        'hydrometer': StageTimer('hydrometer'),
+        'mark dirty': StageTimer('mark dirty'),
+        'flush': StageTimer('flush'),
+        'target send': StageTimer('target send'),
+    }
+    originals = (tiltbridge_junior.process_ble_beacon, tiltbridge_junior.decode_ble_beacon,
+                 TiltHydrometer.process_decoded_values, data_target_handler.mark_dirty, data_target_handler.flush,
+                 NullTarget.send)
+
+    tiltbridge_junior.decode_ble_beacon = stages['decode'].wrap(tiltbridge_junior.decode_ble_beacon)
+    TiltHydrometer.process_decoded_values = stages['hydrometer'].wrap(TiltHydrometer.process_decoded_values)
+    data_target_handler.mark_dirty = stages['mark dirty'].wrap(data_target_handler.mark_dirty)
+    data_target_handler.flush = stages['flush'].wrap(data_target_handler.flush)
+    NullTarget.send = stages['target send'].wrap_async(NullTarget.send)
+    process = stages['frame (total)'].wrap(tiltbridge_junior.process_ble_beacon)
+    try:
+        tiltbridge_junior.process_ble_beacon = process
+        asyncio.run(run_pipeline(frames, realtime, send_frequency))
+    finally:
+        (tiltbridge_junior.process_ble_beacon, tiltbridge_junior.decode_ble_beacon,
+         TiltHydrometer.process_decoded_values, data_target_handler.mark_dirty, data_target_handler.flush,
+         NullTarget.send) = originals
+    return list(stages.values())
+
+
+def measure_allocations(frames: List[ble_capture.CapturedFrame], send_frequency: float) -> dict:
+    tracemalloc.start()
+    asyncio.run(run_pipeline(frames, False, send_frequency))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'retained_bytes': current, 'peak_bytes': peak, 'peak_bytes_per_frame': peak / max(len(frames), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TiltBridge Junior packet pipeline")
+    parser.add_argument('--capture', help="Capture file to replay (default: synthetic frames)")
+    parser.add_argument('--frames', type=int, default=100000, help="Number of synthetic frames to generate")
+    parser.add_argument('--tilts', type=int, default=8, help="Number of Tilts in the synthetic frames")
+    parser.add_argument('--tilt-fraction', type=float, default=0.05, help="Fraction of synthetic frames that are Tilts")
+    parser.add_argument('--send-frequency', type=float, default=0.1, help="Data target send frequency (seconds)")
+    parser.add_argument('--realtime', action='store_true', help="Replay at the recorded pace")
+    parser.add_argument('--no-decode-cache', action='store_true', help="Decode every frame from scratch")
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    if args.no_decode_cache:
+        tiltbridge_junior.decode_cache = UncachedDecoder()
+
+    if args.capture:
+        frames = list(ble_capture.read_capture(args.capture))
+    else:
+        frames = list(ble_capture.synthetic_frames(args.frames, tilt_count=args.tilts,
+                                                   tilt_fraction=args.tilt_fraction))
+
+    hits, misses = metrics.decode_cache_hits.value, metrics.decode_cache_misses.value
+    elapsed = asyncio.run(run_pipeline(frames, args.realtime, args.send_frequency))
+    hits, misses = metrics.decode_cache_hits.value - hits, metrics.decode_cache_misses.value - misses
+    results = {
+        'frames': len(frames),
+        'elapsed_s': elapsed,
+        'frames_per_s': len(frames) / elapsed,
+        'hydrometers': len(tiltbridge_junior.tilts),
+        'decode_cache_hit_rate': hits / (hits + misses) if hits + misses > 0 else None,
+        'stages': {stage.name: stage.percentiles() for stage in measure_stages(frames, args.realtime,
+                                                                               args.send_frequency)},
+        'allocations': measure_allocations(frames, args.send_frequency),
+    }
+
+    print(f"{results['frames']} frames in {elapsed:.3f}s - {results['frames_per_s']:.0f} frames/s "
+          f"({results['hydrometers']} hydrometers)")
+    if results['decode_cache_hit_rate'] is not None:
+        print(f"decode cache: {results['decode_cache_hit_rate']:.1%} of {hits + misses} possible Tilt frames hit")
+    print(f"{'stage':<20}{'count':>10}{'p50 (us)':>12}{'p90 (us)':>12}{'p99 (us)':>12}{'max (us)':>12}")
+    for name, stage in results['stages'].items():
+        if stage['count'] <= 0:
+            print(f"{name:<20}{0:>10}")
+            continue
+        print(f"{name:<20}{stage['count']:>10}{stage['p50_us']:>12.2f}{stage['p90_us']:>12.2f}"
+              f"{stage['p99_us']:>12.2f}{stage['max_us']:>12.2f}")
+    allocations = results['allocations']
+    print(f"allocations: peak {allocations['peak_bytes'] / 1024:.1f} KiB "
+          f"({allocations['peak_bytes_per_frame']:.2f} bytes/frame), "
+          f"retained {allocations['retained_bytes'] / 1024:.1f} KiB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
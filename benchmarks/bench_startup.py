@@ -0,0 +1,168 @@
+"""Cold start benchmark
+
+Measures how long TiltBridge Junior takes to start reading beacons - the time to import tiltbridge_junior (with a
+breakdown of the slowest imports, from python -X importtime), and the time from launching the interpreter to the first
+decoded Tilt beacon. Each run starts a fresh interpreter that runs the same startup path as tiltbridge_junior.py, with
+the bluetooth scanner replaced by a replay of synthetic frames (see ble_capture), so no bluetooth adapter is needed.
+
+Results can be appended to a JSON lines file with --history, to track startup time over time.
+
+Run from the repository root with:  python -m benchmarks.bench_startup [--runs N] [--history FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import ble_capture
+
+# Run in a fresh interpreter - the same as tiltbridge_junior.py's __main__, except that scanning replays a capture file
+CHILD = """
+import time
+import_start = time.monotonic()
+import tiltbridge_junior
+imported = time.monotonic()
+import asyncio, json, os, sys
+import ble_capture, ble_scanner, log_writer
+
+class ReplayScanner(ble_scanner.Scanner):
+    def __init__(self, task):
+        super().__init__(0, None)
+        self.task = task
+
+    @property
+    def running(self):
+        return True
+
+    async def stop(self):
+        self.task.cancel()
+
+async def start_scanners(devices, process, kernel_filter=False, include_failed=False):
+    frames = ble_capture.read_capture(sys.argv[1])
+    return [ReplayScanner(asyncio.create_task(ble_capture.replay(frames, process)))]
+
+def first_beacon(decoded):
+    print(json.dumps({'import_start': import_start, 'imported': imported, 'first_beacon': time.monotonic()}),
+          flush=True)
+    os._exit(0)
+
+ble_scanner.start_scanners = start_scanners
+tiltbridge_junior.process_tilt_frame = first_beacon
+tiltbridge_junior.load_scan_config()
+writer = log_writer.log_writer_from_env()
+writer.start()
+tiltbridge_junior.load_config_file()
+asyncio.run(tiltbridge_junior.async_main())
+"""
+
+VARIANTS = {
+    'sentry enabled': {'TILTBRIDGE_JR_SENTRY_ENABLED': 'true'},
+    'sentry disabled': {'TILTBRIDGE_JR_SENTRY_ENABLED': 'false'},
+}
+
+
+def import_breakdown(module: str = 'tiltbridge_junior', top: int = 10) -> Dict[str, float]:
+    """The cumulative import time (in ms) of module and of the slowest modules it imports directly, as reported by
+    python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True,
+                            text=True, check=True)
+    # python -X importtime lists each module after everything it imported, indented one level deeper than it
+    imports = []  # type: List[Tuple[int, str, float]]
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imports.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative) / 1000))
+
+    position = next(x for x, (_, name, _) in enumerate(imports) if name == module)
+    depth, _, total = imports[position]
+    direct = {}
+    for indent, name, ms in reversed(imports[:position]):
+        if indent <= depth:
+            break  # Imported before module started importing
+        if indent == depth + 2:
+            direct[name] = ms
+    slowest = sorted(direct.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {module: total, **dict(slowest)}
+
+
+def cold_start(capture_path: str, env: Dict[str, str], log_dir: str) -> Dict[str, float]:
+    """Start a fresh interpreter, and return the time (in ms since launching it) until tiltbridge_junior was imported
+    and until the first beacon was decoded"""
+    child_env = dict(os.environ, TILTBRIDGE_JR_LOG_FILE=os.path.join(log_dir, 'tiltbridge-jr.log'), **env)
+    launched = time.monotonic()
+    result = subprocess.run([sys.executable, '-c', CHILD, capture_path], capture_output=True, text=True,
+                            env=child_env, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup run failed:\n{result.stderr}")
+    timings = json.loads(result.stdout.splitlines()[-1])
+    return {
+        'interpreter_ms': (timings['import_start'] - launched) * 1000,
+        'import_ms': (timings['imported'] - timings['import_start']) * 1000,
+        'first_beacon_ms': (timings['first_beacon'] - launched) * 1000,
+    }
+
+
+def git_revision() -> str or None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TiltBridge Junior's cold start")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="Number of cold starts of each variant (the median is used)")
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    parser.add_argument('--history', help="Append the results to this file as a line of JSON, to track them over time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        capture_path = os.path.join(directory, 'capture.bin')
+        writer = ble_capture.CaptureWriter(capture_path)
+        for timestamp_ns, frame in ble_capture.synthetic_frames(1000):
+            writer.write(frame, timestamp_ns)
+        writer.close()
+
+        runs = {name: [] for name in VARIANTS}  # type: Dict[str, List[Dict[str, float]]]
+        for _ in range(args.runs):
+            for name, env in VARIANTS.items():
+                runs[name].append(cold_start(capture_path, env, directory))
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'imports_ms': import_breakdown(),
+        'cold_start': {name: {key: statistics.median(run[key] for run in variant_runs) for key in variant_runs[0]}
+                       for name, variant_runs in runs.items()},
+    }
+
+    print(f"{'import':<40}{'cumulative (ms)':>16}")
+    for name, ms in results['imports_ms'].items():
+        print(f"{name:<40}{ms:>16.1f}")
+    print()
+    print(f"median of {args.runs} cold starts")
+    print(f"{'':<20}{'interpreter (ms)':>18}{'import (ms)':>14}{'first beacon (ms)':>20}")
+    for name, timings in results['cold_start'].items():
+        print(f"{name:<20}{timings['interpreter_ms']:>18.1f}{timings['import_ms']:>14.1f}"
+              f"{timings['first_beacon_ms']:>20.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.history:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
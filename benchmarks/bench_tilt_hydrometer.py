@@ -0,0 +1,187 @@
+"""Microbenchmark for TiltHydrometer smoothing
+
+Compares the per-beacon (process_decoded_values) and per-snapshot (to_dict) cost, and the memory footprint, of
+TiltHydrometer against a reference implementation of the original, which kept a deque of Decimal values and re-summed
+it on every read, and against TiltHydrometer with the original wall-clock (datetime) expiry checks. The expiry check is
+also timed on its own. Each of the alternative smoothing strategies (see smoothing) is benchmarked too.
+
+Run from the repository root with:  python -m benchmarks.bench_tilt_hydrometer
+"""
+import datetime
+import timeit
+import tracemalloc
+from collections import deque
+from decimal import Decimal
+
+import smoothing
+from TiltHydrometer import TiltHydrometer
+
+
+class DequeMeanHydrometer:
+    """The original TiltHydrometer reading/smoothing path - Decimal values in a deque, averaged with sum(d)/len(d) on
+    every read"""
+
+    def __init__(self, smoothing_window: int = 60):
+        self.color = 'Red'
+        self.smoothing_window = smoothing_window
+        self.gravity_list = deque(maxlen=smoothing_window)
+        self.temp_list = deque(maxlen=smoothing_window)
+        self.last_value_received = datetime.datetime.now() - self._cache_expiry_seconds()
+        self.raw_gravity = Decimal(0.0)
+        self.raw_temp = Decimal(0.0)
+        self.gravity = Decimal(0.0)
+        self.temp = Decimal(0.0)
+        self.rssi = 0
+        self.sends_battery = False
+        self.weeks_on_battery = 0
+        self.firmware_version = 0
+        self.tilt_pro = False
+        self.temp_format = 'F'
+
+    def _cache_expiry_seconds(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=(self.smoothing_window * 1.2 * 4))
+
+    def expired(self) -> bool:
+        return self.last_value_received <= datetime.datetime.now() - self._cache_expiry_seconds()
+
+    def _add_to_list(self, gravity, temp):
+        if self.expired():
+            self.gravity_list.clear()
+            self.temp_list.clear()
+        self.last_value_received = datetime.datetime.now()
+        self.gravity_list.append(gravity)
+        self.temp_list.append(temp)
+
+    def process_decoded_values(self, sensor_gravity: int, sensor_temp: int, rssi: int, tx_pwr: int):
+        if sensor_gravity >= 5000:
+            self.tilt_pro = True
+            self.raw_gravity = Decimal(sensor_gravity) / 10000
+            self.raw_temp = Decimal(sensor_temp) / 10
+        else:
+            self.tilt_pro = False
+            self.raw_gravity = Decimal(sensor_gravity) / 1000
+            self.raw_temp = Decimal(sensor_temp)
+        if tx_pwr == 197:
+            self.sends_battery = True
+        elif self.sends_battery:
+            self.weeks_on_battery = tx_pwr
+        self.gravity = self.raw_gravity
+        self.temp = self.raw_temp
+        self.rssi = rssi
+        self._add_to_list(self.gravity, self.temp)
+
+    @staticmethod
+    def _average_deque(d: deque) -> float:
+        if len(d) <= 0:
+            return 0.0
+        return sum(d) / len(d)
+
+    def smoothed_gravity(self) -> Decimal:
+        return Decimal(self._average_deque(self.gravity_list)).quantize(Decimal('.0001' if self.tilt_pro else '.001'))
+
+    def smoothed_temp(self) -> Decimal:
+        return Decimal(self._average_deque(self.temp_list)).quantize(Decimal('.1' if self.tilt_pro else '1.'))
+
+    def to_dict(self):
+        return {
+            "color": self.color,
+            "raw_gravity": str(self.raw_gravity),
+            "raw_temp": str(self.raw_temp),
+            "rssi": self.rssi,
+            "tilt_pro": self.tilt_pro,
+            "sends_battery": self.sends_battery,
+            "weeks_on_battery": self.weeks_on_battery,
+            "firmware_version": self.firmware_version,
+            "smoothed_gravity": str(self.smoothed_gravity()),
+            "smoothed_temp": str(self.smoothed_temp()),
+            "smoothing_window": self.smoothing_window,
+            "temp_format": self.temp_format,
+        }
+
+
+class DatetimeExpiryHydrometer(TiltHydrometer):
+    """TiltHydrometer with the original expiry tracking - datetime.now() and a new timedelta on every check"""
+    __slots__ = ('last_value_received',)
+
+    def __init__(self, color: str):
+        super().__init__(color)
+        self.last_value_received = datetime.datetime.now() - self._cache_expiry_seconds()
+
+    def _cache_expiry_seconds(self) -> datetime.timedelta:
+        return datetime.timedelta(seconds=(self.smoothing_window * 1.2 * 4))
+
+    def expired(self, now_ns=None) -> bool:
+        return self.last_value_received <= datetime.datetime.now() - self._cache_expiry_seconds()
+
+    def _add_to_list(self, sensor_gravity: int, sensor_temp: int):
+        if self.expired():
+            self._clear_lists()
+        pos = self._ring_pos
+        if self._ring_count >= self.smoothing_window:
+            self.gravity_sum -= self._gravity_ring[pos]
+            self.temp_sum -= self._temp_ring[pos]
+        else:
+            self._ring_count += 1
+        self.last_value_received = datetime.datetime.now()
+        self._gravity_ring[pos] = sensor_gravity
+        self._temp_ring[pos] = sensor_temp
+        self.gravity_sum += sensor_gravity
+        self.temp_sum += sensor_temp
+        pos += 1
+        self._ring_pos = 0 if pos >= self.smoothing_window else pos
+
+
+def bench(hydrometer, number: int) -> tuple:
+    """Returns (per-beacon, per-snapshot) cost in microseconds, with a full smoothing window"""
+    readings = [(10450 + (x % 17), 680 + (x % 5), -70, 197) for x in range(number)]
+    for reading in readings[:60]:
+        hydrometer.process_decoded_values(*reading)
+
+    reading_iter = iter(readings)
+    per_beacon = timeit.timeit(lambda: hydrometer.process_decoded_values(*next(reading_iter)), number=number)
+    per_snapshot = timeit.timeit(hydrometer.to_dict, number=number)
+    return per_beacon / number * 1e6, per_snapshot / number * 1e6
+
+
+def memory_per_hydrometer(hydrometer_factory, count: int = 100) -> float:
+    """Returns the memory (in bytes) allocated per hydrometer, with a full smoothing window"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    hydrometers = [hydrometer_factory() for _ in range(count)]
+    for hydrometer in hydrometers:
+        for x in range(60):
+            hydrometer.process_decoded_values(1050 + x, 68, -70, 197)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+def bench_expired(hydrometer, number: int) -> float:
+    """Returns the cost of an expiry check (made for every hydrometer in every snapshot) in microseconds"""
+    hydrometer.process_decoded_values(1050, 68, -70, 197)
+    return timeit.timeit(hydrometer.expired, number=number) / number * 1e6
+
+
+def smoothed_hydrometer(strategy: smoothing.Strategy) -> TiltHydrometer:
+    tilt = TiltHydrometer('Red')
+    strategy.apply(tilt)
+    return tilt
+
+
+def main(number: int = 50000):
+    print(f"{'':<26}{'per beacon (us)':>18}{'per snapshot (us)':>20}{'expired() (us)':>16}{'bytes/hydrometer':>20}")
+    factories = [("deque mean (original)", DequeMeanHydrometer),
+                 ("TiltHydrometer (datetime)", lambda: DatetimeExpiryHydrometer('Red')),
+                 ("TiltHydrometer", lambda: TiltHydrometer('Red'))]
+    for name in smoothing.Strategy.NAMES[1:]:
+        strategy = smoothing.Strategy(name)
+        factories.append((f"  smoothing: {name}", lambda strategy=strategy: smoothed_hydrometer(strategy)))
+    for name, factory in factories:
+        per_beacon, per_snapshot = bench(factory(), number)
+        per_expired = bench_expired(factory(), number)
+        memory = memory_per_hydrometer(factory)
+        print(f"{name:<26}{per_beacon:>18.3f}{per_snapshot:>20.3f}{per_expired:>16.3f}{memory:>20.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import asyncio
+import random
+import struct
+import time
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Tuple
+
+from TiltHydrometer import TiltHydrometer
+
+# Capture files let us record the raw HCI frames handed to process_ble_beacon and replay them later without a bluetooth
+# adapter - for profiling, benchmarking and reproducing bugs.
+#
+# The format is deliberately simple: an 8 byte magic header, followed by one record per frame consisting of a
+# little-endian uint64 timestamp (nanoseconds since the epoch), a uint16 frame length and the frame itself.
+
+CAPTURE_MAGIC = b'TBJRCAP\x01'
+_record_header = struct.Struct('<QH')
+
+# (timestamp_ns, frame)
+CapturedFrame = Tuple[int, bytes]
+
+
+class CaptureWriter:
+    """Writes raw HCI frames to a capture file. Writes are buffered, so that recording on a Raspberry Pi doesn't hit the
+    SD card for every frame."""
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path: str):
+        self.path = path  # type: str
+        self.file = open(path, 'wb', buffering=self.BUFFER_SIZE)  # type: BinaryIO
+        self.file.write(CAPTURE_MAGIC)
+        self.frames_written = 0  # type: int
+
+    def write(self, frame: bytes, timestamp_ns: Optional[int] = None):
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        self.file.write(_record_header.pack(timestamp_ns, len(frame)))
+        self.file.write(frame)
+        self.frames_written += 1
+
+    def recording(self, process: Callable[[bytes], object]) -> Callable[[bytes], object]:
+        """Wrap a frame handler (e.g. process_ble_beacon) so that every frame is written to the capture first"""
+        def record_and_process(frame: bytes):
+            self.write(frame)
+            return process(frame)
+        return record_and_process
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path: str) -> Iterator[CapturedFrame]:
+    """Iterate over the (timestamp_ns, frame) records in a capture file"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a TiltBridge Junior capture file")
+        while True:
+            header = f.read(_record_header.size)
+            if len(header) < _record_header.size:
+                return  # End of file (or a truncated final record, if the daemon was killed mid-write)
+            timestamp_ns, frame_len = _record_header.unpack(header)
+            frame = f.read(frame_len)
+            if len(frame) < frame_len:
+                return
+            yield timestamp_ns, frame
+
+
+def build_adv_report(mac: bytes, ad_data: bytes, rssi: int, extended: bool = False) -> bytes:
+    """Build a single-report HCI LE Advertising Report (or LE Extended Advertising Report) frame"""
+    if extended:
+        body = (b'\x0d\x01\x10\x00\x01' + mac + b'\x01\x00\xff\x7f' + struct.pack('b', rssi) + b'\x00\x00\x00' +
+                b'\x00' * 6 + bytes([len(ad_data)]) + ad_data)
+    else:
+        body = b'\x02\x01\x03\x01' + mac + bytes([len(ad_data)]) + ad_data + struct.pack('b', rssi)
+    return b'\x04\x3e' + bytes([len(body)]) + body
+
+
+def build_tilt_frame(color: str, mac: bytes, temp: int, gravity: int, tx_pwr: int, rssi: int,
+                     extended: bool = False) -> bytes:
+    """Build the frame a Tilt of the given color would broadcast"""
+    uuid = bytes.fromhex(TiltHydrometer.tilt_colors[color].replace('-', ''))
+    ad_data = b'\x02\x01\x04\x1a\xff\x4c\x00\x02\x15' + uuid + struct.pack('>HHB', temp, gravity, tx_pwr)
+    return build_adv_report(mac, ad_data, rssi, extended)
+
+
+def synthetic_frames(count: int, tilt_count: int = 4, tilt_fraction: float = 0.05, frames_per_second: int = 1000,
+                     seed: int = 0) -> Iterator[CapturedFrame]:
+    """Generate a deterministic stream of frames mixing Tilt Classic and Pro beacons with the sort of non-Tilt noise
+    seen in a busy brewery (phones, other iBeacons, trackers, scan responses).
+
+    tilt_fraction is the proportion of frames that are Tilt beacons."""
+    rng = random.Random(seed)
+    colors = list(TiltHydrometer.tilt_colors)
+
+    tilts = []
+    for x in range(tilt_count):
+        pro = x % 2 == 1
+        tilts.append({
+            'color': colors[x % len(colors)],
+            'mac': bytes(rng.getrandbits(8) for _ in range(6)),
+            'gravity': rng.randint(10100, 10600) if pro else rng.randint(1010, 1060),
+            'temp': rng.randint(640, 720) if pro else rng.randint(64, 72),
+        })
+
+    other_ibeacon_uuid = bytes.fromhex('e2c56db5dffb48d2b060d0f5a71096e0')
+    noise_macs = [bytes(rng.getrandbits(8) for _ in range(6)) for _ in range(50)]
+    noise_ads = [
+        # Another iBeacon
+        b'\x02\x01\x06\x1a\xff\x4c\x00\x02\x15' + other_ibeacon_uuid + b'\x00\x01\x00\x02\xc5',
+        # Apple "nearby"/continuity advertisement from a phone
+        b'\x02\x01\x1a\x0a\xff\x4c\x00\x10\x05\x0b\x1c\x8e\x1f\x3a',
+        # Microsoft Swift Pair/CDP beacon
+        b'\x1e\xff\x06\x00\x01\x09\x20\x02' + bytes(range(22)),
+        # Eddystone-UID
+        b'\x02\x01\x06\x03\x03\xaa\xfe\x15\x16\xaa\xfe\x00\xe7' + bytes(range(18)),
+        # Scan response with a complete local name
+        b'\x0c\x09TP357 (B6F3)',
+        # Flags only
+        b'\x02\x01\x06',
+    ]
+
+    interval_ns = 1000000000 // frames_per_second
+    timestamp_ns = 1700000000 * 1000000000
+    for x in range(count):
+        timestamp_ns += interval_ns
+        rssi = rng.randint(-95, -40)
+        if rng.random() < tilt_fraction:
+            tilt = rng.choice(tilts)
+            # Readings drift slowly, and v3 Tilts alternate tx_pwr between 197 and the battery age in weeks
+            tilt['gravity'] += rng.choice((-1, 0, 0, 0, 1))
+            tx_pwr = 197 if x % 2 == 0 else 12
+            frame = build_tilt_frame(tilt['color'], tilt['mac'], tilt['temp'], tilt['gravity'], tx_pwr, rssi,
+                                     extended=rng.random() < 0.1)
+        else:
+            frame = build_adv_report(rng.choice(noise_macs), rng.choice(noise_ads), rssi)
+        yield timestamp_ns, frame
+
+
+async def replay(frames: Iterable[CapturedFrame], process: Callable[[bytes], object], realtime: bool = False,
+                 yield_every: int = 100) -> int:
+    """Feed captured frames to a frame handler (e.g. process_ble_beacon) from inside the event loop, either as fast as
+    possible or at the pace they were recorded. Returns the number of frames replayed.
+
+    When replaying as fast as possible we yield to the event loop every yield_every frames, so that other tasks (such as
+    the data target workers) get to run the same way they would with a real adapter."""
+    loop = asyncio.get_running_loop()
+    replayed = 0
+    first_timestamp_ns = None
+    start = loop.time()
+
+    for timestamp_ns, frame in frames:
+        if realtime:
+            if first_timestamp_ns is None:
+                first_timestamp_ns = timestamp_ns
+            delay = (timestamp_ns - first_timestamp_ns) / 1e9 - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif replayed % yield_every == 0:
+            await asyncio.sleep(0)
+
+        process(frame)
+        replayed += 1
+
+    return replayed
@@ -0,0 +1,205 @@
+import asyncio
+import errno
+import logging
+import time
+from typing import Callable, List, Tuple
+
+import aioblescan as aiobs
+
+import hci_socket
+import metrics
+
+
+LOG = logging.getLogger("tilt")
+
+
+class Scanner:
+    """A BLE scan running on one bluetooth adapter (HCI device). Every frame the adapter receives is passed to process.
+
+    Any number of scanners can run in the same event loop, all feeding the same process function.
+
+    If kernel_filter is set, the kernel only passes on frames that could be Tilts, and all waiting frames are read each
+    time the socket wakes the event loop (see hci_socket)."""
+
+    START_TIMEOUT = 10  # seconds to wait for the adapter to respond when starting a scan
+
+    def __init__(self, device: int, process: Callable[[bytes], object], kernel_filter: bool = False):
+        self.device = device  # type: int
+        self.process = process  # type: Callable[[bytes], object]
+        self.kernel_filter = kernel_filter  # type: bool
+        self.transport = None  # type: asyncio.BaseTransport or None
+        self.btctrl = None  # type: aiobs.BLEScanRequester or None
+        self.frames_received = 0  # type: int
+
+        # Kept by ScanWatchdog
+        self.frames_at_check = 0  # type: int
+        self.progress_ns = 0  # type: int  # When frames were last seen arriving (or the scan was last (re)started)
+        self.rescanned = False  # type: bool  # Whether the scan request has been re-sent since frames last arrived
+        self.failures = 0  # type: int  # Restarts in a row without any frames arriving
+        self.restart_at_ns = 0  # type: int
+
+    def __str__(self):
+        return f"hci{self.device}"
+
+    @property
+    def running(self) -> bool:
+        return self.btctrl is not None
+
+    async def _open_transport(self) -> Tuple[asyncio.BaseTransport, aiobs.BLEScanRequester]:
+        sock = aiobs.create_bt_socket(self.device)
+
+        if self.kernel_filter:
+            hci_socket.configure_socket(sock)
+            btctrl = aiobs.BLEScanRequester()
+            return hci_socket.HCISocketTransport(sock, btctrl), btctrl
+
+        # create a connection with the raw socket (Uses _create_connection_transport instead of create_connection as
+        # this now requires a STREAM socket) - previously was
+        # fac=event_loop.create_connection(aiobs.BLEScanRequester,sock=mysocket)
+        return await asyncio.get_running_loop()._create_connection_transport(sock, aiobs.BLEScanRequester, None, None)
+
+    def _receive(self, data: bytes):
+        self.frames_received += 1
+        self.process(data)
+
+    async def start(self):
+        """Open a raw HCI socket on the adapter and start scanning. Raises OSError if the adapter can't be opened, or
+        doesn't respond."""
+        self.transport, self.btctrl = await self._open_transport()
+        self.btctrl.process = self._receive  # Attach the handler to the bluetooth control loop
+        try:
+            # Waits for the adapter to answer the commands aioblescan sends when the socket is opened
+            await asyncio.wait_for(self.btctrl.send_scan_request(), self.START_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._close()
+            raise OSError(errno.ETIMEDOUT, "Adapter didn't respond")
+
+    async def rescan(self):
+        """Send the adapter the scan request again, in case it has stopped scanning"""
+        await self.btctrl.stop_scan_request()
+        await self.btctrl.send_scan_request()
+
+    async def stop(self):
+        if self.btctrl is None:
+            return
+        try:
+            await self.btctrl.stop_scan_request()
+            command = aiobs.HCI_Cmd_LE_Advertise(enable=False)
+            await self.btctrl.send_command(command)
+        except OSError as e:
+            LOG.warning(f"Unable to stop scanning on {self} - {e}")
+        finally:
+            self._close()
+
+    def _close(self):
+        self.transport.close()
+        self.transport, self.btctrl = None, None
+
+
+class ScanWatchdog:
+    """Watches the frames arriving from each scanner, and restarts the scan on an adapter that has gone quiet - adapters
+    have been known to silently stop delivering advertisements until they are reset.
+
+    Once no frames have arrived from an adapter for stall_timeout seconds, the scan request is sent again. If that
+    doesn't bring frames back within another stall_timeout seconds, the socket is closed and reopened. An adapter that
+    keeps stalling (or can't be reopened) is reopened with an increasing delay, up to MAX_RESTART_DELAY.
+
+    Only the scan is restarted - the hydrometers, and everything else downstream, carry on as they were."""
+
+    CHECK_INTERVAL = 10  # seconds
+    STALL_TIMEOUT = 300  # seconds
+    RESTART_DELAY = 60  # seconds - doubled each time an adapter is reopened without frames arriving in between
+    MAX_RESTART_DELAY = 600  # seconds
+
+    def __init__(self, scanners: List[Scanner], stall_timeout: float = STALL_TIMEOUT):
+        self.scanners = scanners  # type: List[Scanner]
+        self.stall_timeout_ns = int(stall_timeout * 1e9)  # type: int
+        now_ns = time.monotonic_ns()
+        for scanner in scanners:
+            scanner.frames_at_check = scanner.frames_received
+            scanner.progress_ns = now_ns
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            await self.check()
+
+    async def check(self, now_ns: int or None = None):
+        """Restart the scan on any adapter that has stopped delivering frames, or that is due to be retried"""
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        for scanner in self.scanners:
+            if not scanner.running:
+                if now_ns >= scanner.restart_at_ns:
+                    await self.restart(scanner, now_ns)
+                continue
+
+            if scanner.frames_received != scanner.frames_at_check:
+                scanner.frames_at_check = scanner.frames_received
+                scanner.progress_ns = now_ns
+                scanner.rescanned = False
+                scanner.failures = 0
+                continue
+
+            silent_ns = now_ns - scanner.progress_ns
+            if silent_ns < self.stall_timeout_ns or now_ns < scanner.restart_at_ns:
+                continue
+            if not scanner.rescanned:
+                LOG.warning(f"No frames received on {scanner} for {silent_ns / 1e9:.0f} seconds - re-sending the scan "
+                            f"request")
+                metrics.scan_rescans.inc()
+                scanner.rescanned = True
+                scanner.progress_ns = now_ns
+                try:
+                    await scanner.rescan()
+                except OSError as e:
+                    LOG.warning(f"Unable to re-send the scan request on {scanner} - {e}")
+                    await self.restart(scanner, now_ns)
+                continue
+            LOG.warning(f"Still no frames received on {scanner} - reopening it")
+            await self.restart(scanner, now_ns)
+
+    async def restart(self, scanner: Scanner, now_ns: int):
+        """Close the scanner's socket (if it's open) and open it again, scheduling the next attempt if it stalls again
+        or can't be opened"""
+        metrics.scan_reopens.inc()
+        await scanner.stop()
+        scanner.failures += 1
+        # If the adapter still isn't delivering frames, try again after 1, 2, 4... minutes
+        delay = min(self.RESTART_DELAY * 2 ** (scanner.failures - 1), self.MAX_RESTART_DELAY)
+        scanner.restart_at_ns = now_ns + delay * 10 ** 9
+        scanner.rescanned = False
+        scanner.progress_ns = now_ns
+        try:
+            await scanner.start()
+        except OSError as e:
+            LOG.error(f"Unable to reopen {scanner} - {e}. Retrying in {delay} seconds")
+            return
+        LOG.info(f"Scanning for Tilts on {scanner}")
+
+
+def parse_devices(devices_env: str or None) -> List[int]:
+    """Parse a comma separated list of HCI device numbers (e.g. "0,1"), defaulting to device 0"""
+    if not devices_env:
+        return [0]
+    return [int(device) for device in devices_env.split(",") if device.strip()]
+
+
+async def start_scanners(devices: List[int], process: Callable[[bytes], object], kernel_filter: bool = False,
+                         include_failed: bool = False) -> List[Scanner]:
+    """Start scanning on every device, returning the scanners that started. Devices that can't be opened are logged and
+    skipped, so that one missing adapter doesn't stop the others from scanning. If include_failed is set, their
+    scanners are returned as well (not running), for a ScanWatchdog to retry."""
+    scanners = []
+    for device in devices:
+        scanner = Scanner(device, process, kernel_filter)
+        try:
+            await scanner.start()
+        except OSError as e:
+            LOG.error(f"Unable to create socket for {scanner} - {e}")
+            if include_failed:
+                scanners.append(scanner)
+            continue
+        LOG.info(f"Scanning for Tilts on {scanner}")
+        scanners.append(scanner)
+    return scanners
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Callable, Dict, Set, Tuple
+
+from dotenv import dotenv_values
+
+LOG = logging.getLogger("tilt")
+
+# Most of the configuration can be changed without restarting (and so without missing beacons, or losing the readings
+# being smoothed): edit the .env file, and it is picked up within POLL_INTERVAL seconds - or straight away on SIGHUP
+# (e.g. docker kill -s HUP tiltbridge-junior). Only the environment variables that changed are reapplied, by the
+# callback passed to ConfigReloader (see tiltbridge_junior.reload_config).
+
+POLL_INTERVAL = 5  # seconds
+
+
+class EnvFile:
+    """Applies the settings in a .env file to os.environ, the same as dotenv.load_dotenv() - settings that were already
+    in the environment (e.g. from docker's env_file) take precedence over the file. load() can be called again to pick
+    up changes to the file."""
+
+    def __init__(self, path: str):
+        self.path = path  # type: str
+        # The settings taken from the file when it was last loaded
+        self.applied = {}  # type: Dict[str, str]
+        # The file's (modification time, size, inode) when it was last loaded, or None if it didn't exist
+        self.stat = None  # type: Tuple[int, int, int] or None
+
+    def _stat(self) -> Tuple[int, int, int] or None:
+        if not self.path:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def inherit(self, applied: Dict[str, str]):
+        """Take over the settings another EnvFile (in the process that started this one) applied from the file. They
+        are already in this process's environment, so load() would otherwise take them to be set outside the file,
+        and never change them."""
+        self.applied = dict(applied)
+        self.stat = None
+
+    def modified(self) -> bool:
+        """Returns true if the file has changed (or been created or deleted) since it was last loaded"""
+        return self._stat() != self.stat
+
+    def load(self) -> Set[str]:
+        """(Re)read the file, returning the names of the environment variables that have changed as a result. A
+        setting removed from the file is removed from the environment, so it goes back to its default."""
+        self.stat = self._stat()
+        values = dotenv_values(self.path) if self.stat is not None else {}
+
+        applied = {}
+        changed = set()
+        for name, value in values.items():
+            if value is None or (name in os.environ and name not in self.applied):
+                continue  # A name with no value, or set outside the file
+            applied[name] = value
+            if os.environ.get(name) != value:
+                os.environ[name] = value
+                changed.add(name)
+        for name in self.applied.keys() - applied.keys():
+            os.environ.pop(name, None)
+            changed.add(name)
+        self.applied = applied
+        return changed
+
+
+class ConfigReloader:
+    """Reloads env_file on SIGHUP, or when it changes (checked every poll_interval seconds - 0 to only reload on
+    SIGHUP), and calls reload with the names of the environment variables that changed"""
+
+    def __init__(self, env_file: EnvFile, reload: Callable[[Set[str]], object], poll_interval: float = POLL_INTERVAL):
+        self.env_file = env_file  # type: EnvFile
+        self.reload = reload  # type: Callable[[Set[str]], object]
+        self.poll_interval = poll_interval  # type: float
+        # Set by SIGHUP. Created in run() so that it belongs to the running event loop.
+        self.requested = None  # type: asyncio.Event or None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.requested = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, self.requested.set)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.requested.wait(), self.poll_interval or None)
+                except asyncio.TimeoutError:
+                    if not self.env_file.modified():
+                        continue
+                self.requested.clear()
+                self.check()
+        finally:
+            loop.remove_signal_handler(signal.SIGHUP)
+
+    def check(self):
+        """Reload the file, and apply whatever has changed"""
+        try:
+            changed = self.env_file.load()
+        except OSError as e:
+            LOG.error(f"Unable to reload {self.env_file.path} - {e}")
+            return
+        if len(changed) <= 0:
+            LOG.info("Configuration reloaded - nothing has changed")
+            return
+        LOG.warning(f"Configuration reloaded - applying changes to {', '.join(sorted(changed))}")
+        try:
+            self.reload(changed)
+        except Exception as e:
+            # A bad value (e.g. a send frequency that isn't a number) mustn't stop the reloader, or anything else
+            LOG.error(f"Unable to apply the new configuration - {e}")
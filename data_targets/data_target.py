@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Collection, Tuple
+
+import metrics
+
+from .snapshot import Snapshot
+
+
+LOG = logging.getLogger("tilt")
+
+
+class DataTarget:
+    """Base class for all data targets. Each target is configured from environment variables in load_config(), and has
+    its own bounded queue and worker coroutine (run()) so that a slow target can never delay another target, or the BLE
+    event loop.
+
+    Subclasses need to implement load_config() and send(), and will typically override build_payload(). should_send()
+    can be extended for targets that need additional checks before sending (e.g. a valid URL)."""
+
+    name = "Data Target"  # type: str
+    # Default for how often we send data to this target. Targets can override this via their configuration.
+    SEND_FREQUENCY = datetime.timedelta(seconds=3)
+    # Number of snapshots that can be waiting to be sent. When the queue is full, the oldest snapshot is dropped.
+    QUEUE_SIZE = 1
+    # The environment variables load_config() reads all start with one of these. When the configuration is reloaded,
+    # the target is only reconfigured if one of them has changed - or on any change at all, if there are none.
+    ENV_PREFIXES = ()  # type: Tuple[str, ...]
+
+    def __init__(self):
+        self.enabled = False  # type: bool
+        # Scheduling is done in time.monotonic_ns() integers, so that sends aren't skipped or bunched up if the clock is
+        # stepped - send_frequency (a timedelta) is converted to send_frequency_ns when it is set
+        self.send_frequency_ns = 0  # type: int
+        self.send_frequency = self.SEND_FREQUENCY
+        self.data_last_sent = time.monotonic_ns()  # type: int
+
+        # The last snapshot queued for this target. If a target comes due and the snapshot hasn't changed, there is
+        # nothing new to send.
+        self.last_snapshot = None  # type: Snapshot or None
+
+        # Metrics for this target - created here so that recording a send doesn't need to look anything up
+        self.metric_sends = metrics.target_sends.labels(self.name)  # type: metrics.CounterChild
+        self.metric_send_failures = metrics.target_send_failures.labels(self.name)  # type: metrics.CounterChild
+        self.metric_send_seconds = metrics.target_send_seconds.labels(self.name)  # type: metrics.HistogramChild
+        self.metric_snapshots_dropped = metrics.target_snapshots_dropped.labels(self.name)  # type: metrics.CounterChild
+        self.metric_queue_depth = metrics.target_queue_depth.labels(self.name)  # type: metrics.GaugeChild
+
+        # Snapshots waiting to be sent by run(). This is created in run() so that it belongs to the running event loop.
+        self.queue = None  # type: asyncio.Queue or None
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def send_frequency(self) -> datetime.timedelta:
+        return datetime.timedelta(microseconds=self.send_frequency_ns // 1000)
+
+    @send_frequency.setter
+    def send_frequency(self, send_frequency: datetime.timedelta):
+        self.send_frequency_ns = send_frequency // datetime.timedelta(microseconds=1) * 1000
+
+    def load_config(self):
+        """Load the config for this target from environment variables (called as part of the main setup process)"""
+        raise NotImplementedError
+
+    @classmethod
+    def config_changed(cls, changed: Collection[str]) -> bool:
+        """Returns true if any of the changed environment variables is one this target's configuration is read from"""
+        if len(cls.ENV_PREFIXES) <= 0:
+            return len(changed) > 0
+        return any(name.startswith(cls.ENV_PREFIXES) for name in changed)
+
+    def should_send(self, now: int, force: bool = False) -> bool:
+        """Returns true if this target is due to be sent a new snapshot (or if force is set, if it can be sent one at
+        all). now is from time.monotonic_ns()."""
+        return self.enabled and (force or now - self.data_last_sent > self.send_frequency_ns)
+
+    def next_send_due(self) -> int:
+        """Returns the earliest time (in time.monotonic_ns()) this target could next be due to send"""
+        return self.data_last_sent + self.send_frequency_ns
+
+    def build_payload(self, snapshot: Snapshot):
+        """Build the payload that will be queued for send() from the shared snapshot. This runs on the event loop, so
+        it should be quick - by default, the snapshot itself is queued."""
+        return snapshot
+
+    def enqueue(self, payload) -> bool:
+        """Queue a payload for the worker. If the queue is full, the oldest payload is dropped to make room."""
+        if self.queue is None:
+            # The worker hasn't started yet
+            return False
+
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.metric_snapshots_dropped.inc()
+            LOG.info(f"{self.name} is falling behind - dropping stale snapshot")
+        self.queue.put_nowait(payload)
+        self.metric_queue_depth.set(self.queue.qsize())
+        return True
+
+    def process_snapshot(self, snapshot: Snapshot, now: int, force: bool = False):
+        """Check if this target is due to send, and if so queue the snapshot for the worker. This is called from the
+        event loop, so it must never block."""
+        if not self.should_send(now, force):
+            return
+
+        if snapshot is self.last_snapshot:
+            # Nothing has changed since we last sent - skip this send, and check again next interval
+            self.data_last_sent = now
+        elif self.enqueue(self.build_payload(snapshot)):
+            self.data_last_sent = now
+            self.last_snapshot = snapshot
+
+    async def send(self, payload):
+        """Send a queued payload to the target. Runs in the target's worker task."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release anything the target holds open (called on shutdown, once the worker task has been cancelled)"""
+        pass
+
+    def take_over(self, previous: 'DataTarget'):
+        """Called on a target that is replacing previous (with a new configuration) once previous has been shut down,
+        just before this target starts sending"""
+        pass
+
+    async def drain(self):
+        """Wait until everything queued for this target has been sent (or has failed to send)"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def run(self):
+        """Worker task - waits for snapshots queued by process_snapshot() and sends them to the target"""
+        self.queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+
+        while True:
+            payload = await self.queue.get()
+            self.metric_queue_depth.set(self.queue.qsize())
+            self.metric_sends.inc()
+            start = time.perf_counter()
+            try:
+                await self.send(payload)
+            except Exception as e:
+                self.metric_send_failures.inc()
+                LOG.error(f"Unhandled error sending to {self.name}: {e}")
+            finally:
+                self.metric_send_seconds.observe(time.perf_counter() - start)
+                self.queue.task_done()
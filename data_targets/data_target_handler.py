@@ -1,19 +1,272 @@
-from typing import Dict
+import asyncio
+import functools
+import logging
+import os
+import time
+from typing import Collection, Dict, List, Mapping, Tuple, Type
 
+import metrics
 from TiltHydrometer import TiltHydrometer
 
+from .data_target import DataTarget
 from .legacy_fermentrack_target import LegacyFermentrackTarget
+from .mqtt_target import MQTTTarget
+from .snapshot import Snapshot
 
-target_legacy_fermentrack = LegacyFermentrackTarget()
 
+LOG = logging.getLogger("tilt")
 
-def process_data(tilts: Dict[str, TiltHydrometer]):
-    # TODO - Make this asynchronous
-    global target_legacy_fermentrack
+# Registry of every available data target. Each target reads its own environment variables in load_config() to
+# determine if it is enabled (e.g. FERMENTRACK_LEGACY_TARGET_ENABLED). New targets are added via register_target().
+target_classes = [LegacyFermentrackTarget, MQTTTarget]  # type: List[Type[DataTarget]]
+
+# The targets that are enabled after load_config()
+targets = []  # type: List[DataTarget]
+
+# The last snapshot sent to the targets - reused as long as no hydrometer has new readings
+last_snapshot = None  # type: Snapshot or None
+
+# Scheduling uses time.monotonic_ns() - never the wall clock, which can be stepped (e.g. by NTP on a freshly booted Pi)
+NEVER = 2 ** 63  # type: int
+
+# The earliest time any enabled target is next due to send - the scheduler sleeps until then
+next_send_due = NEVER  # type: int
+
+# Set from the beacon path (via mark_dirty) when a hydrometer has new readings. If nothing is dirty when a target is
+# due, the last snapshot is reused (and targets that have already sent it skip the send).
+dirty = False  # type: bool
+
+# Set by mark_dirty when a reading changes significantly from what was last sent, to wake the scheduler and send
+# immediately. Created in run() so that it belongs to the running event loop.
+flush_requested = None  # type: asyncio.Event or None
+
+# Thresholds (in raw sensor units - Classic, Pro) for sending immediately instead of waiting for the next scheduled
+# send. None if immediate sends are disabled. See load_config().
+immediate_send_gravity_delta = None  # type: Tuple[int, int] or None
+immediate_send_temp_delta = None  # type: Tuple[int, int] or None
+
+# The scheduler never sleeps for less than this, so targets with very short send frequencies don't spin the event loop
+MIN_FLUSH_INTERVAL = 0.1  # seconds
+
+# Set (along with flush_requested) by reload_config, to wake the scheduler to work out when the new set of targets is
+# next due - without forcing a send
+reschedule_requested = False  # type: bool
+
+# The worker task of each target that is running
+workers = {}  # type: Dict[DataTarget, asyncio.Task]
+
+# When a target is replaced by reload_config, the new one only starts sending once the old one has finished (see
+# _hand_over). These are the hand overs still in progress, by target class.
+hand_overs = {}  # type: Dict[Type[DataTarget], asyncio.Task]
+
+# How long a replaced target has to finish sending what it was given before it is shut down regardless
+HAND_OVER_TIMEOUT = 30  # seconds
+
+
+def register_target(target_class: Type[DataTarget]) -> Type[DataTarget]:
+    """Add a data target class to the registry. Can be used as a class decorator."""
+    if target_class not in target_classes:
+        target_classes.append(target_class)
+    return target_class
+
+
+def mark_dirty(tilt: TiltHydrometer):
+    """Called from the BLE callback after a Tilt beacon has been processed. This only flags that there is new data - the
+    scheduler started by run() decides when to send it - so it needs to stay as cheap as possible."""
+    global dirty
+
+    dirty = True
+    if immediate_send_gravity_delta is not None and flush_requested is not None:
+        pro = int(tilt.tilt_pro)  # Index into the (Classic, Pro) deltas
+        if tilt.changed_since_flush(immediate_send_gravity_delta[pro], immediate_send_temp_delta[pro]):
+            flush_requested.set()
+
+
+def flush(tilts: Mapping[tuple, TiltHydrometer], force: bool = False):
+    """Queue a shared snapshot for every target that is due to send (or every target, if force is set). The snapshot is
+    only rebuilt if there have been new readings, and targets skip sending a snapshot they have already sent."""
+    global dirty, last_snapshot, next_send_due
+
+    now = time.monotonic_ns()
+    if dirty or last_snapshot is None:
+        dirty = False
+        start = time.perf_counter()
+        previous, last_snapshot = last_snapshot, Snapshot.build(tilts, last_snapshot)
+        metrics.snapshot_build_seconds.observe(time.perf_counter() - start)
+        if last_snapshot is not previous:
+            for tilt in tilts.values():
+                tilt.mark_flushed()
+
+    for target in targets:
+        target.process_snapshot(last_snapshot, now, force)
+    next_send_due = min((target.next_send_due() for target in targets), default=NEVER)
+
+
+async def run_scheduler(tilts: Mapping[tuple, TiltHydrometer]):
+    """Flush the targets as each one comes due, or immediately when flush_requested is set"""
+    global reschedule_requested
+
+    while True:
+        delay = max((next_send_due - time.monotonic_ns()) / 1e9, MIN_FLUSH_INTERVAL)
+        try:
+            await asyncio.wait_for(flush_requested.wait(), delay)
+            force = not reschedule_requested
+        except asyncio.TimeoutError:
+            force = False
+        flush_requested.clear()
+        reschedule_requested = False
+        flush(tilts, force)
+
+
+def _start_worker(target: DataTarget):
+    workers[target] = asyncio.create_task(target.run())
+
+
+async def run(tilts: Mapping[tuple, TiltHydrometer]):
+    """Start a worker task for each enabled target, along with the scheduler that decides when to send to them - started
+    by async_main and runs for the life of the event loop"""
+    global next_send_due, flush_requested
+
+    if len(targets) <= 0:
+        LOG.info("No data targets are enabled")
+
+    # The scheduler runs even if no targets are enabled, in case one is enabled by reload_config
+    flush_requested = asyncio.Event()
+    for target in targets:
+        _start_worker(target)
+    await asyncio.sleep(0)  # Let the workers create their queues before we start offering them snapshots
+    next_send_due = min((target.next_send_due() for target in targets), default=NEVER)
+
+    try:
+        await run_scheduler(tilts)
+    finally:
+        tasks = list(workers.values()) + list(hand_overs.values())
+        for task in tasks:
+            task.cancel()
+        workers.clear()
+        hand_overs.clear()
+        # Wait for them to finish cancelling, so that none are left pending when the event loop closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def close():
+    """Shut down every enabled target - called once run() has been cancelled"""
+    for target in targets:
+        target.close()
+
+
+def _delta_from_env(env_var: str, classic_scale: int, pro_scale: int) -> Tuple[int, int] or None:
+    """Read a gravity/temp delta from an environment variable and convert it to raw sensor units for (Classic, Pro)"""
+    delta_env = os.environ.get(env_var)
+    if not delta_env:
+        return None
+    delta = float(delta_env)
+    return max(round(delta * classic_scale), 1), max(round(delta * pro_scale), 1)
+
+
+def _load_immediate_send_config():
+    global immediate_send_gravity_delta, immediate_send_temp_delta
+
+    # Changes in gravity (in SG, e.g. 0.002) or temperature (in F) at least this large are sent immediately, rather
+    # than waiting for the next scheduled send. If only one is set, the other is effectively disabled.
+    immediate_send_gravity_delta = _delta_from_env("TILTBRIDGE_JR_IMMEDIATE_SEND_GRAVITY_DELTA", 1000, 10000)
+    immediate_send_temp_delta = _delta_from_env("TILTBRIDGE_JR_IMMEDIATE_SEND_TEMP_DELTA", 1, 10)
+    if immediate_send_gravity_delta is not None or immediate_send_temp_delta is not None:
+        immediate_send_gravity_delta = immediate_send_gravity_delta or (0x10000, 0x10000)
+        immediate_send_temp_delta = immediate_send_temp_delta or (0x10000, 0x10000)
 
-    target_legacy_fermentrack.process(tilts)
 
 def load_config():
-    global target_legacy_fermentrack
+    """Instantiate and configure every registered target, keeping the ones that are enabled"""
+    global targets
+
+    _load_immediate_send_config()
+    targets = []
+    for target_class in target_classes:
+        target = target_class()
+        target.load_config()
+        if target.enabled:
+            targets.append(target)
+
+
+def reload_config(changed: Collection[str]):
+    """Apply changed environment variables (by name) while running. Only targets whose configuration has changed are
+    touched - each is replaced by a newly configured instance, which takes over once the old one has finished sending
+    what it was given (see _hand_over). Every other target carries on as it was."""
+    global targets, reschedule_requested
+
+    _load_immediate_send_config()
+    running = {type(target): target for target in targets}
+    new_targets = []
+    replaced = []  # (target class, previous target or None, replacement or None)
+    for target_class in target_classes:
+        previous = running.get(target_class)
+        if not target_class.config_changed(changed):
+            if previous is not None:
+                new_targets.append(previous)
+            continue
+
+        replacement = target_class()
+        replacement.load_config()
+        if not replacement.enabled:
+            replacement = None
+        else:
+            if previous is not None:
+                # Carry on sending on the same schedule
+                replacement.data_last_sent = previous.data_last_sent
+            new_targets.append(replacement)
+        if previous is not None or replacement is not None:
+            replaced.append((target_class, previous, replacement))
+
+    # flush() only ever sees the old set of targets or the new one - the event loop can't run it part way through this
+    targets = new_targets
+    if flush_requested is None:
+        return  # Not running yet - run() starts the new targets
+
+    for target_class, previous, replacement in replaced:
+        if previous is None and target_class not in hand_overs:
+            _start_worker(replacement)
+            continue
+        hand_over = asyncio.create_task(_hand_over(previous, replacement, hand_overs.get(target_class)))
+        hand_overs[target_class] = hand_over
+        hand_over.add_done_callback(functools.partial(_hand_over_done, target_class))
+    reschedule_requested = True
+    flush_requested.set()
+
+
+def _hand_over_done(target_class: Type[DataTarget], task: asyncio.Task):
+    if hand_overs.get(target_class) is task:
+        del hand_overs[target_class]
+
+
+async def _hand_over(previous: DataTarget or None, replacement: DataTarget or None,
+                     after: asyncio.Task or None = None):
+    """Shut down a target that has been reconfigured once it has sent everything it was given (waiting for any earlier
+    hand over of the same kind of target first), then start its replacement. The two never send at the same time, so
+    nothing is lost or sent out of order."""
+    if after is not None:
+        await asyncio.wait([after])
+    if previous is not None:
+        try:
+            await asyncio.wait_for(previous.drain(), HAND_OVER_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOG.warning(f"{previous} was still sending {HAND_OVER_TIMEOUT} seconds after being reconfigured - "
+                        f"abandoning the send")
+        finally:
+            worker = workers.pop(previous, None)
+            if worker is not None:
+                worker.cancel()
+            # Closing can wait on a send still stuck in a thread (see LegacyFermentrackTarget.close), so it is done off
+            # the event loop - and the replacement is only held up for so long
+            closing = asyncio.get_running_loop().run_in_executor(None, previous.close)
+            try:
+                await asyncio.wait_for(closing, HAND_OVER_TIMEOUT)
+            except asyncio.TimeoutError:
+                LOG.warning(f"{previous} was still closing {HAND_OVER_TIMEOUT} seconds after being reconfigured - "
+                            f"starting its replacement anyway")
 
-    target_legacy_fermentrack.load_config()
+    # The replacement may itself have been replaced in the meantime, in which case the next hand over starts that one
+    if replacement is not None and replacement in targets:
+        if previous is not None:
+            replacement.take_over(previous)
+        _start_worker(replacement)
@@ -0,0 +1,69 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from .snapshot import Snapshot
+
+
+class DeltaEncoder:
+    """Encodes snapshots for Fermentrack as the changes since the last snapshot it acknowledged, to save bandwidth on
+    metered links.
+
+    A delta payload ({"tilts": [...], "tiltbridge_junior": true, "delta": true}) only lists the hydrometers with a field
+    that has changed, and for each of them only the changed fields, plus color and mac to identify the hydrometer. The
+    server merges these into the state from earlier payloads. Every resync_interval_ns (and after a send fails, in case
+    the server lost its state), a full payload is sent instead, the same as when delta encoding is off.
+
+    The encoder only moves on to a new base once the server has accepted the payload (see acknowledge()). Until then,
+    every delta is relative to the last payload the server is known to have."""
+
+    KEY_FIELDS = ('color', 'mac')
+
+    # (snapshot, whether the payload was a full resync, when it was encoded) - passed back to acknowledge()
+    Pending = Tuple[Snapshot, bool, int]
+
+    def __init__(self, resync_interval_ns: int):
+        self.resync_interval_ns = resync_interval_ns  # type: int
+        # The fields of each hydrometer as of the last acknowledged payload, keyed by (color, mac)
+        self.acknowledged = {}  # type: Dict[Tuple[str, str], dict]
+        # When the last full payload was acknowledged (time.monotonic_ns()), or None if the next payload must be full
+        self.last_resync_ns = None  # type: int or None
+
+    def encode(self, snapshot: Snapshot, now_ns: int, full_payload: bytes) -> Tuple[Optional[bytes], Pending]:
+        """Encode snapshot as a delta, or return full_payload if a resync is due. Returns None as the payload if no
+        hydrometer has changed since the last acknowledged payload (so there is nothing to send)."""
+        if self.last_resync_ns is None or now_ns - self.last_resync_ns >= self.resync_interval_ns:
+            return full_payload, (snapshot, True, now_ns)
+
+        changes = []  # type: List[bytes]
+        for tilt in snapshot.tilts:
+            previous = self.acknowledged.get((tilt['color'], tilt['mac']))
+            if previous is tilt:
+                # Hydrometers cache their dict until the next reading, so this is the dict we last sent
+                continue
+            if previous is None:
+                changed = tilt
+            else:
+                changed = {field: value for field, value in tilt.items()
+                           if field in self.KEY_FIELDS or previous.get(field) != value}
+                if len(changed) <= len(self.KEY_FIELDS):
+                    continue
+            changes.append(json.dumps(changed, separators=(',', ':')).encode())
+
+        if len(changes) <= 0:
+            return None, (snapshot, False, now_ns)
+        return b'{"tilts":[' + b','.join(changes) + b'],"tiltbridge_junior":true,"delta":true}', \
+            (snapshot, False, now_ns)
+
+    def acknowledge(self, pending: Pending):
+        """The server accepted the payload from encode() - later deltas are relative to it"""
+        snapshot, full, now_ns = pending
+        if full:
+            # A full payload replaces the server's state, so hydrometers that have gone are forgotten here too
+            self.acknowledged = {}
+            self.last_resync_ns = now_ns
+        for tilt in snapshot.tilts:
+            self.acknowledged[(tilt['color'], tilt['mac'])] = tilt
+
+    def reset(self):
+        """Send a full payload next time"""
+        self.last_resync_ns = None
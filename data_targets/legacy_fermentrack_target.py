@@ -1,25 +1,61 @@
+import asyncio
 import datetime
+import gzip
 import logging
 import os
-from typing import Dict
-
-import sentry_sdk
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Mapping
 
 from TiltHydrometer import TiltHydrometer
-import requests
+
+from .data_target import DataTarget
+from .delta_encoder import DeltaEncoder
+from .outbox import Outbox, OutboxEntry, outbox_from_env
+from .snapshot import Snapshot
 
 
 LOG = logging.getLogger("tilt")
 
+# requests takes a while to import on slower devices, so it's imported by the worker thread before the first send
+requests = None
 
-class LegacyFermentrackTarget:
 
+class LegacyFermentrackTarget(DataTarget):
+
+    name = "Legacy Fermentrack Target"
     FERMENTRACK_SEND_FREQUENCY = datetime.timedelta(seconds=3)
+    SEND_FREQUENCY = FERMENTRACK_SEND_FREQUENCY
+    SEND_TIMEOUT = 5  # seconds
+    HEADERS = {'Content-Type': 'application/json'}
+    GZIP_HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    GZIP_MIN_SIZE = 256  # bytes - smaller bodies aren't worth compressing
+    GZIP_LEVEL = 6
+    BACKFILL_BATCH_SIZE = 100  # readings per backfill request
+    RESYNC_INTERVAL = datetime.timedelta(minutes=5)  # How often a full payload is sent when delta encoding
+    ENV_PREFIXES = ("FERMENTRACK_LEGACY_TARGET_", "TILTBRIDGE_JR_OUTBOX_")
 
     def __init__(self):
-        self.enabled = False  # type: bool
+        super().__init__()
         self.target_url = None  # type: str or None
-        self.data_last_sent = datetime.datetime.now()  # type: datetime.datetime
+
+        # If set, readings that couldn't be sent are kept in the outbox, and backfilled to this URL in batches once
+        # Fermentrack is reachable again. The legacy endpoint has no way to timestamp a reading, so backfilled readings
+        # go to a separate bulk endpoint.
+        self.backfill_url = None  # type: str or None
+        self.outbox = None  # type: Outbox or None
+
+        # requests is blocking, so sends happen on a single worker thread which reuses one Session (keep-alive)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fermentrack")
+        self.session = None  # type: requests.Session or None
+
+        # Whether to gzip request bodies - True or False, or None to gzip once Fermentrack advertises that it accepts
+        # gzip (with an Accept-Encoding header in a response, per RFC 7694)
+        self.gzip = None  # type: bool or None
+        self.server_accepts_gzip = False  # type: bool
+
+        # If set, only changes since the last payload Fermentrack accepted are sent (see DeltaEncoder)
+        self.delta = None  # type: DeltaEncoder or None
 
     def load_config(self):
         """Load the config file (called as part of the main setup process)"""
@@ -27,6 +63,28 @@ class LegacyFermentrackTarget:
         self.enabled = enabled_env.lower() == 'true' if enabled_env else False
         self.target_url = os.environ.get("FERMENTRACK_LEGACY_TARGET_URL", None)
 
+        send_frequency_env = os.environ.get("FERMENTRACK_LEGACY_TARGET_SEND_FREQUENCY", None)
+        self.send_frequency = datetime.timedelta(seconds=float(send_frequency_env)) if send_frequency_env \
+            else self.FERMENTRACK_SEND_FREQUENCY
+
+        gzip_env = (os.environ.get("FERMENTRACK_LEGACY_TARGET_GZIP", None) or 'auto').lower()
+        self.gzip = None if gzip_env == 'auto' else gzip_env == 'true'
+
+        delta_env = os.environ.get("FERMENTRACK_LEGACY_TARGET_DELTA", None)
+        if delta_env is not None and delta_env.lower() == 'true':
+            resync_interval_env = os.environ.get("FERMENTRACK_LEGACY_TARGET_RESYNC_INTERVAL", None)
+            resync_interval = datetime.timedelta(seconds=float(resync_interval_env)) if resync_interval_env \
+                else self.RESYNC_INTERVAL
+            self.delta = DeltaEncoder(resync_interval // datetime.timedelta(microseconds=1) * 1000)
+        else:
+            self.delta = None
+
+        self.backfill_url = os.environ.get("FERMENTRACK_LEGACY_TARGET_BACKFILL_URL", None) or None
+        if self.enabled and self.backfill_url is not None and self.outbox is None:
+            self.outbox = outbox_from_env(self.name)
+            if len(self.outbox) > 0:
+                LOG.info(f"{len(self.outbox)} unsent reading(s) will be backfilled to {self.backfill_url}")
+
         if not self.enabled:
             LOG.info("Logging to Legacy Fermentrack Target is disabled")
         else:
@@ -35,41 +93,119 @@ class LegacyFermentrackTarget:
             else:
                 LOG.info(f"Logging to Legacy Fermentrack Target is enabled, with target URL {self.target_url}")
 
+    def should_send(self, now: int, force: bool = False) -> bool:
+        """Data will be sent as a JSON object (see encode_payload) to a Fermentrack HTTP endpoint every send_frequency
+        (FERMENTRACK_SEND_FREQUENCY by default)"""
+        if self.target_url is None or len(self.target_url) <= 11:
+            return False
+        return super().should_send(now, force)
+
     @staticmethod
-    def convert_tilts_to_list(tilts: Dict[str, TiltHydrometer]) -> list[dict]:
-            """Loop through a list of TiltHydrometer objects and convert them to something serializable"""
-            tilt_list = []
-            for color, tilt in tilts.items():
-                if not tilt.expired():
-                    tilt_list.append(tilt.to_dict())
-            return tilt_list
-
-    def process(self, tilts: Dict[str, TiltHydrometer]):
-        """This function is called by the main loop every time a new Tilt message is received to determine if we need
-        to send a new message to Fermentrack - and if we do, to send that message. Data will be sent as a JSON object
-        representing the dict returned by convert_tilts_to_dict(tilts) to a Fermentrack HTTP endpoint using requests
-        every FERMENTRACK_SEND_FREQUENCY (timedelta)."""
-        if not self.enabled:
-            return
+    def encode_payload(snapshot: Snapshot) -> bytes:
+        """Encode the JSON body Fermentrack expects ({"tilts": [...], "tiltbridge_junior": true}) from the snapshot's
+        pre-encoded Tilt list"""
+        return b'{"tilts": ' + snapshot.tilts_json + b', "tiltbridge_junior": true}'
 
-        if self.target_url is None or len(self.target_url) <= 11:
-            return
-        elif datetime.datetime.now() - self.data_last_sent > self.FERMENTRACK_SEND_FREQUENCY:
-            target_dict = {
-                'tilts': self.convert_tilts_to_list(tilts),
-                'tiltbridge_junior': True,
-            }
-
-            try:
-                r=requests.post(self.target_url, json=target_dict, timeout=5)
-            except Exception as e:
-                LOG.error(e)
-                # sentry_sdk.capture_exception(e)
-                self.data_last_sent = datetime.datetime.now()  # Prevent hammering the endpoint
+    @staticmethod
+    def encode_backfill_entry(snapshot: Snapshot) -> bytes:
+        """Encode a snapshot for the outbox - the same Tilt list as encode_payload, plus the time it was taken"""
+        return b'{"timestamp": "' + snapshot.created.isoformat().encode() + b'", "tilts": ' + snapshot.tilts_json + b'}'
+
+    @staticmethod
+    def encode_backfill(entries: List[OutboxEntry]) -> bytes:
+        """Encode the JSON body for a bulk backfill ({"snapshots": [...], "tiltbridge_junior": true})"""
+        return b'{"snapshots": [' + b', '.join(payload for _, _, payload in entries) + b'], "tiltbridge_junior": true}'
+
+    async def send(self, snapshot: Snapshot):
+        """Send a snapshot to Fermentrack. requests blocks, so the POST itself happens on the worker thread"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._send, snapshot)
+
+    def _send(self, snapshot: Snapshot):
+        payload = self.encode_payload(snapshot)
+        pending = None
+        if self.delta is not None:
+            payload, pending = self.delta.encode(snapshot, time.monotonic_ns(), payload)
+            if payload is None:
+                LOG.debug("Nothing has changed since the last send to Fermentrack")
+                return
+
+        if self._post(self.target_url, payload):
+            LOG.info("Sent {} Tilt(s) to Fermentrack".format(len(snapshot)))
+            if pending is not None:
+                self.delta.acknowledge(pending)
+            if self.outbox is not None and len(self.outbox) > 0:
+                self._backfill()
+        else:
+            self.metric_send_failures.inc()
+            if self.delta is not None:
+                # Fermentrack may have lost track of our earlier payloads (e.g. if it was restarted)
+                self.delta.reset()
+            if self.outbox is not None:
+                self.outbox.append(self.encode_backfill_entry(snapshot), snapshot.created.timestamp())
+
+    def _backfill(self):
+        """Send everything in the outbox to the backfill URL, BACKFILL_BATCH_SIZE readings per request. If a request
+        fails, the rest are left for the next successful send."""
+        while True:
+            entries = self.outbox.peek(self.BACKFILL_BATCH_SIZE)
+            if len(entries) <= 0 or not self._post(self.backfill_url, self.encode_backfill(entries)):
                 return
+            self.outbox.remove(entries)
+            LOG.info(f"Backfilled {len(entries)} reading(s) to Fermentrack")
+
+    def _post(self, url: str, data: bytes) -> bool:
+        """POST data to Fermentrack (gzipped, if enabled), returning True if it was accepted"""
+        global requests
+        if self.session is None:
+            if requests is None:
+                import requests
+            self.session = requests.Session()
+            # Neither header changes anything over HTTP/1.1, so leave them out to save bandwidth
+            del self.session.headers['Accept'], self.session.headers['Connection']
 
-            if r.status_code != 200:
-                LOG.error(f"Error sending data to Fermentrack: {r.text}")
+        compress = (self.server_accepts_gzip if self.gzip is None else self.gzip) and len(data) >= self.GZIP_MIN_SIZE
+        try:
+            if compress:
+                r = self.session.post(url, data=gzip.compress(data, self.GZIP_LEVEL, mtime=0),
+                                      headers=self.GZIP_HEADERS, timeout=self.SEND_TIMEOUT)
             else:
-                LOG.info("Sent {} Tilt(s) to Fermentrack".format(len(target_dict['tilts'])))
-            self.data_last_sent = datetime.datetime.now()
+                r = self.session.post(url, data=data, headers=self.HEADERS, timeout=self.SEND_TIMEOUT)
+        except Exception as e:
+            LOG.error(e)
+            # sentry_sdk.capture_exception(e)
+            return False
+
+        if self.gzip is None and not self.server_accepts_gzip:
+            self.server_accepts_gzip = self.accepts_gzip(r.headers.get('Accept-Encoding'))
+        if compress and r.status_code == 415:
+            LOG.warning("Fermentrack doesn't accept gzipped requests - sending them uncompressed")
+            self.gzip = False
+            return self._post(url, data)
+
+        if r.status_code != 200:
+            LOG.error(f"Error sending data to Fermentrack: {r.text}")
+            return False
+        return True
+
+    @staticmethod
+    def accepts_gzip(accept_encoding: str or None) -> bool:
+        """Returns true if an Accept-Encoding header value lists gzip (without ruling it out with q=0)"""
+        if not accept_encoding:
+            return False
+        for coding in accept_encoding.split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() == 'gzip':
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
+
+    def take_over(self, previous: DataTarget):
+        # The outbox was opened (and its readings counted) before previous wrote out the last of its unsent readings
+        if self.outbox is not None:
+            self.outbox.commit()
+
+    def close(self):
+        """Write any readings waiting in the outbox to disk, once the worker thread is done with it"""
+        if self.outbox is not None:
+            self.executor.submit(self.outbox.close)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import struct
+from typing import Dict, List, Tuple
+
+LOG = logging.getLogger("tilt")
+
+# A minimal asyncio MQTT 3.1.1 client - just enough to publish (QoS 0 or 1) over one long-lived connection. We only ever
+# publish, so there is no support for subscriptions, and QoS 2 isn't needed.
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 0x10, 0x20, 0x30, 0x40
+PINGREQ, PINGRESP, DISCONNECT = 0xc0, 0xd0, 0xe0
+
+CONNACK_ERRORS = {1: "unacceptable protocol version", 2: "identifier rejected", 3: "server unavailable",
+                  4: "bad user name or password", 5: "not authorized"}
+
+
+class MQTTError(Exception):
+    pass
+
+
+def encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length <= 0:
+            return bytes(encoded)
+
+
+def encode_string(value: str or bytes) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack('!H', len(value)) + value
+
+
+def packet(packet_type: int, body: bytes = b'') -> bytes:
+    return bytes([packet_type]) + encode_remaining_length(len(body)) + body
+
+
+def connect_packet(client_id: str, keepalive: int, username: str or None = None,
+                   password: str or None = None) -> bytes:
+    flags = 0x02  # Clean session
+    payload = encode_string(client_id)
+    if username is not None:
+        flags |= 0x80
+        payload += encode_string(username)
+        if password is not None:
+            flags |= 0x40
+            payload += encode_string(password)
+    return packet(CONNECT, encode_string("MQTT") + bytes([4, flags]) + struct.pack('!H', keepalive) + payload)
+
+
+def publish_packet(topic: str, payload: bytes, qos: int = 0, retain: bool = False, packet_id: int = 0) -> bytes:
+    body = encode_string(topic)
+    if qos > 0:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH | (qos << 1) | int(retain), body + payload)
+
+
+async def read_packet(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    """Read one MQTT packet, returning (first byte, body)"""
+    header = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if byte & 0x80 == 0:
+            break
+        multiplier *= 128
+    return header, await reader.readexactly(length)
+
+
+class MQTTClient:
+    """Publishes messages to an MQTT broker over a single connection.
+
+    publish_batch() writes every message in one go and then waits for the socket buffer to drain - and for QoS 1, for
+    the broker to acknowledge every message - so a slow broker slows down the caller rather than messages piling up
+    in memory."""
+
+    CONNECT_TIMEOUT = 10  # seconds
+    ACK_TIMEOUT = 10  # seconds
+
+    def __init__(self, host: str, port: int = 1883, client_id: str = "tiltbridge_junior", keepalive: int = 60,
+                 username: str or None = None, password: str or None = None):
+        self.host = host  # type: str
+        self.port = port  # type: int
+        self.client_id = client_id  # type: str
+        self.keepalive = keepalive  # type: int
+        self.username = username  # type: str or None
+        self.password = password  # type: str or None
+
+        self.reader = None  # type: asyncio.StreamReader or None
+        self.writer = None  # type: asyncio.StreamWriter or None
+        self.reader_task = None  # type: asyncio.Task or None
+        self.ping_task = None  # type: asyncio.Task or None
+        self.next_packet_id = 1  # type: int
+        # QoS 1 publishes waiting for a PUBACK, by packet ID
+        self.pending_acks = {}  # type: Dict[int, asyncio.Future]
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        """Connect to the broker. Raises MQTTError (or OSError) if it can't be reached, or doesn't accept the
+        connection - leaving the client closed."""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.CONNECT_TIMEOUT)
+            self.writer.write(connect_packet(self.client_id, self.keepalive, self.username, self.password))
+            await self.writer.drain()
+            header, body = await asyncio.wait_for(read_packet(self.reader), self.ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Not an OSError before Python 3.11
+            self.close()
+            raise MQTTError("Timed out connecting to the broker")
+        except asyncio.IncompleteReadError:
+            self.close()
+            raise MQTTError("Broker closed the connection")
+        except OSError:
+            self.close()
+            raise
+
+        if header & 0xf0 != CONNACK or len(body) < 2:
+            self.close()
+            raise MQTTError("Broker didn't acknowledge the connection")
+        if body[1] != 0:
+            self.close()
+            raise MQTTError(f"Connection refused - {CONNACK_ERRORS.get(body[1], body[1])}")
+
+        self.reader_task = asyncio.create_task(self._read_loop())
+        self.ping_task = asyncio.create_task(self._ping_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header, body = await read_packet(self.reader)
+                if header & 0xf0 == PUBACK and len(body) >= 2:
+                    future = self.pending_acks.pop(struct.unpack('!H', body[:2])[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            LOG.warning(f"Lost connection to MQTT broker {self.host}:{self.port}")
+            self._fail_pending(MQTTError(f"Connection lost - {e}"))
+            # There's no one to say DISCONNECT to, and this task is finishing anyway - but the pings need to stop
+            self.writer.close()
+            self.reader_task = None
+            self.close()
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self.writer.write(packet(PINGREQ))
+
+    def _fail_pending(self, exc: Exception):
+        for future in self.pending_acks.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending_acks = {}
+
+    def _packet_id(self) -> int:
+        packet_id = self.next_packet_id
+        self.next_packet_id = packet_id % 0xffff + 1
+        return packet_id
+
+    async def publish_batch(self, messages: List[Tuple[str, bytes, bool]], qos: int = 0):
+        """Publish a batch of (topic, payload, retain) messages. Raises MQTTError (or OSError) if they couldn't be
+        delivered."""
+        if not self.connected:
+            raise MQTTError("Not connected")
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        data = []
+        for topic, payload, retain in messages:
+            packet_id = 0
+            if qos > 0:
+                packet_id = self._packet_id()
+                future = self.pending_acks[packet_id] = loop.create_future()
+                futures.append(future)
+            data.append(publish_packet(topic, payload, qos, retain, packet_id))
+
+        self.writer.write(b''.join(data))
+        await self.writer.drain()
+        if len(futures) > 0:
+            try:
+                await asyncio.wait_for(asyncio.gather(*futures), self.ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise MQTTError("Timed out waiting for the broker to acknowledge messages")
+
+    def close(self):
+        for task in (self.reader_task, self.ping_task):
+            if task is not None:
+                task.cancel()
+        self.reader_task, self.ping_task = None, None
+        self._fail_pending(MQTTError("Connection closed"))
+
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(packet(DISCONNECT))
+            self.writer.close()
+        self.reader, self.writer = None, None
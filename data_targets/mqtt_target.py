@@ -0,0 +1,186 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Set, Tuple
+
+from .data_target import DataTarget
+from .mqtt_client import MQTTClient, MQTTError
+from .snapshot import Snapshot
+
+
+LOG = logging.getLogger("tilt")
+
+
+class MQTTTarget(DataTarget):
+    """Publishes each hydrometer's smoothed readings to an MQTT broker, over a single long-lived connection.
+
+    Each hydrometer's state is published (retained) to <topic prefix>/<color>_<mac>/state, only when it has changed
+    since it was last published. Every change in a snapshot is published as one batch. If Home Assistant discovery is
+    enabled, the (retained) discovery config for each hydrometer is published the first time it is seen."""
+
+    name = "MQTT Target"
+    MQTT_SEND_FREQUENCY = datetime.timedelta(seconds=10)
+    SEND_FREQUENCY = MQTT_SEND_FREQUENCY
+    RECONNECT_INTERVAL = 30  # seconds
+    ENV_PREFIXES = ("MQTT_TARGET_",)
+
+    # (key in the state payload, name, unit, Home Assistant device class)
+    SENSORS = (
+        ('gravity', 'Gravity', 'SG', None),
+        ('temperature', 'Temperature', None, 'temperature'),
+        ('weeks_on_battery', 'Battery Age', 'weeks', None),
+        ('rssi', 'Signal Strength', 'dBm', 'signal_strength'),
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.host = None  # type: str or None
+        self.port = 1883  # type: int
+        self.username = None  # type: str or None
+        self.password = None  # type: str or None
+        self.topic_prefix = "tiltbridge_junior"  # type: str
+        self.discovery_prefix = "homeassistant"  # type: str or None
+        self.qos = 0  # type: int
+
+        self.client = None  # type: MQTTClient or None
+        # When we last tried to connect (from time.monotonic_ns()), so that reconnection attempts are rate limited
+        self.last_connect_attempt = None  # type: int or None
+        # The last state payload published for each hydrometer, and the hydrometers we've published discovery for
+        self.published_state = {}  # type: Dict[str, bytes]
+        self.discovered = set()  # type: Set[str]
+
+    def load_config(self):
+        """Load the config file (called as part of the main setup process)"""
+        enabled_env = os.environ.get("MQTT_TARGET_ENABLED", None)
+        self.enabled = enabled_env.lower() == 'true' if enabled_env else False
+        self.host = os.environ.get("MQTT_TARGET_HOST", None) or None
+        port_env = os.environ.get("MQTT_TARGET_PORT", None)
+        self.port = int(port_env) if port_env else 1883
+        self.username = os.environ.get("MQTT_TARGET_USERNAME", None) or None
+        self.password = os.environ.get("MQTT_TARGET_PASSWORD", None) or None
+        self.topic_prefix = os.environ.get("MQTT_TARGET_TOPIC_PREFIX", None) or "tiltbridge_junior"
+        # Set to an empty string to disable Home Assistant discovery
+        self.discovery_prefix = os.environ.get("MQTT_TARGET_DISCOVERY_PREFIX", "homeassistant") or None
+        qos_env = os.environ.get("MQTT_TARGET_QOS", None)
+        self.qos = min(int(qos_env), 1) if qos_env else 0
+
+        send_frequency_env = os.environ.get("MQTT_TARGET_SEND_FREQUENCY", None)
+        self.send_frequency = datetime.timedelta(seconds=float(send_frequency_env)) if send_frequency_env \
+            else self.MQTT_SEND_FREQUENCY
+
+        if not self.enabled:
+            LOG.info("Logging to MQTT Target is disabled")
+        elif self.host is None:
+            LOG.error("Logging to MQTT Target is enabled, but no broker host is set")
+        else:
+            LOG.info(f"Logging to MQTT Target is enabled, with broker {self.host}:{self.port}")
+
+    def should_send(self, now: int, force: bool = False) -> bool:
+        if self.host is None:
+            return False
+        return super().should_send(now, force)
+
+    @staticmethod
+    def device_id(tilt: dict) -> str:
+        mac = tilt['mac'].replace(':', '') if tilt['mac'] else 'unknown'
+        return f"{tilt['color'].lower()}_{mac}"
+
+    def state_topic(self, device_id: str) -> str:
+        return f"{self.topic_prefix}/{device_id}/state"
+
+    @staticmethod
+    def state_payload(tilt: dict) -> bytes:
+        return json.dumps({
+            'gravity': float(tilt['smoothed_gravity']),
+            'temperature': float(tilt['smoothed_temp']),
+            'temp_format': tilt['temp_format'],
+            'weeks_on_battery': tilt['weeks_on_battery'],
+            'rssi': tilt['rssi'],
+        }).encode()
+
+    def discovery_messages(self, device_id: str, tilt: dict) -> List[Tuple[str, bytes, bool]]:
+        """The Home Assistant MQTT discovery config for each of a hydrometer's sensors"""
+        device = {
+            'identifiers': [f"tiltbridge_junior_{device_id}"],
+            'name': f"{tilt['color']} Tilt",
+            'manufacturer': "Tilt",
+            'model': "Tilt Pro" if tilt['tilt_pro'] else "Tilt",
+        }
+        messages = []
+        for key, name, unit, device_class in self.SENSORS:
+            unique_id = f"tiltbridge_junior_{device_id}_{key}"
+            config = {
+                'name': name,
+                'unique_id': unique_id,
+                'state_topic': self.state_topic(device_id),
+                'value_template': f"{{{{ value_json.{key} }}}}",
+                'state_class': 'measurement',
+                'device': device,
+            }
+            if key == 'temperature':
+                unit = "°C" if tilt['temp_format'] == 'C' else "°F"
+            if unit is not None:
+                config['unit_of_measurement'] = unit
+            if device_class is not None:
+                config['device_class'] = device_class
+            messages.append((f"{self.discovery_prefix}/sensor/{unique_id}/config", json.dumps(config).encode(), True))
+        return messages
+
+    async def _ensure_connected(self) -> bool:
+        if self.client is not None and self.client.connected:
+            return True
+        now = time.monotonic_ns()
+        if self.last_connect_attempt is not None and now - self.last_connect_attempt < self.RECONNECT_INTERVAL * 1e9:
+            return False
+        self.last_connect_attempt = now
+
+        if self.client is not None:
+            self.client.close()
+        self.client = MQTTClient(self.host, self.port, username=self.username, password=self.password)
+        try:
+            await self.client.connect()
+        except (OSError, MQTTError, asyncio.TimeoutError) as e:
+            LOG.error(f"Unable to connect to MQTT broker {self.host}:{self.port} - {e}")
+            self.client.close()
+            return False
+        LOG.info(f"Connected to MQTT broker {self.host}:{self.port}")
+        return True
+
+    async def send(self, snapshot: Snapshot):
+        """Publish every hydrometer that has changed since it was last published as a single batch"""
+        messages = []
+        state = {}
+        discovered = []
+        for tilt in snapshot.tilts:
+            device_id = self.device_id(tilt)
+            if self.discovery_prefix is not None and device_id not in self.discovered:
+                messages.extend(self.discovery_messages(device_id, tilt))
+                discovered.append(device_id)
+            payload = self.state_payload(tilt)
+            if self.published_state.get(device_id) != payload:
+                messages.append((self.state_topic(device_id), payload, True))
+                state[device_id] = payload
+        if len(messages) <= 0:
+            return
+
+        if not await self._ensure_connected():
+            self.metric_send_failures.inc()
+            return
+        try:
+            await self.client.publish_batch(messages, self.qos)
+        except (OSError, MQTTError) as e:
+            LOG.error(f"Error publishing to MQTT broker {self.host}:{self.port} - {e}")
+            self.metric_send_failures.inc()
+            self.client.close()
+            return
+
+        self.published_state.update(state)
+        self.discovered.update(discovered)
+        LOG.info(f"Published {len(messages)} message(s) to MQTT")
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
@@ -0,0 +1,112 @@
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+
+LOG = logging.getLogger("tilt")
+
+# (id, created (seconds since the epoch), payload)
+OutboxEntry = Tuple[int, float, bytes]
+
+
+class Outbox:
+    """A bounded, disk-backed queue of payloads that a data target couldn't send, so they can be backfilled once the
+    target is reachable again. Payloads are stored in an SQLite database in WAL mode (append-only in the common case).
+
+    Appends are buffered in memory and committed in a single transaction every COMMIT_INTERVAL seconds (or once
+    COMMIT_SIZE payloads are waiting), so an outage doesn't mean one fsync per reading on a Raspberry Pi's SD card.
+    The oldest payloads are evicted once there are more than max_entries of them, or once they are older than max_age.
+
+    An Outbox isn't thread-safe - every call must come from the same thread (for data targets, the target's worker
+    thread)."""
+
+    COMMIT_INTERVAL = 60  # seconds
+    COMMIT_SIZE = 100  # payloads
+
+    def __init__(self, path: str, name: str, max_entries: int = 100000,
+                 max_age: datetime.timedelta = datetime.timedelta(days=7)):
+        self.path = path  # type: str
+        # Several targets can share one database - each only sees its own payloads
+        self.name = name  # type: str
+        self.max_entries = max_entries  # type: int
+        self.max_age = max_age  # type: datetime.timedelta
+
+        # Appends that haven't been committed to the database yet, as (created, payload)
+        self.pending = []  # type: List[Tuple[float, bytes]]
+        self.last_commit = time.monotonic()  # type: float
+
+        # check_same_thread is disabled as the outbox is created on the main thread, but used from the worker thread
+        self.db = sqlite3.connect(path, check_same_thread=False)  # type: sqlite3.Connection
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, NORMAL only syncs at checkpoints - a power cut may lose the last few commits, but never corrupts
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "target TEXT NOT NULL, created REAL NOT NULL, payload BLOB NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_target ON outbox (target, id)")
+        self.db.commit()
+        self.stored = self._count()  # type: int
+
+    def __len__(self):
+        return self.stored + len(self.pending)
+
+    def _count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE target = ?", (self.name,)).fetchone()[0]
+
+    def append(self, payload: bytes, created: Optional[float] = None):
+        """Queue a payload for backfill. It is written to disk with the next batch."""
+        self.pending.append((time.time() if created is None else created, payload))
+        if len(self.pending) >= self.COMMIT_SIZE or time.monotonic() - self.last_commit >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Write any pending payloads to disk in one transaction, and evict the oldest payloads if over the limits"""
+        self.last_commit = time.monotonic()
+        expected = len(self)
+        with self.db:
+            if len(self.pending) > 0:
+                self.db.executemany("INSERT INTO outbox (target, created, payload) VALUES (?, ?, ?)",
+                                    [(self.name, created, payload) for created, payload in self.pending])
+                self.pending = []
+
+            self.db.execute("DELETE FROM outbox WHERE target = ? AND created < ?",
+                            (self.name, time.time() - self.max_age.total_seconds()))
+            self.db.execute("DELETE FROM outbox WHERE target = ? AND id NOT IN "
+                            "(SELECT id FROM outbox WHERE target = ? ORDER BY id DESC LIMIT ?)",
+                            (self.name, self.name, self.max_entries))
+        self.stored = self._count()
+        if self.stored < expected:
+            LOG.warning(f"Discarded {expected - self.stored} unsent reading(s) from the {self.name} outbox (either the "
+                        f"outbox is full, or the readings are too old)")
+
+    def peek(self, limit: int) -> List[OutboxEntry]:
+        """Return up to limit of the oldest payloads, without removing them"""
+        if len(self.pending) > 0:
+            self.commit()
+        return self.db.execute("SELECT id, created, payload FROM outbox WHERE target = ? ORDER BY id LIMIT ?",
+                               (self.name, limit)).fetchall()
+
+    def remove(self, entries: List[OutboxEntry]):
+        """Remove payloads (returned by peek) once they have been sent"""
+        if len(entries) <= 0:
+            return
+        with self.db:
+            self.db.execute("DELETE FROM outbox WHERE target = ? AND id <= ?", (self.name, entries[-1][0]))
+        self.stored = self._count()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def outbox_from_env(name: str) -> Outbox:
+    """Create (or reopen) the outbox for a data target, using the TILTBRIDGE_JR_OUTBOX_* environment variables"""
+    path = os.environ.get("TILTBRIDGE_JR_OUTBOX_FILE") or "log/outbox.sqlite3"
+    max_entries_env = os.environ.get("TILTBRIDGE_JR_OUTBOX_MAX_ENTRIES")
+    max_age_env = os.environ.get("TILTBRIDGE_JR_OUTBOX_MAX_AGE_DAYS")
+
+    max_entries = int(max_entries_env) if max_entries_env else 100000
+    max_age = datetime.timedelta(days=float(max_age_env) if max_age_env else 7)
+    return Outbox(path, name, max_entries=max_entries, max_age=max_age)
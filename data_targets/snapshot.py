@@ -0,0 +1,40 @@
+import datetime
+import time
+from typing import List, Mapping, Tuple
+
+from TiltHydrometer import TiltHydrometer
+
+
+class Snapshot:
+    """A point-in-time serialization of every active (non-expired) hydrometer. One snapshot is built per send interval
+    and shared by every target that is due to send, so the serialization cost is paid once rather than once per target.
+
+    The dicts in tilts (and the encoded JSON) are shared between targets, and must not be modified."""
+
+    __slots__ = ('tilts', 'tilts_json', 'created', 'key')
+
+    def __init__(self, tilts: List[dict], tilts_json: bytes, key: Tuple = ()):
+        self.tilts = tilts  # type: List[dict]
+        # tilts, pre-encoded as a JSON list
+        self.tilts_json = tilts_json  # type: bytes
+        # Wall-clock time, as this is only used in serialized output (e.g. backfilled readings)
+        self.created = datetime.datetime.now()  # type: datetime.datetime
+        # Identifies the hydrometers and readings this snapshot was built from - see build()
+        self.key = key  # type: Tuple
+
+    def __len__(self):
+        return len(self.tilts)
+
+    @classmethod
+    def build(cls, tilts: Mapping[tuple, TiltHydrometer], previous: 'Snapshot' or None = None) -> 'Snapshot':
+        """Build a snapshot of the active hydrometers. If nothing has changed since previous was built, previous is
+        returned as-is. Hydrometers cache their own serialized form, so only the ones with new readings since the last
+        snapshot are re-serialized."""
+        now_ns = time.monotonic_ns()
+        active = [tilt for tilt in tilts.values() if not tilt.expired(now_ns)]
+        key = tuple((id(tilt), tilt.version) for tilt in active)
+        if previous is not None and previous.key == key:
+            return previous
+
+        return cls([tilt.to_dict() for tilt in active], b'[' + b', '.join(tilt.to_json() for tilt in active) + b']',
+                   key)
@@ -0,0 +1,49 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+LOG = logging.getLogger("tilt")
+
+# Unexpected errors are reported to Sentry. Importing and initializing sentry_sdk takes seconds on a Pi Zero, and no
+# beacons are read while that happens, so it's done on a background thread once scanning has started (see
+# start_in_background). Errors before then aren't reported.
+
+DSN = "https://9a5f70908aee4f879e0f7f9ec81ef618@sentry.optictheory.com/10"
+
+# sentry_sdk, once it has been initialized
+_sentry = None
+
+
+def enabled_from_env() -> bool:
+    """Whether errors should be reported - set TILTBRIDGE_JR_SENTRY_ENABLED to 'false' to turn reporting off"""
+    enabled_env = os.environ.get("TILTBRIDGE_JR_SENTRY_ENABLED")
+    return enabled_env.lower() == 'true' if enabled_env else True
+
+
+def init():
+    global _sentry
+    import sentry_sdk
+    import sentry_sdk.integrations.logging
+
+    # I'm trying to output things that are install-specific (or environmental) to log files that a user can access,
+    # while not logging those to Sentry. The "tilt" logger in this case shouldn't be sent to Sentry, but should be
+    # logged to the log file.
+    sentry_sdk.integrations.logging.ignore_logger("tilt")
+    sentry_sdk.init(DSN, traces_sample_rate=0.0)
+    _sentry = sentry_sdk
+
+
+def start_in_background() -> Optional[threading.Thread]:
+    """Initialize error reporting on a background thread"""
+    if _sentry is not None:
+        return None
+    thread = threading.Thread(target=init, name="error-reporting", daemon=True)
+    thread.start()
+    return thread
+
+
+def capture_exception(e: BaseException):
+    """Report an exception, if error reporting has been initialized"""
+    if _sentry is not None:
+        _sentry.capture_exception(e)
@@ -0,0 +1,216 @@
+import asyncio
+import ctypes
+import logging
+import socket
+import struct
+from typing import List, Tuple
+
+import tilt_decoder
+
+
+LOG = logging.getLogger("tilt")
+
+# Kernel-side filtering for the raw HCI socket. By default aioblescan asks the kernel for every HCI event, and every one
+# of them wakes up the event loop, only for process_ble_beacon to throw most of them away. With filtering enabled:
+#
+#  1. The HCI socket filter (SOL_HCI/HCI_FILTER) only passes HCI events we care about - LE meta events (advertising
+#     reports), plus command complete/status events, which BLEScanRequester needs while it sets up the adapter.
+#  2. A classic BPF socket filter (SO_ATTACH_FILTER) then drops every advertising report that doesn't carry an Apple
+#     iBeacon manufacturer specific data block, before it is ever queued on the socket.
+#  3. HCISocketTransport reads every frame waiting on the socket each time it is woken up, rather than one per wakeup.
+
+SOL_HCI = getattr(socket, 'SOL_HCI', 0)
+HCI_FILTER = getattr(socket, 'HCI_FILTER', 2)
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
+EVT_CMD_COMPLETE = 0x0e
+EVT_CMD_STATUS = 0x0f
+
+RECEIVE_BUFFER_SIZE = 1024 * 1024  # bytes
+MAX_FRAME_SIZE = 258  # An HCI event is at most 255 bytes of parameters, plus the packet type, event code and length
+MAX_FRAMES_PER_WAKEUP = 64
+
+# How many AD structures into each advertisement the BPF filter looks for the iBeacon block. Classic BPF can't loop, so
+# the walk is unrolled. Tilts broadcast the iBeacon block second (after the flags).
+BPF_MAX_AD_STRUCTURES = 4
+
+
+def hci_filter(event_codes: Tuple[int, ...] = (EVT_CMD_COMPLETE, EVT_CMD_STATUS,
+                                               tilt_decoder.EVT_LE_META_EVENT)) -> bytes:
+    """Build a struct hci_filter that only passes HCI event packets with the given event codes"""
+    event_mask = 0
+    for event_code in event_codes:
+        event_mask |= 1 << event_code
+    return struct.pack("IIIh2x", 1 << tilt_decoder.HCI_EVENT_PKT, event_mask & 0xffffffff, event_mask >> 32, 0)
+
+
+# Classic BPF opcodes (see linux/filter.h)
+BPF_LD, BPF_LDX, BPF_ST, BPF_ALU, BPF_JMP, BPF_RET, BPF_MISC = 0x00, 0x01, 0x02, 0x04, 0x05, 0x06, 0x07
+BPF_W, BPF_H, BPF_B = 0x00, 0x08, 0x10
+BPF_IMM, BPF_ABS, BPF_IND, BPF_MEM = 0x00, 0x20, 0x40, 0x60
+BPF_ADD, BPF_JA, BPF_JEQ = 0x00, 0x00, 0x10
+BPF_K, BPF_X = 0x00, 0x08
+BPF_TAX = 0x00
+
+ACCEPT = 0x40000  # Return value for the BPF program - the number of bytes of the frame to keep (i.e. all of them)
+
+# A BPF instruction before its jumps are resolved - (code, jt, jf, k), where jt and jf are either label names or None to
+# fall through to the next instruction. Labels are plain strings in the program.
+BPFInstruction = Tuple[int, str or None, str or None, int]
+
+
+def _assemble(program: List[BPFInstruction or str]) -> List[Tuple[int, int, int, int]]:
+    """Resolve the labels in a BPF program to jump offsets"""
+    labels, instructions = {}, []
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = len(instructions)
+        else:
+            instructions.append(item)
+
+    assembled = []
+    for x, (code, jt, jf, k) in enumerate(instructions):
+        jt = labels[jt] - x - 1 if jt is not None else 0
+        jf = labels[jf] - x - 1 if jf is not None else 0
+        if code == BPF_JMP | BPF_JA:
+            k, jt, jf = jt, 0, 0
+        assembled.append((code, jt, jf, k))
+    return assembled
+
+
+def ibeacon_bpf_program() -> List[Tuple[int, int, int, int]]:
+    """Build a classic BPF program that passes command complete/status events, and LE advertising reports (legacy or
+    extended) carrying an iBeacon. Reports we can't inspect (multiple reports per event) are passed, so that the
+    userspace decoder can deal with them the same way it does without the filter."""
+    program = [
+        (BPF_LD | BPF_B | BPF_ABS, None, None, 0),
+        (BPF_JMP | BPF_JEQ | BPF_K, None, 'drop', tilt_decoder.HCI_EVENT_PKT),
+        (BPF_LD | BPF_B | BPF_ABS, None, None, 1),
+        (BPF_JMP | BPF_JEQ | BPF_K, 'accept', None, EVT_CMD_COMPLETE),
+        (BPF_JMP | BPF_JEQ | BPF_K, 'accept', None, EVT_CMD_STATUS),
+        (BPF_JMP | BPF_JEQ | BPF_K, None, 'drop', tilt_decoder.EVT_LE_META_EVENT),
+        (BPF_LD | BPF_B | BPF_ABS, None, None, 3),  # Subevent
+        (BPF_JMP | BPF_JEQ | BPF_K, 'legacy', None, tilt_decoder.EVT_LE_ADVERTISING_REPORT),
+        (BPF_JMP | BPF_JEQ | BPF_K, None, 'drop', tilt_decoder.EVT_LE_EXTENDED_ADVERTISING_REPORT),
+        (BPF_LD | BPF_B | BPF_ABS, None, None, 4),  # Number of reports
+        (BPF_JMP | BPF_JEQ | BPF_K, None, 'accept', 1),
+        (BPF_LDX | BPF_W | BPF_IMM, None, None, tilt_decoder.EXT_ADV_REPORT_DATA_LEN_OFFSET + 1),
+        (BPF_JMP | BPF_JA, 'walk0', None, 0),
+        'legacy',
+        (BPF_LD | BPF_B | BPF_ABS, None, None, 4),  # Number of reports
+        (BPF_JMP | BPF_JEQ | BPF_K, None, 'accept', 1),
+        (BPF_LDX | BPF_W | BPF_IMM, None, None, tilt_decoder.ADV_REPORT_DATA_LEN_OFFSET + 1),
+    ]
+
+    # X holds the offset of the current AD structure: length, type, data...
+    for x in range(BPF_MAX_AD_STRUCTURES):
+        program += [
+            f'walk{x}',
+            (BPF_LD | BPF_B | BPF_IND, None, None, 0),
+            (BPF_JMP | BPF_JEQ | BPF_K, 'drop', None, 0),  # A zero length structure marks the end of the data
+            (BPF_ST, None, None, 0),
+            (BPF_LD | BPF_B | BPF_IND, None, None, 1),
+            (BPF_JMP | BPF_JEQ | BPF_K, None, f'next{x}', tilt_decoder.AD_TYPE_MANUFACTURER_SPECIFIC),
+            (BPF_LD | BPF_H | BPF_IND, None, None, 2),
+            (BPF_JMP | BPF_JEQ | BPF_K, None, f'next{x}', struct.unpack('>H', tilt_decoder.IBEACON_PREFIX[:2])[0]),
+            (BPF_LD | BPF_H | BPF_IND, None, None, 4),
+            (BPF_JMP | BPF_JEQ | BPF_K, 'accept', f'next{x}', struct.unpack('>H', tilt_decoder.IBEACON_PREFIX[2:])[0]),
+            f'next{x}',
+            (BPF_LD | BPF_MEM, None, None, 0),
+            (BPF_ALU | BPF_ADD | BPF_K, None, None, 1),
+            (BPF_ALU | BPF_ADD | BPF_X, None, None, 0),
+            (BPF_MISC | BPF_TAX, None, None, 0),
+        ]
+
+    program += [
+        'drop',
+        (BPF_RET | BPF_K, None, None, 0),
+        'accept',
+        (BPF_RET | BPF_K, None, None, ACCEPT),
+    ]
+    return _assemble(program)
+
+
+def attach_bpf(sock: socket.socket, program: List[Tuple[int, int, int, int]]):
+    """Attach a classic BPF program to a socket (SO_ATTACH_FILTER). Raises OSError if the kernel refuses it."""
+    filters = b''.join(struct.pack('HBBI', *instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(filters)
+    # struct sock_fprog - the kernel copies the program during setsockopt, so buffer only needs to outlive the call
+    fprog = struct.pack('HP', len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def configure_socket(sock: socket.socket, bpf: bool = True):
+    """Enable kernel-side filtering on a raw HCI socket, and enlarge its receive buffer so that bursts of advertisements
+    aren't dropped while the event loop is busy. Each step is best-effort - if the kernel doesn't support one, we log it
+    and carry on without it."""
+    try:
+        sock.setsockopt(SOL_HCI, HCI_FILTER, hci_filter())
+    except OSError as e:
+        LOG.warning(f"Unable to set HCI event filter - {e}")
+
+    if bpf:
+        try:
+            attach_bpf(sock, ibeacon_bpf_program())
+        except OSError as e:
+            LOG.warning(f"Unable to attach BPF filter - {e}")
+
+    try:
+        # SO_RCVBUFFORCE ignores rmem_max, but needs CAP_NET_ADMIN (which we have in Docker for bluetooth)
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RECEIVE_BUFFER_SIZE)
+    except OSError:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError as e:
+            LOG.warning(f"Unable to enlarge socket receive buffer - {e}")
+
+
+class HCISocketTransport(asyncio.Transport):
+    """A minimal transport for a raw HCI socket that reads every frame waiting on the socket (up to max_frames) each
+    time the socket becomes readable, handing each one to the protocol's data_received(). asyncio's own socket
+    transport only reads one frame per wakeup."""
+
+    def __init__(self, sock: socket.socket, protocol: asyncio.Protocol, max_frames: int = MAX_FRAMES_PER_WAKEUP):
+        super().__init__()
+        self.sock = sock  # type: socket.socket
+        self.protocol = protocol  # type: asyncio.Protocol
+        self.max_frames = max_frames  # type: int
+        self.loop = asyncio.get_running_loop()
+        self.closed = False  # type: bool
+
+        sock.setblocking(False)
+        self.protocol.connection_made(self)
+        self.loop.add_reader(sock.fileno(), self._read_ready)
+
+    def _read_ready(self):
+        recv = self.sock.recv
+        data_received = self.protocol.data_received
+        for _ in range(self.max_frames):
+            try:
+                frame = recv(MAX_FRAME_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                LOG.error(f"Error reading from HCI socket - {e}")
+                self._close(e)
+                return
+            data_received(frame)
+
+    def write(self, data: bytes):
+        # HCI commands are tiny and only sent during setup/shutdown, so we send them directly
+        self.sock.send(data)
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self):
+        self._close(None)
+
+    def _close(self, exc: Exception or None):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.protocol.connection_lost(exc)
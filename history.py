@@ -0,0 +1,366 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import http_server
+from TiltHydrometer import TiltHydrometer
+
+LOG = logging.getLogger("tilt")
+
+# An embedded time-series store for every hydrometer's readings, so fermentation curves can be served from the device.
+#
+# Every reading is kept at full resolution for a couple of days, and rolled up into 1 minute, 15 minute and hourly
+# averages which are kept for progressively longer (see TIERS). Each tier of each hydrometer is stored as a series of
+# segment files covering a fixed span of time, and whole segments are deleted once they are past the tier's retention,
+# so storage is bounded no matter how long a fermentation runs.
+#
+# A segment is a pair of append-only files:
+#   <start>.dat - blocks of readings. Each block is columnar - every timestamp, then every gravity, and so on (see
+#                 COLUMNS) - so a block can be encoded/decoded with one array copy per column.
+#   <start>.idx - one fixed-size entry per block (see INDEX_ENTRY), which is memory-mapped and binary searched to find
+#                 the blocks in a range without reading any of the others.
+#
+# Readings are buffered in memory and written as one block per hydrometer every flush_interval seconds, to keep SD card
+# writes few and large. Everything is stored little-endian.
+
+# (name, array typecode): seconds since the epoch, SG, degrees F, dBm and the number of readings averaged
+COLUMNS = (('timestamp', 'I'), ('gravity', 'f'), ('temp', 'f'), ('count', 'H'), ('rssi', 'b'))
+ROW_SIZE = sum(array(typecode).itemsize for _, typecode in COLUMNS)
+# (offset in the .dat file, rows, first timestamp, last timestamp)
+INDEX_ENTRY = struct.Struct('<IIII')
+
+DAY = 86400
+
+
+class Tier:
+    __slots__ = ('name', 'interval', 'segment', 'retention')
+
+    def __init__(self, name: str, interval: int, segment: int, retention: int):
+        self.name = name  # type: str
+        self.interval = interval  # type: int  # seconds per row (0 for every reading)
+        self.segment = segment  # type: int  # seconds of readings per segment file
+        self.retention = retention  # type: int  # seconds segments are kept for
+
+
+TIERS = (
+    Tier('raw', 0, DAY, 2 * DAY),
+    Tier('1m', 60, DAY, 14 * DAY),
+    Tier('15m', 900, 7 * DAY, 180 * DAY),
+    Tier('1h', 3600, 30 * DAY, 730 * DAY),
+)  # type: Tuple[Tier, ...]
+TIERS_BY_NAME = {tier.name: tier for tier in TIERS}  # type: Dict[str, Tier]
+
+
+def device_id(color: str, mac: str or None) -> str:
+    return f"{color.lower()}_{mac.replace(':', '').lower() if mac else 'unknown'}"
+
+
+class Rows:
+    """A batch of readings, held column by column"""
+    __slots__ = ('timestamp', 'gravity', 'temp', 'count', 'rssi')
+
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def append(self, timestamp: int, gravity: float, temp: float, count: int, rssi: int):
+        self.timestamp.append(timestamp)
+        self.gravity.append(gravity)
+        self.temp.append(temp)
+        self.count.append(count)
+        self.rssi.append(rssi)
+
+    def extend(self, other: 'Rows', start: int = 0, end: Optional[int] = None):
+        for name, _ in COLUMNS:
+            getattr(self, name).extend(getattr(other, name)[start:end])
+
+    def encode(self, start: int = 0, end: Optional[int] = None) -> bytes:
+        columns = []
+        for name, _ in COLUMNS:
+            column = getattr(self, name)[start:end]
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column.tobytes())
+        return b''.join(columns)
+
+    @classmethod
+    def decode(cls, data, count: int) -> 'Rows':
+        rows = cls()
+        offset = 0
+        for name, typecode in COLUMNS:
+            column = getattr(rows, name)
+            size = count * column.itemsize
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            offset += size
+        return rows
+
+    def to_dict(self) -> dict:
+        return {
+            'timestamp': self.timestamp.tolist(),
+            'gravity': [round(value, 4) for value in self.gravity],
+            'temp': [round(value, 1) for value in self.temp],
+            'rssi': self.rssi.tolist(),
+            'count': self.count.tolist(),
+        }
+
+
+class Rollup:
+    """Averages rows into fixed buckets of a tier's interval"""
+    __slots__ = ('interval', 'bucket', 'count', 'gravity_sum', 'temp_sum', 'rssi_sum')
+
+    def __init__(self, interval: int):
+        self.interval = interval  # type: int
+        self.bucket = -1  # type: int
+        self.count = 0  # type: int
+        self.gravity_sum = 0.0  # type: float
+        self.temp_sum = 0.0  # type: float
+        self.rssi_sum = 0  # type: int
+
+    def add(self, rows: Rows) -> Rows:
+        """Add rows to the rollup, returning a row for each bucket that has been completed"""
+        completed = Rows()
+        for timestamp, gravity, temp, count, rssi in zip(rows.timestamp, rows.gravity, rows.temp, rows.count,
+                                                          rows.rssi):
+            bucket = timestamp - timestamp % self.interval
+            if bucket != self.bucket:
+                if self.count > 0:
+                    completed.append(self.bucket, self.gravity_sum / self.count, self.temp_sum / self.count,
+                                     min(self.count, 0xffff), round(self.rssi_sum / self.count))
+                self.bucket = bucket
+                self.count, self.gravity_sum, self.temp_sum, self.rssi_sum = 0, 0.0, 0.0, 0
+            # Rows that are themselves rollups are weighted by the number of readings they cover
+            self.count += count
+            self.gravity_sum += gravity * count
+            self.temp_sum += temp * count
+            self.rssi_sum += rssi * count
+        return completed
+
+
+class History:
+    """Records every hydrometer's readings, and serves them back over a range of time (see query())"""
+
+    FLUSH_INTERVAL = 60  # seconds
+    PRUNE_INTERVAL = 3600  # seconds
+    MAX_POINTS = 2000  # The most rows query() will pick a resolution for
+    RAW_READING_INTERVAL = 5  # Roughly how often a Tilt broadcasts, in seconds
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path  # type: str
+        self.flush_interval = flush_interval  # type: float
+
+        # Readings that haven't been written yet, by hydrometer. Only touched from the event loop.
+        self.buffers = {}  # type: Dict[TiltHydrometer, Tuple[str, Rows]]
+        # The rollups for each hydrometer (one per tier after raw). Only touched from the writer thread.
+        self.rollups = {}  # type: Dict[str, List[Rollup]]
+        self.last_prune = 0.0  # type: float
+        # Writes (and queries, so they never see a half-written block) happen one at a time on a worker thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+    def record(self, tilt: TiltHydrometer, sensor_gravity: int, sensor_temp: int, rssi: int):
+        """Buffer a reading (called for every beacon, so this needs to be cheap)"""
+        if sensor_temp == 999:
+            return  # Not a reading - the Tilt is reporting its firmware version
+        buffer = self.buffers.get(tilt)
+        if buffer is None:
+            buffer = self.buffers[tilt] = (device_id(tilt.color, tilt.mac), Rows())
+        if sensor_gravity >= 5000:  # Tilt Pro
+            buffer[1].append(int(time.time()), sensor_gravity / 10000, sensor_temp / 10, 1, rssi)
+        else:
+            buffer[1].append(int(time.time()), sensor_gravity / 1000, sensor_temp, 1, rssi)
+
+    async def flush(self):
+        """Write every buffered reading to disk"""
+        batches = list(self.buffers.values())
+        self.buffers = {}
+        if len(batches) > 0:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.write, batches, time.time())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                LOG.error(f"Unable to write history to {self.path} - {e}")
+
+    async def close(self):
+        try:
+            await self.flush()
+        except OSError as e:
+            LOG.error(f"Unable to write history to {self.path} - {e}")
+        self.executor.shutdown()
+
+    def _segment_path(self, device: str, tier: Tier, start: int) -> str:
+        return os.path.join(self.path, device, tier.name, str(start))
+
+    def _append(self, device: str, tier: Tier, rows: Rows):
+        """Append rows to a tier's segment(s), as one block per segment"""
+        start = 0
+        while start < len(rows):
+            segment = rows.timestamp[start] - rows.timestamp[start] % tier.segment
+            end = start
+            while end < len(rows) and rows.timestamp[end] - rows.timestamp[end] % tier.segment == segment:
+                end += 1
+
+            base = self._segment_path(device, tier, segment)
+            os.makedirs(os.path.dirname(base), exist_ok=True)
+            # The block is written before its index entry, so a reader never finds an entry for a missing block
+            with open(base + '.dat', 'ab') as data:
+                offset = data.tell()
+                data.write(rows.encode(start, end))
+            with open(base + '.idx', 'ab') as index:
+                index.write(INDEX_ENTRY.pack(offset, end - start, rows.timestamp[start], rows.timestamp[end - 1]))
+            start = end
+
+    def write(self, batches: List[Tuple[str, Rows]], now: float):
+        """Write batches of raw readings, and any rollups they complete (called on the writer thread)"""
+        for device, rows in batches:
+            rollups = self.rollups.get(device)
+            if rollups is None:
+                rollups = self.rollups[device] = [Rollup(tier.interval) for tier in TIERS[1:]]
+            self._append(device, TIERS[0], rows)
+            for tier, rollup in zip(TIERS[1:], rollups):
+                rows = rollup.add(rows)
+                if len(rows) <= 0:
+                    break
+                self._append(device, tier, rows)
+
+        if now - self.last_prune >= self.PRUNE_INTERVAL:
+            self.prune(now)
+
+    def prune(self, now: float):
+        """Delete every segment that is entirely past its tier's retention"""
+        self.last_prune = now
+        removed = 0
+        for device in os.listdir(self.path):
+            for tier in TIERS:
+                tier_path = os.path.join(self.path, device, tier.name)
+                if not os.path.isdir(tier_path):
+                    continue
+                for filename in os.listdir(tier_path):
+                    start, _, _ = filename.partition('.')
+                    if start.isdigit() and int(start) + tier.segment < now - tier.retention:
+                        os.remove(os.path.join(tier_path, filename))
+                        removed += 1
+        if removed > 0:
+            LOG.info(f"Removed {removed} expired history file(s)")
+
+    def _read_segment(self, base: str, start: int, end: int, rows: Rows):
+        try:
+            index_file = open(base + '.idx', 'rb')
+            data_file = open(base + '.dat', 'rb')
+        except FileNotFoundError:
+            return
+        with index_file, data_file:
+            entries = os.fstat(index_file.fileno()).st_size // INDEX_ENTRY.size
+            if entries <= 0:
+                return
+            with mmap.mmap(index_file.fileno(), entries * INDEX_ENTRY.size, access=mmap.ACCESS_READ) as index, \
+                    mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Find the first block that ends at or after start
+                low, high = 0, entries
+                while low < high:
+                    middle = (low + high) // 2
+                    if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[3] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+                for entry in range(low, entries):
+                    offset, count, first, last = INDEX_ENTRY.unpack_from(index, entry * INDEX_ENTRY.size)
+                    if first > end:
+                        break
+                    if offset + count * ROW_SIZE > len(data):
+                        continue  # Truncated (e.g. by a power cut)
+                    block = Rows.decode(data[offset:offset + count * ROW_SIZE], count)
+                    if first >= start and last <= end:
+                        rows.extend(block)
+                    else:
+                        timestamps = block.timestamp
+                        first_row = next((i for i, ts in enumerate(timestamps) if ts >= start), count)
+                        last_row = next((i for i, ts in enumerate(timestamps) if ts > end), count)
+                        rows.extend(block, first_row, last_row)
+
+    def choose_tier(self, start: int, end: int, now: float) -> Tier:
+        """The finest tier that still has readings from start, and has no more than MAX_POINTS rows between start and
+        end"""
+        for tier in TIERS:
+            if start < now - tier.retention:
+                continue
+            if (end - start) / max(tier.interval, self.RAW_READING_INTERVAL) <= self.MAX_POINTS:
+                return tier
+        return TIERS[-1]
+
+    def query(self, device: str, start: int, end: int, tier: Tier) -> Rows:
+        """Return a hydrometer's rows from start to end (inclusive, in seconds since the epoch) at a tier's resolution.
+        Readings that haven't been flushed yet aren't included."""
+        rows = Rows()
+        device_path = os.path.join(self.path, device, tier.name)
+        if not os.path.isdir(device_path):
+            return rows
+        segment = start - start % tier.segment
+        while segment <= end:
+            self._read_segment(self._segment_path(device, tier, segment), start, end, rows)
+            segment += tier.segment
+        return rows
+
+    async def serve_history(self, request: http_server.Request, writer: asyncio.StreamWriter) -> http_server.Response:
+        """GET /api/history?color=Red&mac=aa:bb:cc:dd:ee:ff[&start=...][&end=...][&resolution=raw|1m|15m|1h]
+
+        start and end are in seconds since the epoch, and default to the last day. The range is limited to what the tier
+        still keeps. The resolution is chosen to suit the range if it isn't given."""
+        params = {name: values[-1] for name, values in parse_qs(request.query).items()}
+        now = time.time()
+        try:
+            color = params['color']
+            end = int(params.get('end', now))
+            start = int(params.get('start', end - DAY))
+        except (KeyError, ValueError):
+            return http_server.Response(400, b'color is required, and start/end must be integers\n', 'text/plain')
+        if start > end:
+            return http_server.Response(400, b'start must not be after end\n', 'text/plain')
+        if 'resolution' in params:
+            tier = TIERS_BY_NAME.get(params['resolution'])
+            if tier is None:
+                return http_server.Response(400, f"resolution must be one of {', '.join(TIERS_BY_NAME)}\n".encode(),
+                                            'text/plain')
+        else:
+            tier = self.choose_tier(start, end, now)
+        # Nothing is kept past the tier's retention (or recorded in the future), so don't walk segments for it
+        start = max(start, int(now) - tier.retention)
+        end = min(end, int(now))
+
+        device = device_id(color, params.get('mac'))
+        rows = await asyncio.get_running_loop().run_in_executor(self.executor, self.query, device, start, end, tier)
+        body = dict(device=device, resolution=tier.name, **rows.to_dict())
+        return http_server.Response(200, json.dumps(body).encode(), 'application/json',
+                                    {'Access-Control-Allow-Origin': '*'})
+
+    def add_routes(self, server: http_server.HTTPServer):
+        server.route("/api/history", self.serve_history)
+
+
+def history_from_env() -> Optional[History]:
+    """Create the history store if it is enabled, using the TILTBRIDGE_JR_HISTORY_* environment variables"""
+    enabled_env = os.environ.get("TILTBRIDGE_JR_HISTORY_ENABLED")
+    if not (enabled_env.lower() == 'true' if enabled_env else False):
+        return None
+    path = os.environ.get("TILTBRIDGE_JR_HISTORY_DIR") or "log/history"
+    flush_interval_env = os.environ.get("TILTBRIDGE_JR_HISTORY_FLUSH_INTERVAL")
+    flush_interval = float(flush_interval_env) if flush_interval_env else History.FLUSH_INTERVAL
+    os.makedirs(path, exist_ok=True)
+    LOG.info(f"Recording history to {path}")
+    return History(path, flush_interval)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+LOG = logging.getLogger("tilt")
+
+# A deliberately small HTTP/1.1 server for the daemon's local endpoints (e.g. /metrics). It runs in the same event loop
+# as BLE scanning, so every handler has to be quick - handlers should serve data that has already been prepared rather
+# than doing any real work per request.
+
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers')
+
+    def __init__(self, method: str, path: str, query: str, headers: Dict[str, str]):
+        self.method = method  # type: str
+        self.path = path  # type: str
+        self.query = query  # type: str
+        # Header names are lowercased
+        self.headers = headers  # type: Dict[str, str]
+
+
+class Response:
+    __slots__ = ('status', 'body', 'headers')
+
+    REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+    def __init__(self, status: int = 200, body: bytes = b'', content_type: str or None = None,
+                 headers: Optional[Dict[str, str]] = None):
+        self.status = status  # type: int
+        self.body = body  # type: bytes
+        self.headers = dict(headers) if headers else {}  # type: Dict[str, str]
+        if content_type is not None:
+            self.headers['Content-Type'] = content_type
+
+    def encode(self, include_body: bool = True) -> bytes:
+        lines = [f"HTTP/1.1 {self.status} {self.REASONS.get(self.status, '')}"]
+        lines.extend(f"{name}: {value}" for name, value in self.headers.items())
+        lines.append(f"Content-Length: {len(self.body)}")
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head + self.body if include_body else head
+
+
+# A handler returns a Response, or None if it has taken over the connection itself (e.g. to stream events), in which
+# case the connection is closed once the handler returns.
+Handler = Callable[[Request, asyncio.StreamWriter], Awaitable[Optional[Response]]]
+
+
+class HTTPServer:
+    MAX_HEADER_SIZE = 8192  # bytes
+    REQUEST_TIMEOUT = 30  # seconds a keep-alive connection can sit idle
+
+    def __init__(self):
+        self.routes = {}  # type: Dict[str, Handler]
+        self.server = None  # type: asyncio.AbstractServer or None
+        # The task handling each open connection, so that long-lived connections (e.g. streams) can be closed on stop()
+        self.connections = set()  # type: Set[asyncio.Task]
+
+    def route(self, path: str, handler: Handler):
+        """Serve GET (and HEAD) requests for path with handler"""
+        self.routes[path] = handler
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        LOG.info(f"Serving HTTP on {host}:{port} ({', '.join(self.routes)})")
+
+    @property
+    def port(self) -> int:
+        """The port the server is listening on (useful if started on port 0)"""
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.REQUEST_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            return None
+        if len(head) > self.MAX_HEADER_SIZE:
+            return None
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition('?')
+        return Request(method.upper(), path, query, headers)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    return
+                response = await self._dispatch(request, writer)
+                if response is None:
+                    return  # The handler streamed its own response
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                response.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                writer.write(response.encode(request.method != 'HEAD'))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _dispatch(self, request: Request, writer: asyncio.StreamWriter) -> Optional[Response]:
+        if request.method not in ('GET', 'HEAD'):
+            return Response(405, b'Method not allowed\n', 'text/plain', {'Allow': 'GET, HEAD'})
+        handler = self.routes.get(request.path)
+        if handler is None:
+            return Response(404, b'Not found\n', 'text/plain')
+        try:
+            return await handler(request, writer)
+        except Exception as e:
+            LOG.error(f"Error handling request for {request.path}: {e}")
+            return Response(500, b'Internal server error\n', 'text/plain')
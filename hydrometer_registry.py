@@ -0,0 +1,75 @@
+import time
+from collections.abc import Mapping
+from typing import Dict, Optional, Tuple
+
+from TiltHydrometer import TiltHydrometer
+from smoothing import SmoothingConfig, Strategy
+import tilt_decoder
+
+
+class HydrometerRegistry(Mapping):
+    """Tracks every Tilt we've heard from, keyed by (color, MAC address) so that multiple Tilts of the same color don't
+    overwrite each other's readings.
+
+    Hydrometers are created the first time they are seen. The hot path (lookup()) is a single dict lookup keyed on the
+    raw UUID and MAC bytes from the decoder, so the cost stays constant no matter how many hydrometers we're tracking.
+    Iterating over the registry (e.g. .items()) works the same as the old color-keyed dict of TiltHydrometers."""
+
+    def __init__(self, smoothing: SmoothingConfig or None = None):
+        # How new hydrometers smooth their readings - if None, they use the built-in mean of the last 60 readings
+        self.smoothing = smoothing  # type: SmoothingConfig or None
+        self.hydrometers = {}  # type: Dict[Tuple[str, str], TiltHydrometer]
+        # Index from the raw (uuid, mac) bytes as broadcast to the hydrometer, used by lookup()
+        self._raw_index = {}  # type: Dict[Tuple[bytes, bytes], TiltHydrometer]
+
+    def __getitem__(self, key: Tuple[str, str]) -> TiltHydrometer:
+        return self.hydrometers[key]
+
+    def __iter__(self):
+        return iter(self.hydrometers)
+
+    def __len__(self):
+        return len(self.hydrometers)
+
+    def items(self):
+        return self.hydrometers.items()
+
+    def values(self):
+        return self.hydrometers.values()
+
+    def set_smoothing(self, smoothing: SmoothingConfig) -> int:
+        """Change how hydrometers smooth their readings. Hydrometers already being tracked are switched over (keeping
+        the readings in their smoothing window) if their strategy has changed. Returns the number switched over."""
+        previous, self.smoothing = self.smoothing, smoothing
+        switched = 0
+        for tilt in self.hydrometers.values():
+            strategy = smoothing.strategy_for(tilt.color)
+            if strategy != (previous.strategy_for(tilt.color) if previous is not None else Strategy()):
+                strategy.apply(tilt, keep_readings=True)
+                switched += 1
+        return switched
+
+    def lookup(self, uuid: bytes, mac: bytes) -> Optional[TiltHydrometer]:
+        """Returns the hydrometer for the raw UUID/MAC from a decoded frame, creating it if this is the first time we've
+        seen it. Returns None if the UUID isn't a known Tilt color."""
+        raw_key = (uuid, mac)
+        tilt = self._raw_index.get(raw_key)
+        if tilt is None:
+            color = TiltHydrometer.color_lookup_table_bytes.get(uuid)
+            if color is None:
+                return None
+            tilt = TiltHydrometer(color, tilt_decoder.format_mac(mac))
+            if self.smoothing is not None:
+                self.smoothing.strategy_for(color).apply(tilt)
+            self.hydrometers[(tilt.color, tilt.mac)] = tilt
+            self._raw_index[raw_key] = tilt
+        return tilt
+
+    def evict_expired(self) -> int:
+        """Remove any hydrometers that we haven't heard from recently. Returns the number of hydrometers removed."""
+        now_ns = time.monotonic_ns()
+        expired_keys = [raw_key for raw_key, tilt in self._raw_index.items() if tilt.expired(now_ns)]
+        for raw_key in expired_keys:
+            tilt = self._raw_index.pop(raw_key)
+            del self.hydrometers[(tilt.color, tilt.mac)]
+        return len(expired_keys)
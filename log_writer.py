@@ -0,0 +1,120 @@
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from typing import Dict, List, Tuple
+
+# Log records are written to the log file by a background thread (a logging.handlers.QueueListener), so a slow SD card
+# never holds up the event loop - logging a record only formats its message and puts it on a queue. The file is rotated
+# by size, so verbose logging left on doesn't fill the disk.
+#
+# When running split (see tiltbridge_junior.run_split_processes), the child processes forward their records to the
+# supervisor's writer through a multiprocessing queue, so only one process ever writes to (and rotates) the file.
+
+FORMAT = '%(asctime)s %(levelname)-8s: %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+DEFAULT_PATH = 'log/tiltbridge-jr.log'
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+DEFAULT_RATE_LIMIT = 60  # records per call site per minute
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most limit records from each call site (line of code) every interval seconds, so a message
+    logged for every frame can't flood the log. The first record let through after some were dropped notes how many."""
+
+    def __init__(self, limit: int, interval: float = 60):
+        super().__init__()
+        self.limit = limit  # type: int
+        self.interval_ns = int(interval * 1e9)  # type: int
+        # (pathname, lineno) -> [start of the current interval (time.monotonic_ns()), records let through, dropped]
+        self.call_sites = {}  # type: Dict[Tuple[str, int], List[int]]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.pathname, record.lineno)
+        now_ns = time.monotonic_ns()
+        call_site = self.call_sites.get(key)
+        if call_site is None or now_ns - call_site[0] >= self.interval_ns:
+            dropped = call_site[2] if call_site is not None else 0
+            self.call_sites[key] = [now_ns, 1, 0]
+            if dropped > 0:
+                record.msg = f"{record.msg} ({dropped} similar message(s) suppressed)"
+            return True
+        if call_site[1] < self.limit:
+            call_site[1] += 1
+            return True
+        call_site[2] += 1
+        return False
+
+
+def queue_handler(log_queue, rate_limit: int) -> logging.handlers.QueueHandler:
+    """A handler that puts records on log_queue (rate limited, if rate_limit is above 0)"""
+    handler = logging.handlers.QueueHandler(log_queue)
+    if rate_limit > 0:
+        handler.addFilter(RateLimitFilter(rate_limit))
+    return handler
+
+
+def install(handler: logging.Handler):
+    """Send every log record to handler (and nowhere else)"""
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(logging.WARN)
+
+
+class LogWriter:
+    """Writes every log record to a file (rotated once it reaches max_bytes) from a background thread.
+
+    Records are read from log_queue, which can be a multiprocessing queue shared with child processes (see
+    forward())."""
+
+    def __init__(self, path: str = DEFAULT_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 backup_count: int = DEFAULT_BACKUP_COUNT, rate_limit: int = DEFAULT_RATE_LIMIT, log_queue=None):
+        self.path = path  # type: str
+        self.rate_limit = rate_limit  # type: int
+        self.queue = log_queue if log_queue is not None else queue.SimpleQueue()
+        self.file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                                 delay=True)
+        self.file_handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler)
+        self.handler = None  # type: logging.handlers.QueueHandler or None
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.listener.start()
+        self.handler = queue_handler(self.queue, self.rate_limit)
+        install(self.handler)
+
+    def stop(self):
+        """Write out any records still queued, and close the file"""
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+            self.handler = None
+        self.listener.stop()
+        self.file_handler.close()
+
+
+def rate_limit_from_env() -> int:
+    rate_limit_env = os.environ.get("TILTBRIDGE_JR_LOG_RATE_LIMIT")
+    return int(rate_limit_env) if rate_limit_env else DEFAULT_RATE_LIMIT
+
+
+def log_writer_from_env(log_queue=None) -> LogWriter:
+    """Create the log writer, using the TILTBRIDGE_JR_LOG_* environment variables"""
+    path = os.environ.get("TILTBRIDGE_JR_LOG_FILE") or DEFAULT_PATH
+    max_bytes_env = os.environ.get("TILTBRIDGE_JR_LOG_MAX_BYTES")
+    backup_count_env = os.environ.get("TILTBRIDGE_JR_LOG_BACKUP_COUNT")
+    max_bytes = int(max_bytes_env) if max_bytes_env else DEFAULT_MAX_BYTES
+    backup_count = int(backup_count_env) if backup_count_env else DEFAULT_BACKUP_COUNT
+    return LogWriter(path, max_bytes, backup_count, rate_limit_from_env(), log_queue)
+
+
+def forward(log_queue):
+    """Send this (child) process's log records to the LogWriter reading from log_queue"""
+    install(queue_handler(log_queue, rate_limit_from_env()))
@@ -0,0 +1,243 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+# Lightweight instrumentation for the daemon, exposed in the Prometheus text format (see render()).
+#
+# Every metric (and every labelled child of a metric) is created up front - at import, or when a data target is set up -
+# so recording an event is just an attribute increment, with nothing allocated or looked up on the hot path. Each metric
+# family is registered in REGISTRY when it is created.
+#
+# The counters updated for every frame are kept as their (unlabelled) child, so the hot path can update .value directly
+# rather than paying for a method call.
+
+
+class _Child:
+    """A single time series - a metric with a specific set of label values"""
+    __slots__ = ('label_values',)
+
+    def __init__(self, label_values: Tuple[str, ...]):
+        self.label_values = label_values  # type: Tuple[str, ...]
+
+
+class CounterChild(_Child):
+    __slots__ = ('value',)
+
+    def __init__(self, label_values: Tuple[str, ...] = ()):
+        super().__init__(label_values)
+        self.value = 0  # type: int
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class GaugeChild(_Child):
+    __slots__ = ('value', 'function')
+
+    def __init__(self, label_values: Tuple[str, ...] = ()):
+        super().__init__(label_values)
+        self.value = 0  # type: float
+        # If set, the gauge's value is read from this when metrics are rendered, rather than being set as things change
+        self.function = None  # type: Callable[[], float] or None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramChild(_Child):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...], label_values: Tuple[str, ...] = ()):
+        super().__init__(label_values)
+        self.buckets = buckets  # type: Tuple[float, ...]
+        # Non-cumulative count per bucket - the last entry is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)  # type: List[int]
+        self.sum = 0.0  # type: float
+        self.count = 0  # type: int
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    metric_type = ''
+    child_class = _Child
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name  # type: str
+        self.documentation = documentation  # type: str
+        self.labelnames = labelnames  # type: Tuple[str, ...]
+        self.children = {}  # type: Dict[Tuple[str, ...], _Child]
+        if len(labelnames) <= 0:
+            self.children[()] = self._new_child(())
+        REGISTRY.append(self)
+
+    def _new_child(self, label_values: Tuple[str, ...]) -> _Child:
+        return self.child_class(label_values)
+
+    def labels(self, *label_values: str) -> _Child:
+        """Returns the child for a set of label values, creating it the first time it is requested. This does a dict
+        lookup, so call it once at setup and keep the child, rather than calling it for every event."""
+        if len(label_values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        child = self.children.get(label_values)
+        if child is None:
+            child = self.children[label_values] = self._new_child(label_values)
+        return child
+
+    def _label_string(self, label_values: Tuple[str, ...], extra: str = '') -> str:
+        labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, label_values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if len(labels) > 0 else ''
+
+    def _samples(self, child) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for child in list(self.children.values()):
+            lines.extend(self._samples(child))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+    child_class = CounterChild
+
+    def inc(self, amount: int = 1):
+        self.children[()].inc(amount)
+
+    def _samples(self, child: CounterChild) -> List[str]:
+        return [f"{self.name}{self._label_string(child.label_values)} {child.value}"]
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+    child_class = GaugeChild
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.children[()].set_function(function)
+
+    def _samples(self, child: GaugeChild) -> List[str]:
+        return [f"{self.name}{self._label_string(child.label_values)} {_format_value(child.get())}"]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+    child_class = HistogramChild
+
+    # Suitable for network requests (in seconds)
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))  # type: Tuple[float, ...]
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self, label_values: Tuple[str, ...]) -> HistogramChild:
+        return HistogramChild(self.buckets, label_values)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def _samples(self, child: HistogramChild) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            labels = self._label_string(child.label_values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = self._label_string(child.label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Every metric, in the order they were created
+REGISTRY = []  # type: List[_Metric]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render() -> bytes:
+    """Render every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode()
+
+
+# BLE pipeline
+frames_received = Counter("tiltbridge_frames_received_total",
+                          "HCI frames received from the bluetooth adapter(s)").labels()
+frames_dropped = Counter("tiltbridge_frames_dropped_total", "HCI frames that weren't processed as a Tilt reading",
+                         ("reason",))
+frames_dropped_not_tilt = frames_dropped.labels("not_tilt")  # Not a Tilt iBeacon (rejected by the fast decoder)
+frames_dropped_fallback = frames_dropped.labels("fallback_rejected")  # Rejected by the aioblescan decoder
+frames_dropped_unknown_color = frames_dropped.labels("unknown_color")  # A Tilt-like UUID that isn't a known color
+frames_dropped_duplicate = frames_dropped.labels("duplicate")  # Already received through another adapter
+frames_dropped_ring_full = frames_dropped.labels("ring_full")  # The pipeline process fell behind (split processes)
+frames_fallback = Counter("tiltbridge_frames_fallback_decoded_total",
+                          "HCI frames that had to be handed to the (slower) aioblescan decoder").labels()
+decode_cache_lookups = Counter("tiltbridge_decode_cache_lookups_total",
+                               "Frames that could be a Tilt beacon looked up in the decode cache", ("result",))
+decode_cache_hits = decode_cache_lookups.labels("hit")  # A repeat of a recent beacon - only the RSSI was decoded
+decode_cache_misses = decode_cache_lookups.labels("miss")
+tilt_beacons = Counter("tiltbridge_tilt_beacons_total", "Tilt beacons decoded").labels()
+scan_restarts = Counter("tiltbridge_scan_restarts_total",
+                        "Scans restarted by the watchdog on an adapter that stopped delivering frames (or couldn't be "
+                        "opened)", ("action",))
+scan_rescans = scan_restarts.labels("rescan")  # The scan request was sent again
+scan_reopens = scan_restarts.labels("reopen")  # The socket was closed and opened again
+process_restarts = Counter("tiltbridge_process_restarts_total",
+                           "Processes restarted by the supervisor after exiting or hanging (split processes)",
+                           ("process",))
+ingest_restarts = process_restarts.labels("ingest")
+pipeline_restarts = process_restarts.labels("pipeline")
+
+# Hydrometers
+hydrometer_readings = Counter("tiltbridge_hydrometer_readings_total",
+                              "Readings added to a hydrometer's smoothing window").labels()
+hydrometer_firmware_reports = Counter("tiltbridge_hydrometer_firmware_reports_total",
+                                      "Beacons reporting a Tilt's firmware version rather than a reading").labels()
+hydrometer_outliers = Counter("tiltbridge_hydrometer_outliers_total",
+                              "Readings rejected as outliers by the hampel smoothing strategy").labels()
+hydrometers = Gauge("tiltbridge_hydrometers", "Hydrometers currently being tracked")
+
+# Data targets
+snapshot_build_seconds = Histogram("tiltbridge_snapshot_build_seconds", "Time taken to build a snapshot to send",
+                                   buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+target_sends = Counter("tiltbridge_target_sends_total", "Snapshots sent (or attempted) to a data target", ("target",))
+target_send_failures = Counter("tiltbridge_target_send_failures_total",
+                               "Snapshots that failed to send to a data target", ("target",))
+target_send_seconds = Histogram("tiltbridge_target_send_seconds", "Time taken to send a snapshot to a data target",
+                                ("target",))
+target_snapshots_dropped = Counter("tiltbridge_target_snapshots_dropped_total",
+                                   "Snapshots replaced by a newer one before a data target could send them",
+                                   ("target",))
+target_queue_depth = Gauge("tiltbridge_target_queue_depth", "Snapshots waiting to be sent to a data target",
+                           ("target",))
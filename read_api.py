@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+from typing import Mapping
+
+import http_server
+from data_targets.snapshot import Snapshot
+from TiltHydrometer import TiltHydrometer
+
+LOG = logging.getLogger("tilt")
+
+
+class ReadAPI:
+    """Serves the latest readings for every active hydrometer (the same data sent to the data targets) as JSON, so that
+    dashboards can poll TiltBridge Junior directly:
+
+        GET /api/tilts         - {"tilts": [...]}, with an ETag so that unchanged polls get a 304 Not Modified
+        GET /api/tilts/stream  - Server-Sent Events, with one event each time the readings change
+
+    Every client is served from the same pre-encoded response, which is rebuilt at most once every REFRESH_INTERVAL
+    seconds (and only if a hydrometer has new readings), so adding clients costs next to nothing."""
+
+    REFRESH_INTERVAL = 0.5  # seconds
+    STREAM_INTERVAL = 1.0  # seconds between checks for new readings for each stream client
+    STREAM_KEEPALIVE = 15.0  # seconds between keep-alive comments when nothing has changed
+    HEADERS = {'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'}
+
+    def __init__(self, tilts: Mapping[tuple, TiltHydrometer]):
+        self.tilts = tilts  # type: Mapping[tuple, TiltHydrometer]
+        self.snapshot = None  # type: Snapshot or None
+        # version is incremented each time the snapshot changes. The ETag includes an ID for this process, so that
+        # clients don't get a false match after a restart.
+        self.version = 0  # type: int
+        self.instance = os.urandom(4).hex()  # type: str
+        self.etag = ''  # type: str
+        self.body = b''  # type: bytes
+        self.refreshed = float('-inf')  # type: float
+
+    def refresh(self) -> int:
+        """Rebuild the response if it is stale and the readings have changed. Returns the current version."""
+        now = asyncio.get_running_loop().time()
+        if now - self.refreshed < self.REFRESH_INTERVAL:
+            return self.version
+        self.refreshed = now
+
+        snapshot = Snapshot.build(self.tilts, self.snapshot)
+        if snapshot is not self.snapshot:
+            self.snapshot = snapshot
+            self.version += 1
+            self.etag = f'"{self.instance}-{self.version}"'
+            self.body = b'{"tilts": ' + snapshot.tilts_json + b'}'
+        return self.version
+
+    def _etag_matches(self, if_none_match: str or None) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison - a W/ prefix from an intermediate proxy still matches
+        return '*' in tags or any(tag.replace('W/', '', 1) == self.etag for tag in tags)
+
+    async def serve_tilts(self, request: http_server.Request, writer: asyncio.StreamWriter) -> http_server.Response:
+        self.refresh()
+        headers = dict(self.HEADERS, ETag=self.etag)
+        if self._etag_matches(request.headers.get('if-none-match')):
+            return http_server.Response(304, headers=headers)
+        return http_server.Response(200, self.body, 'application/json', headers)
+
+    async def serve_stream(self, request: http_server.Request, writer: asyncio.StreamWriter) -> None:
+        """Stream the readings as Server-Sent Events until the client disconnects"""
+        head = ['HTTP/1.1 200 OK', 'Content-Type: text/event-stream', 'Connection: close']
+        head.extend(f"{name}: {value}" for name, value in self.HEADERS.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        sent_version = None
+        idle = 0.0
+        try:
+            while True:
+                version = self.refresh()
+                if version != sent_version:
+                    writer.write(b'id: ' + self.etag.strip('"').encode() + b'\nevent: tilts\ndata: ' + self.body +
+                                 b'\n\n')
+                    sent_version = version
+                    idle = 0.0
+                elif idle >= self.STREAM_KEEPALIVE:
+                    writer.write(b': keep-alive\n\n')  # Lets us notice clients that have gone away
+                    idle = 0.0
+                await writer.drain()
+                await asyncio.sleep(self.STREAM_INTERVAL)
+                idle += self.STREAM_INTERVAL
+        except ConnectionError:
+            LOG.debug("Stream client disconnected")
+        except asyncio.CancelledError:
+            # The server is stopping - end the stream, rather than leaving the connection task to die with the error
+            writer.close()
+
+    def add_routes(self, server: http_server.HTTPServer):
+        server.route("/api/tilts", self.serve_tilts)
+        server.route("/api/tilts/stream", self.serve_stream)
@@ -0,0 +1,317 @@
+import logging
+import math
+import os
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from typing import Dict, List, Optional, Sequence
+
+import metrics
+from TiltHydrometer import TiltHydrometer
+
+LOG = logging.getLogger("tilt")
+
+# Alternatives to TiltHydrometer's built-in smoothing (the mean of the last smoothing_window readings), selected per
+# hydrometer color with the TILTBRIDGE_JR_SMOOTHING* environment variables (see config_from_env()):
+#
+#   mean    - The mean of the last `window` readings (the default - handled by TiltHydrometer itself)
+#   time    - The time-weighted mean of the readings from the last `seconds` seconds, so the smoothing covers the same
+#             span of time however many readings get through
+#   ewma    - An exponentially weighted moving average, weighted by the time between readings, with the same average
+#             age as a `seconds` long window. O(1) time and memory per reading.
+#   median  - The median of the last `window` readings, which ignores the odd bad reading entirely
+#   hampel  - The mean of the last `window` readings, but with any reading that is more than `threshold` (scaled) median
+#             absolute deviations from the median of the window replaced by that median
+#
+# Smoothers work on the raw integer sensor values (e.g. 1050 for 1.050 SG on a Tilt Classic) and return the smoothed
+# value rounded to an integer, the same as the built-in mean.
+
+
+# Returns total / count, rounded (half to even) to an integer - the same rounding as the built-in mean
+round_div = TiltHydrometer._average_sum
+
+
+class Smoother:
+    """Smooths one stream of raw sensor values (a hydrometer has one for gravity, and one for temperature)"""
+    __slots__ = ()
+
+    def add(self, value: int, now_ns: int):
+        """Add a reading received at now_ns (from time.monotonic_ns())"""
+        raise NotImplementedError
+
+    def value(self) -> int:
+        """The smoothed value"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def seed(self, values: Sequence[int], now_ns: int):
+        """Start from readings carried over from another smoother (oldest first). When each arrived wasn't kept, so
+        they're all added as of now_ns."""
+        for value in values:
+            self.add(value, now_ns)
+
+
+class TimeWindowSmoother(Smoother):
+    """The time-weighted mean of the readings in the last window_ns - each reading counts for as long as it was the
+    latest reading. Bursts of readings (when reception is good) don't outweigh long gaps (when it isn't)."""
+    __slots__ = ('window_ns', 'times', 'values', 'weighted_sum', 'total')
+
+    def __init__(self, window_ns: int):
+        self.window_ns = window_ns  # type: int
+        self.times = deque()  # type: deque
+        self.values = deque()  # type: deque
+        # The sum of every reading but the latest, multiplied by how long it was the latest reading
+        self.weighted_sum = 0  # type: int
+        # The plain sum, for when every reading arrived at the same time
+        self.total = 0  # type: int
+
+    def add(self, value: int, now_ns: int):
+        times, values = self.times, self.values
+        if len(times) > 0:
+            self.weighted_sum += values[-1] * (now_ns - times[-1])
+        times.append(now_ns)
+        values.append(value)
+        self.total += value
+
+        cutoff = now_ns - self.window_ns
+        while times[0] < cutoff and len(times) > 1:
+            self.weighted_sum -= values[0] * (times[1] - times[0])
+            self.total -= values[0]
+            times.popleft()
+            values.popleft()
+
+    def value(self) -> int:
+        if len(self.times) <= 0:
+            return 0
+        span = self.times[-1] - self.times[0]
+        if span <= 0:
+            return round_div(self.total, len(self.values))
+        return round_div(self.weighted_sum, span)
+
+    def clear(self):
+        self.times.clear()
+        self.values.clear()
+        self.weighted_sum = 0
+        self.total = 0
+
+    def seed(self, values: Sequence[int], now_ns: int):
+        # Readings that all arrived at once would only count for as long as they're the latest, so start from their
+        # mean instead
+        self.add(round_div(sum(values), len(values)), now_ns)
+
+
+class EWMASmoother(Smoother):
+    """An exponentially weighted moving average. The weight of each reading depends on the time since the previous one,
+    so the smoothing is the same no matter how many readings get through."""
+    __slots__ = ('tau_ns', 'average', 'last_ns')
+
+    def __init__(self, window_ns: int):
+        # A time constant of half the window gives readings the same average age as a window_ns long mean
+        self.tau_ns = max(window_ns / 2, 1)  # type: float
+        self.average = None  # type: float or None
+        self.last_ns = 0  # type: int
+
+    def add(self, value: int, now_ns: int):
+        if self.average is None:
+            self.average = float(value)
+        else:
+            self.average += (1 - math.exp((self.last_ns - now_ns) / self.tau_ns)) * (value - self.average)
+        self.last_ns = now_ns
+
+    def value(self) -> int:
+        return 0 if self.average is None else round(self.average)
+
+    def clear(self):
+        self.average = None
+
+    seed = TimeWindowSmoother.seed
+
+
+class MedianSmoother(Smoother):
+    """The median of the last window readings. The window is kept both in arrival order (to know which reading to drop)
+    and sorted (so the median is a lookup) - each reading is an O(log n) search and an O(n) memmove, which for windows
+    of this size is much quicker than a heap-based structure in Python."""
+    __slots__ = ('window', 'ring', 'pos', 'sorted')
+
+    def __init__(self, window: int):
+        self.window = window  # type: int
+        self.ring = array('H', bytes(2 * window))  # type: array
+        self.pos = 0  # type: int
+        self.sorted = []  # type: List[int]
+
+    def _insert(self, value: int):
+        if len(self.sorted) >= self.window:
+            del self.sorted[bisect_left(self.sorted, self.ring[self.pos])]
+        insort(self.sorted, value)
+        self.ring[self.pos] = value
+        self.pos = (self.pos + 1) % self.window
+
+    def add(self, value: int, now_ns: int):
+        self._insert(value)
+
+    def median(self) -> int:
+        values = self.sorted
+        count = len(values)
+        if count <= 0:
+            return 0
+        middle = count // 2
+        return values[middle] if count % 2 else round_div(values[middle - 1] + values[middle], 2)
+
+    def count_within(self, median: int, distance: int) -> int:
+        """The number of readings in the window no more than distance from median"""
+        return bisect_right(self.sorted, median + distance) - bisect_left(self.sorted, median - distance)
+
+    def value(self) -> int:
+        return self.median()
+
+    def clear(self):
+        self.sorted.clear()
+        self.pos = 0
+
+
+class HampelSmoother(MedianSmoother):
+    """A Hampel filter followed by a mean - readings more than threshold scaled median absolute deviations from the
+    median of the window are replaced by that median before being averaged"""
+    __slots__ = ('threshold', 'limit_scale', 'cleaned', 'cleaned_sum')
+
+    MIN_READINGS = 5  # Readings needed before anything is treated as an outlier
+    MAD_SCALE = 1.4826  # Scales the MAD to a standard deviation, for normally distributed readings
+    MIN_DEVIATION = 1  # Readings are integers, so a window of identical readings still allows +/- 1 * threshold
+
+    def __init__(self, window: int, threshold: float):
+        super().__init__(window)
+        self.threshold = threshold  # type: float
+        # A reading is an outlier if its distance from the median is more than this many MADs
+        self.limit_scale = threshold * self.MAD_SCALE  # type: float
+        self.cleaned = array('H', bytes(2 * window))  # type: array
+        self.cleaned_sum = 0  # type: int
+
+    def add(self, value: int, now_ns: int):
+        cleaned = value
+        if len(self.sorted) >= self.MIN_READINGS:
+            median = self.median()
+            distance = abs(value - median)
+            if distance > self.threshold * self.MIN_DEVIATION and self._mad_below(median, distance / self.limit_scale):
+                cleaned = median
+                metrics.hydrometer_outliers.value += 1
+
+        pos = self.pos
+        if len(self.sorted) >= self.window:
+            self.cleaned_sum -= self.cleaned[pos]
+        self.cleaned[pos] = cleaned
+        self.cleaned_sum += cleaned
+        # The raw reading still goes into the window, so a genuine step change is accepted once it is the majority
+        self._insert(value)
+
+    def _mad_below(self, median: int, limit: float) -> bool:
+        """Returns true if the median absolute deviation of the window (from median) is less than limit. Readings are
+        integers, so this is true if at least half of them are within the largest integer distance below limit - which
+        is two binary searches, rather than finding the MAD itself."""
+        distance = math.ceil(limit) - 1
+        return distance >= 0 and self.count_within(median, distance) >= (len(self.sorted) - 1) // 2 + 1
+
+    def value(self) -> int:
+        return round_div(self.cleaned_sum, len(self.sorted))
+
+    def clear(self):
+        super().clear()
+        self.cleaned_sum = 0
+
+
+class Strategy:
+    """How a hydrometer's readings are smoothed"""
+    __slots__ = ('name', 'window', 'seconds', 'threshold')
+
+    NAMES = ('mean', 'time', 'ewma', 'median', 'hampel')
+
+    def __init__(self, name: str = 'mean', window: int = 60, seconds: float = 300, threshold: float = 3):
+        if name not in self.NAMES:
+            raise ValueError(f"Unknown smoothing strategy {name} - expected one of {', '.join(self.NAMES)}")
+        self.name = name  # type: str
+        # The number of readings to smooth over (mean, median and hampel), or the span of time (time and ewma)
+        self.window = window  # type: int
+        self.seconds = seconds  # type: float
+        # How many (scaled) median absolute deviations from the median a reading can be before it's an outlier (hampel)
+        self.threshold = threshold  # type: float
+
+    def __eq__(self, other):
+        return isinstance(other, Strategy) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def _key(self) -> tuple:
+        # Only the parameters the strategy uses - and always the window, which apply() passes on to the hydrometer
+        if self.name in ('time', 'ewma'):
+            return self.name, self.window, self.seconds
+        if self.name == 'hampel':
+            return self.name, self.window, self.threshold
+        return self.name, self.window
+
+    def __str__(self):
+        if self.name in ('time', 'ewma'):
+            return f"{self.name} ({self.seconds:g}s)"
+        return f"{self.name} ({self.window} readings)"
+
+    def create(self) -> Optional[Smoother]:
+        """A new smoother for one of a hydrometer's readings, or None for TiltHydrometer's built-in mean"""
+        if self.name == 'time':
+            return TimeWindowSmoother(int(self.seconds * 1e9))
+        if self.name == 'ewma':
+            return EWMASmoother(int(self.seconds * 1e9))
+        if self.name == 'median':
+            return MedianSmoother(self.window)
+        if self.name == 'hampel':
+            return HampelSmoother(self.window, self.threshold)
+        return None
+
+    def apply(self, tilt: TiltHydrometer, keep_readings: bool = False):
+        """Set up a (newly created) hydrometer to smooth its readings with this strategy. To switch a hydrometer that
+        is already in use over to it, set keep_readings to start from the readings in its current window."""
+        tilt.set_smoothing(self.window, self.create(), self.create(), keep_readings)
+        if self.name in ('time', 'ewma'):
+            # A reading this old no longer counts for much of anything
+            tilt.cache_expiry_ns = max(tilt.cache_expiry_ns, int(self.seconds * 2e9))
+
+
+class SmoothingConfig:
+    """The smoothing strategy for each hydrometer color"""
+
+    def __init__(self, default: Strategy = None, colors: Optional[Dict[str, Strategy]] = None):
+        self.default = default or Strategy()  # type: Strategy
+        self.colors = colors or {}  # type: Dict[str, Strategy]
+
+    def strategy_for(self, color: str) -> Strategy:
+        return self.colors.get(color, self.default)
+
+
+def config_from_env() -> SmoothingConfig:
+    """Read the smoothing strategy from TILTBRIDGE_JR_SMOOTHING (or TILTBRIDGE_JR_SMOOTHING_<COLOR> for a single color),
+    with its parameters from TILTBRIDGE_JR_SMOOTHING_WINDOW/_SECONDS and TILTBRIDGE_JR_OUTLIER_THRESHOLD"""
+    window_env = os.environ.get("TILTBRIDGE_JR_SMOOTHING_WINDOW")
+    seconds_env = os.environ.get("TILTBRIDGE_JR_SMOOTHING_SECONDS")
+    threshold_env = os.environ.get("TILTBRIDGE_JR_OUTLIER_THRESHOLD")
+    window = int(window_env) if window_env else 60
+    seconds = float(seconds_env) if seconds_env else 300
+    threshold = float(threshold_env) if threshold_env else 3
+
+    def strategy(env_var: str) -> Optional[Strategy]:
+        name = os.environ.get(env_var)
+        if not name:
+            return None
+        try:
+            return Strategy(name.lower(), window, seconds, threshold)
+        except ValueError as e:
+            LOG.error(f"{env_var}: {e}")
+            return None
+
+    config = SmoothingConfig(strategy("TILTBRIDGE_JR_SMOOTHING") or Strategy('mean', window, seconds, threshold))
+    for color in TiltHydrometer.tilt_colors:
+        color_strategy = strategy(f"TILTBRIDGE_JR_SMOOTHING_{color.upper()}")
+        if color_strategy is not None:
+            config.colors[color] = color_strategy
+    LOG.info(f"Smoothing readings with {config.default}" +
+             "".join(f", {color} with {strategy}" for color, strategy in config.colors.items()))
+    return config
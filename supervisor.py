@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Callable, Coroutine, List, Optional
+
+LOG = logging.getLogger("tilt")
+
+# Child processes are started with spawn rather than fork - by the time the supervisor starts, Sentry has started its
+# background threads, and forking a process with threads running can leave the child deadlocked on a lock one of them
+# held.
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+class SupervisedProcess:
+    """A child process that is restarted if it exits, or if it stops sending heartbeats"""
+
+    def __init__(self, name: str, target: Callable, args: tuple = (), heartbeat: Callable[[], int] or None = None,
+                 on_restart: Callable[[], None] or None = None):
+        self.name = name  # type: str
+        self.target = target  # type: Callable
+        self.args = args  # type: tuple
+        # Returns the time.monotonic_ns() of the process's last heartbeat (0 if it hasn't sent one). If None, the
+        # process is only restarted if it exits.
+        self.heartbeat = heartbeat  # type: Callable[[], int] or None
+        self.on_restart = on_restart  # type: Callable[[], None] or None
+        self.process = None  # type: multiprocessing.Process or None
+        self.started_ns = 0  # type: int
+        self.failures = 0  # type: int  # Failures in a row, each without running long enough to be considered stable
+        self.restart_at_ns = 0  # type: int
+
+    def start(self):
+        self.process = CONTEXT.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        self.started_ns = time.monotonic_ns()
+
+    def problem(self, now_ns: int, heartbeat_timeout_ns: int) -> Optional[str]:
+        """Returns why the process needs restarting, or None if it's healthy"""
+        if not self.process.is_alive():
+            return f"exited with code {self.process.exitcode}"
+        if self.heartbeat is not None:
+            # A heartbeat from before the process started was sent by the one it replaced
+            silent_ns = now_ns - max(self.heartbeat(), self.started_ns)
+            if silent_ns > heartbeat_timeout_ns:
+                return f"hasn't sent a heartbeat for {silent_ns / 1e9:.0f} seconds"
+        return None
+
+    def signal(self, signum: int):
+        if self.process is not None and self.process.is_alive():
+            os.kill(self.process.pid, signum)
+
+    def terminate(self):
+        """Ask the process to shut down (see run_until_terminated)"""
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+    def stop(self, timeout: float):
+        """Shut the process down, killing it if it hasn't exited within timeout seconds"""
+        self.terminate()
+        self.wait(timeout)
+
+    def wait(self, timeout: float):
+        """Wait for the process to exit after terminate(), killing it if it hasn't within timeout seconds"""
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            LOG.error(f"{self.name} process didn't shut down within {timeout} seconds - killing it")
+            self.process.kill()
+            self.process.join()
+        self.process = None
+
+
+class Supervisor:
+    """Starts a set of child processes, and keeps them running until the supervisor is interrupted (SIGINT) or
+    terminated (SIGTERM), at which point they are shut down. SIGHUP is passed on to every process (to reload the
+    configuration).
+
+    A process that exits or stops sending heartbeats is stopped and started again. A process that keeps failing is
+    restarted with an increasing delay (up to MAX_RESTART_DELAY), so a persistent problem - e.g. a missing bluetooth
+    adapter - doesn't become a tight restart loop."""
+
+    CHECK_INTERVAL = 1  # seconds
+    HEARTBEAT_TIMEOUT = 30  # seconds
+    STOP_TIMEOUT = 10  # seconds to wait for a process to shut down cleanly before killing it
+    MAX_RESTART_DELAY = 60  # seconds
+    STABLE_AFTER = 60  # seconds - a process that ran for at least this long before failing is restarted immediately
+
+    def __init__(self, processes: List[SupervisedProcess]):
+        self.processes = processes  # type: List[SupervisedProcess]
+
+    def check(self, now_ns: int or None = None):
+        """Restart any process that has failed, or start any process whose restart delay has passed"""
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        for child in self.processes:
+            if child.process is None:
+                if now_ns >= child.restart_at_ns:
+                    child.start()
+                continue
+
+            problem = child.problem(now_ns, int(self.HEARTBEAT_TIMEOUT * 1e9))
+            if problem is None:
+                continue
+            if now_ns - child.started_ns >= self.STABLE_AFTER * 10 ** 9:
+                child.failures = 0
+            child.failures += 1
+            # Restart straight away the first time, then after 1, 2, 4... seconds
+            delay = 0 if child.failures <= 1 else min(2 ** (child.failures - 2), self.MAX_RESTART_DELAY)
+            LOG.error(f"{child.name} process {problem} - restarting it" + (f" in {delay} seconds" if delay else ""))
+            child.stop(self.STOP_TIMEOUT)
+            if child.on_restart is not None:
+                child.on_restart()
+            child.restart_at_ns = now_ns + delay * 10 ** 9
+            if delay <= 0:
+                child.start()
+
+    def stop(self):
+        # Ask every process to shut down before waiting for any of them, so they shut down in parallel
+        for child in self.processes:
+            child.terminate()
+        for child in self.processes:
+            child.wait(self.STOP_TIMEOUT)
+
+    def run(self):
+        """Run (and supervise) the processes until interrupted or terminated"""
+        # Turn SIGTERM (e.g. from docker stop) into an exception, so the processes are shut down rather than orphaned
+        previous_handler = signal.signal(signal.SIGTERM, _raise_system_exit)
+        previous_hup_handler = signal.signal(signal.SIGHUP, self._forward_signal)
+        try:
+            for child in self.processes:
+                child.start()
+            while True:
+                time.sleep(self.CHECK_INTERVAL)
+                self.check()
+        except KeyboardInterrupt:
+            LOG.info('Keyboard interrupt')
+        finally:
+            LOG.debug('Stopping child processes')
+            self.stop()
+            signal.signal(signal.SIGTERM, previous_handler)
+            signal.signal(signal.SIGHUP, previous_hup_handler)
+
+    def _forward_signal(self, signum, frame):
+        for child in self.processes:
+            child.signal(signum)
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def run_until_terminated(coro: Coroutine):
+    """Run a coroutine as the main function of a supervised child process. SIGTERM (sent by the supervisor to shut the
+    process down) or SIGINT cancels the coroutine, so that it can clean up after itself."""
+    async def main():
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        cancelled = False
+
+        def cancel():
+            # Only cancel once - a second signal (e.g. SIGTERM from the supervisor following a Ctrl-C that reached every
+            # process) mustn't interrupt the clean up
+            nonlocal cancelled
+            if not cancelled:
+                cancelled = True
+                task.cancel()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, cancel)
+        try:
+            await coro
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    # Nothing is left to clean up, so the process can just exit
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
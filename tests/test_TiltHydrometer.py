@@ -1,6 +1,7 @@
 import unittest
 from decimal import Decimal
-from datetime import datetime, timedelta
+import time
+from unittest import mock
 from collections import deque
 from TiltHydrometer import TiltHydrometer
 
@@ -15,7 +16,7 @@ class TiltHydrometerTests(unittest.TestCase):
         self.assertEqual(self.tilt.smoothing_window, 60)
         self.assertIsInstance(self.tilt.gravity_list, deque)
         self.assertIsInstance(self.tilt.temp_list, deque)
-        self.assertIsInstance(self.tilt.last_value_received, datetime)
+        self.assertIsInstance(self.tilt.last_value_received_ns, int)
         self.assertEqual(self.tilt.raw_gravity, Decimal(0.0))
         self.assertEqual(self.tilt.raw_temp, Decimal(0.0))
         self.assertEqual(self.tilt.gravity, Decimal(0.0))
@@ -30,12 +31,33 @@ class TiltHydrometerTests(unittest.TestCase):
     def test_expired(self):
         self.assertTrue(self.tilt.expired())  # Tilts should be expired when first generated
 
-        self.tilt.last_value_received = datetime.now()
+        self.tilt.last_value_received_ns = time.monotonic_ns()
         self.assertFalse(self.tilt.expired())  # Tilts should not be expired if they have been updated recently
 
-        self.tilt.last_value_received = datetime.now() - timedelta(hours=24)
+        self.tilt.last_value_received_ns = time.monotonic_ns() - 24 * 3600 * 10 ** 9
         self.assertTrue(self.tilt.expired())  # Tilts should be expired if not updated recently
 
+    def test_expiry_threshold(self):
+        with mock.patch('time.monotonic_ns', return_value=10 ** 12):
+            self.tilt.process_decoded_values(1050, 68, -80, 197)
+        self.assertEqual(self.tilt.cache_expiry_ns, 288 * 10 ** 9)  # 60 readings * 1.2 * 4 seconds
+        self.assertFalse(self.tilt.expired(10 ** 12 + self.tilt.cache_expiry_ns - 1))
+        self.assertTrue(self.tilt.expired(10 ** 12 + self.tilt.cache_expiry_ns))
+
+    def test_wall_clock_steps_dont_expire(self):
+        # e.g. NTP stepping the clock on a freshly booted Pi, which has no real-time clock. The wall clock (in both of
+        # the forms the time module reads it) jumps back and forth while the monotonic clock stands still.
+        now_ns = time.monotonic_ns()
+        with mock.patch('time.monotonic_ns', return_value=now_ns):
+            self.tilt.process_decoded_values(1050, 68, -80, 197)
+            for readings, step in enumerate((-24 * 3600, 24 * 3600), start=2):
+                wall_clock = time.time() + step
+                with mock.patch('time.time', return_value=wall_clock), \
+                        mock.patch('time.time_ns', return_value=int(wall_clock * 10 ** 9)):
+                    self.assertFalse(self.tilt.expired())
+                    self.tilt.process_decoded_values(1051, 68, -80, 197)
+                    self.assertEqual(len(self.tilt.gravity_list), readings)  # The smoothing window wasn't cleared
+
     def test_process_decoded_values_non_pro(self):
         gravity = 1242  # Not a Tilt Pro
         temp = 72  # Not a Tilt Pro
@@ -63,17 +85,103 @@ class TiltHydrometerTests(unittest.TestCase):
         self.assertFalse(self.tilt.sends_battery)  # Since 197 should not have been received at amy point
 
     def test_smoothed_gravity(self):
-        gravity_list = deque([1000, 2000, 3000])
-        self.tilt.gravity_list = gravity_list
-        expected_average = Decimal(sum(gravity_list)) / len(gravity_list)
+        gravity_list = [1000, 2000, 3000]  # Raw sensor values - 1.000, 2.000, 3.000
+        for gravity in gravity_list:
+            self.tilt.process_decoded_values(gravity, 68, -80, 197)
+        expected_average = Decimal(sum(gravity_list)) / 1000 / len(gravity_list)
         self.assertEqual(self.tilt.smoothed_gravity(), expected_average.quantize(Decimal('.001')))
 
     def test_smoothed_temp(self):
-        temp_list = deque([65, 68, 70])
-        self.tilt.temp_list = temp_list
+        temp_list = [65, 68, 70]
+        for temp in temp_list:
+            self.tilt.process_decoded_values(1050, temp, -80, 197)
         expected_average = Decimal(sum(temp_list)) / len(temp_list)
         self.assertEqual(self.tilt.smoothed_temp(), expected_average.quantize(Decimal('1.')))
 
+    def test_smoothed_values_pro(self):
+        for gravity, temp in [(10451, 681), (10452, 682), (10452, 684)]:
+            self.tilt.process_decoded_values(gravity, temp, -80, 197)
+        self.assertEqual(str(self.tilt.smoothed_gravity()), '1.0452')
+        self.assertEqual(str(self.tilt.smoothed_temp()), '68.2')
+
+    def test_smoothed_values_match_decimal_mean(self):
+        """The running sum needs to give exactly the same result as averaging the Decimal values in the window,
+        including after values have been evicted from the window"""
+        gravity_values = [1040 + (x * 7) % 23 for x in range(self.tilt.smoothing_window * 2)]
+        for gravity in gravity_values:
+            self.tilt.process_decoded_values(gravity, 68, -80, 197)
+
+        window = [Decimal(x) / 1000 for x in gravity_values[-self.tilt.smoothing_window:]]
+        expected_average = (sum(window) / len(window)).quantize(Decimal('.001'))
+        self.assertEqual(self.tilt.smoothed_gravity(), expected_average)
+        self.assertEqual(self.tilt.gravity_sum, sum(gravity_values[-self.tilt.smoothing_window:]))
+
+    def test_smoothed_values_empty(self):
+        self.assertEqual(str(self.tilt.smoothed_gravity()), '0.000')
+        self.assertEqual(str(self.tilt.smoothed_temp()), '0')
+
+    def test_switching_to_pro_clears_lists(self):
+        self.tilt.process_decoded_values(1050, 68, -80, 197)
+        self.tilt.process_decoded_values(10500, 680, -80, 197)
+        self.assertEqual(len(self.tilt.gravity_list), 1)
+        self.assertEqual(self.tilt.gravity_sum, 10500)
+
+    def test_smoothing_window_wraps(self):
+        """Once the window is full, the oldest values should be evicted from both the window and the running sum"""
+        for gravity in range(1000, 1000 + self.tilt.smoothing_window + 5):
+            self.tilt.process_decoded_values(gravity, 68, -80, 197)
+        expected = list(range(1005, 1000 + self.tilt.smoothing_window + 5))
+        self.assertEqual(list(self.tilt.gravity_list), expected)
+        self.assertEqual(self.tilt.gravity_sum, sum(expected))
+        self.assertEqual(self.tilt.temp_sum, 68 * self.tilt.smoothing_window)
+
+    def test_expired_clears_window(self):
+        self.tilt.process_decoded_values(1050, 68, -80, 197)
+        self.tilt.last_value_received_ns = time.monotonic_ns() - 24 * 3600 * 10 ** 9
+        self.tilt.process_decoded_values(1060, 70, -80, 197)
+        self.assertEqual(list(self.tilt.gravity_list), [1060])
+        self.assertEqual(self.tilt.smoothed_gravity(), Decimal('1.060'))
+
+    def test_to_dict_scales_on_serialization(self):
+        self.tilt.process_decoded_values(4000, 72, -80, 197)
+        tilt_dict = self.tilt.to_dict()
+        self.assertEqual(tilt_dict['raw_gravity'], '4')  # Same as str(Decimal(4000) / 1000)
+        self.assertEqual(tilt_dict['raw_temp'], '72')
+        self.assertEqual(tilt_dict['smoothed_gravity'], '4.000')
+        self.assertEqual(tilt_dict['smoothed_temp'], '72')
+
+    def test_to_dict_cached_until_new_reading(self):
+        self.tilt.process_decoded_values(1050, 68, -80, 197)
+        tilt_dict = self.tilt.to_dict()
+        self.assertIs(self.tilt.to_dict(), tilt_dict)
+        self.assertIs(self.tilt.to_json(), self.tilt.to_json())
+
+        self.tilt.process_decoded_values(1051, 68, -80, 197)
+        self.assertIsNot(self.tilt.to_dict(), tilt_dict)
+        self.assertEqual(self.tilt.to_dict()['raw_gravity'], '1.051')
+
+    def test_to_dict_not_cached_across_smoothing_change(self):
+        for gravity in (1050, 1052, 1060):
+            self.tilt.process_decoded_values(gravity, 68, -80, 197)
+        tilt_json = self.tilt.to_json()
+        self.assertEqual(self.tilt.to_dict()['smoothed_gravity'], '1.054')
+
+        version = self.tilt.version
+        self.tilt.set_smoothing(2, keep_readings=True)
+        self.assertGreater(self.tilt.version, version)
+        self.assertEqual(self.tilt.to_dict()['smoothing_window'], 2)
+        self.assertEqual(self.tilt.to_dict()['smoothed_gravity'], '1.056')
+        self.assertIsNot(self.tilt.to_json(), tilt_json)
+
+    def test_to_json(self):
+        import json
+        self.tilt.process_decoded_values(10500, 680, -80, 197)
+        self.assertEqual(json.loads(self.tilt.to_json()), self.tilt.to_dict())
+
+    def test_no_instance_dict(self):
+        # TiltHydrometer uses __slots__ to keep the per-hydrometer footprint small
+        self.assertFalse(hasattr(self.tilt, '__dict__'))
+
     def test_color_lookup(self):
         # self.assertEqual(TiltHydrometer.color_lookup(self.color), 'Red')
         uuid_with_dash = 'a495bb10-c5b1-4b44-b512-1370f02d74de'
@@ -0,0 +1,30 @@
+import unittest
+
+from beacon_dedup import BeaconDeduplicator
+
+
+class BeaconDeduplicatorTests(unittest.TestCase):
+    def setUp(self):
+        self.deduplicator = BeaconDeduplicator(window=0.25)
+
+    def test_repeat_within_window_is_duplicate(self):
+        self.assertFalse(self.deduplicator.is_duplicate(('mac', 1050), now=100.0))
+        self.assertTrue(self.deduplicator.is_duplicate(('mac', 1050), now=100.1))
+        # A different reading (or a different Tilt) isn't a duplicate
+        self.assertFalse(self.deduplicator.is_duplicate(('mac', 1051), now=100.1))
+        self.assertFalse(self.deduplicator.is_duplicate(('other mac', 1050), now=100.1))
+
+    def test_repeat_after_window_is_not_duplicate(self):
+        """A Tilt broadcasts the same reading repeatedly - those broadcasts are separate readings"""
+        self.assertFalse(self.deduplicator.is_duplicate(('mac', 1050), now=100.0))
+        self.assertFalse(self.deduplicator.is_duplicate(('mac', 1050), now=101.0))
+        self.assertTrue(self.deduplicator.is_duplicate(('mac', 1050), now=101.1))
+
+    def test_old_entries_are_expired(self):
+        for x in range(100):
+            self.deduplicator.is_duplicate(('mac', x), now=100.0 + x)
+        self.assertEqual(len(self.deduplicator), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from beacon_ring import BeaconRing, INGEST_COUNTERS
+from supervisor import CONTEXT
+
+YELLOW = bytes.fromhex('a495bb70c5b14b44b5121370f02d74de')
+MAC = b'\xc9\xf7\xd0\xcf\x7a\xdf'
+
+
+def frame(gravity: int) -> tuple:
+    return YELLOW, MAC, 728, gravity, 197, -65
+
+
+def write_frames(ring_name: str, count: int):
+    """Writes count beacons into the ring from another process, retrying whenever the ring is full"""
+    ring = BeaconRing.attach(ring_name)
+    for gravity in range(count):
+        while not ring.put(frame(gravity)):
+            pass
+    ring.beat('writer')
+    ring.close()
+
+
+class BeaconRingTests(unittest.TestCase):
+    def setUp(self):
+        self.ring = BeaconRing.create(8)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_put_and_read(self):
+        self.assertEqual(self.ring.read(), [])
+        self.assertTrue(self.ring.put(frame(10345)))
+        self.assertTrue(self.ring.put(frame(10346)))
+        self.assertEqual(len(self.ring), 2)
+        self.assertEqual(self.ring.read(), [frame(10345), frame(10346)])
+        self.assertEqual(len(self.ring), 0)
+
+    def test_wraps_around(self):
+        for batch in range(5):
+            for gravity in range(5):
+                self.ring.put(frame(batch * 10 + gravity))
+            self.assertEqual([f[3] for f in self.ring.read()], [batch * 10 + gravity for gravity in range(5)])
+
+    def test_full_ring_drops_new_beacons(self):
+        for gravity in range(10):
+            self.ring.put(frame(gravity))
+        self.assertEqual(self.ring.overflows, 2)
+        self.assertEqual([f[3] for f in self.ring.read()], list(range(8)))
+        self.assertTrue(self.ring.put(frame(100)))
+
+    def test_attach(self):
+        self.ring.put(frame(1))
+        self.ring.publish_counters(tuple(range(len(INGEST_COUNTERS))))
+        reader = BeaconRing.attach(self.ring.name)
+        try:
+            self.assertEqual(reader.capacity, 8)
+            self.assertEqual(reader.read(), [frame(1)])
+            self.assertEqual(reader.counters(), tuple(range(len(INGEST_COUNTERS))))
+            # A reader that attaches later (e.g. a restarted pipeline process) picks up where the last one left off
+            reader.close()
+            self.ring.put(frame(2))
+            reader = BeaconRing.attach(self.ring.name)
+            self.assertEqual(reader.read(), [frame(2)])
+        finally:
+            reader.close()
+
+    def test_capacity_must_be_power_of_two(self):
+        with self.assertRaises(ValueError):
+            BeaconRing.create(100)
+
+    def test_across_processes(self):
+        writer = CONTEXT.Process(target=write_frames, args=(self.ring.name, 100))
+        writer.start()
+        received = []
+        while writer.is_alive() or len(self.ring) > 0:
+            received.extend(self.ring.read())
+        writer.join()
+        self.assertEqual([f[3] for f in received], list(range(100)))
+        self.assertEqual(received[0], frame(0))
+        self.assertGreater(self.ring.heartbeat('writer'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiounittest import AsyncTestCase
+
+import ble_capture
+import tilt_decoder
+from tiltbridge_junior import decode_with_aioblescan
+
+
+class BLECaptureTests(AsyncTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.capture_path = os.path.join(self.temp_dir.name, 'capture.bin')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_capture_round_trip(self):
+        frames = list(ble_capture.synthetic_frames(200))
+        writer = ble_capture.CaptureWriter(self.capture_path)
+        for timestamp_ns, frame in frames:
+            writer.write(frame, timestamp_ns)
+        writer.close()
+
+        self.assertEqual(writer.frames_written, 200)
+        self.assertEqual(list(ble_capture.read_capture(self.capture_path)), frames)
+
+    def test_read_truncated_capture(self):
+        """A capture cut off mid-record (e.g. the daemon was killed) should return every complete record"""
+        frames = list(ble_capture.synthetic_frames(10))
+        writer = ble_capture.CaptureWriter(self.capture_path)
+        for timestamp_ns, frame in frames:
+            writer.write(frame, timestamp_ns)
+        writer.close()
+        with open(self.capture_path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.capture_path) - 5)
+
+        self.assertEqual(list(ble_capture.read_capture(self.capture_path)), frames[:-1])
+
+    def test_read_invalid_capture(self):
+        with open(self.capture_path, 'wb') as f:
+            f.write(b'not a capture file')
+        with self.assertRaises(ValueError):
+            list(ble_capture.read_capture(self.capture_path))
+
+    def test_recording_wrapper(self):
+        processed = []
+        writer = ble_capture.CaptureWriter(self.capture_path)
+        process = writer.recording(processed.append)
+        process(b'\x04\x3e\x01\x02')
+        writer.close()
+
+        self.assertEqual(processed, [b'\x04\x3e\x01\x02'])
+        self.assertEqual([frame for _, frame in ble_capture.read_capture(self.capture_path)], [b'\x04\x3e\x01\x02'])
+
+    def test_synthetic_frames_are_deterministic(self):
+        self.assertEqual(list(ble_capture.synthetic_frames(100, seed=3)),
+                         list(ble_capture.synthetic_frames(100, seed=3)))
+
+    def test_synthetic_frames_decode(self):
+        """Synthetic frames should be a mix of Tilts and noise, and decode the same through both decoders"""
+        tilt_frames = 0
+        for _, frame in ble_capture.synthetic_frames(1000, tilt_fraction=0.2):
+            decoded = tilt_decoder.decode_tilt_frame(frame)
+            self.assertEqual(decoded, decode_with_aioblescan(frame))
+            if decoded is not None:
+                tilt_frames += 1
+        self.assertGreater(tilt_frames, 100)
+        self.assertLess(tilt_frames, 300)
+
+    async def test_replay(self):
+        processed = []
+        frames = list(ble_capture.synthetic_frames(250))
+        replayed = await ble_capture.replay(frames, processed.append)
+        self.assertEqual(replayed, 250)
+        self.assertEqual(processed, [frame for _, frame in frames])
+
+    async def test_replay_realtime(self):
+        processed = []
+        # 5 frames at 100 frames/sec should take at least 40ms to replay at the recorded pace
+        frames = list(ble_capture.synthetic_frames(5, frames_per_second=100))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await ble_capture.replay(frames, processed.append, realtime=True)
+        self.assertGreaterEqual(loop.time() - start, 0.035)
+        self.assertEqual(len(processed), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+import ble_scanner
+import metrics
+from ble_scanner import Scanner, ScanWatchdog
+
+SECOND = 10 ** 9
+FRAME = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
+
+
+class FakeRequester:
+    """Stands in for aioblescan's BLEScanRequester"""
+
+    def __init__(self, adapter: 'FakeAdapter'):
+        self.adapter = adapter
+        self.process = None
+        self.scan_requests = 0
+
+    async def send_scan_request(self):
+        if not self.adapter.responding:
+            await asyncio.Event().wait()
+        self.scan_requests += 1
+
+    async def stop_scan_request(self):
+        pass
+
+    async def send_command(self, command):
+        pass
+
+    def data_received(self, packet: bytes):
+        self.process(packet)
+
+
+class FakeTransport:
+    """Delivers a frame to its requester every interval seconds (if interval is set) until the adapter stalls"""
+
+    def __init__(self, adapter: 'FakeAdapter', requester: FakeRequester, interval: float or None):
+        self.adapter = adapter
+        self.requester = requester
+        self.closed = False
+        self.handle = None
+        if interval is not None:
+            self.handle = asyncio.get_running_loop().call_later(interval, self.emit_every, interval)
+
+    def emit(self):
+        if not self.closed and not self.adapter.stalled:
+            self.requester.data_received(FRAME)
+
+    def emit_every(self, interval: float):
+        self.emit()
+        self.handle = asyncio.get_running_loop().call_later(interval, self.emit_every, interval)
+
+    def close(self):
+        self.closed = True
+        if self.handle is not None:
+            self.handle.cancel()
+
+
+class FakeAdapter:
+    """A bluetooth adapter that can stop delivering frames (stalled), stop answering commands (responding), or fail to
+    open"""
+
+    def __init__(self, interval: float or None = None):
+        self.interval = interval
+        self.stalled = False
+        self.responding = True
+        self.failed_opens = 0  # Opens to fail before succeeding
+        self.opens = 0
+        self.transport = None  # type: FakeTransport or None
+
+    async def open(self, scanner):
+        self.opens += 1
+        if self.failed_opens > 0:
+            self.failed_opens -= 1
+            raise OSError(19, "No such device")
+        requester = FakeRequester(self)
+        self.transport = FakeTransport(self, requester, self.interval)
+        return self.transport, requester
+
+
+class BLEScannerTests(AsyncTestCase):
+    def test_parse_devices(self):
+        self.assertEqual(ble_scanner.parse_devices(None), [0])
+        self.assertEqual(ble_scanner.parse_devices("1"), [1])
+        self.assertEqual(ble_scanner.parse_devices("0, 1,"), [0, 1])
+
+    async def test_missing_adapter_doesnt_stop_others(self):
+        async def start(scanner):
+            if scanner.device == 1:
+                raise OSError(19, "No such device")
+
+        with mock.patch.object(ble_scanner.Scanner, 'start', start):
+            scanners = await ble_scanner.start_scanners([0, 1, 2], print)
+
+        self.assertEqual([scanner.device for scanner in scanners], [0, 2])
+        self.assertTrue(all(scanner.process is print for scanner in scanners))
+
+
+class ScanWatchdogTests(AsyncTestCase):
+    def setUp(self):
+        self.frames = []
+        self.adapter = FakeAdapter()
+        patcher = mock.patch.object(Scanner, '_open_transport', lambda scanner: self.adapter.open(scanner))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def start_watchdog(self, stall_timeout: float = 30):
+        self.scanner = Scanner(0, self.frames.append)
+        await self.scanner.start()
+        self.watchdog = ScanWatchdog([self.scanner], stall_timeout)
+        return self.scanner.progress_ns
+
+    async def test_rescans_then_reopens_stalled_adapter(self):
+        rescans, reopens = metrics.scan_rescans.value, metrics.scan_reopens.value
+        now_ns = await self.start_watchdog()
+        self.adapter.transport.emit()
+        await self.watchdog.check(now_ns + 10 * SECOND)
+        self.assertEqual(self.frames, [FRAME])
+
+        # The adapter stops delivering frames
+        self.adapter.stalled = True
+        first_transport = self.adapter.transport
+        await self.watchdog.check(now_ns + 39 * SECOND)
+        self.assertEqual(first_transport.requester.scan_requests, 1)
+        with self.assertLogs("tilt", "WARNING") as logs:
+            await self.watchdog.check(now_ns + 40 * SECOND)
+        self.assertIn("No frames received on hci0 for 30 seconds - re-sending the scan request", logs.output[0])
+        self.assertEqual(first_transport.requester.scan_requests, 2)
+        self.assertEqual(metrics.scan_rescans.value, rescans + 1)
+
+        with self.assertLogs("tilt", "WARNING") as logs:
+            await self.watchdog.check(now_ns + 70 * SECOND)
+        self.assertIn("Still no frames received on hci0 - reopening it", logs.output[0])
+        self.assertTrue(first_transport.closed)
+        self.assertEqual(self.adapter.opens, 2)
+        self.assertEqual(metrics.scan_reopens.value, reopens + 1)
+
+        # Frames from the new socket go to the same place as before
+        self.adapter.stalled = False
+        self.adapter.transport.emit()
+        self.assertEqual(self.frames, [FRAME, FRAME])
+        await self.watchdog.check(now_ns + 80 * SECOND)
+        self.assertEqual(self.scanner.failures, 0)
+
+    async def test_backs_off_when_adapter_keeps_stalling(self):
+        now_ns = await self.start_watchdog()
+        self.adapter.stalled = True
+        with self.assertLogs("tilt", "WARNING"):
+            for seconds in (30, 60):
+                await self.watchdog.check(now_ns + seconds * SECOND)
+        self.assertEqual(self.adapter.opens, 2)
+
+        # Reopened at 60s, so the next attempt waits until 120s - the scan is requested again then, and reopened at 150s
+        await self.watchdog.check(now_ns + 119 * SECOND)
+        with self.assertLogs("tilt", "WARNING"):
+            for seconds in (120, 150):
+                await self.watchdog.check(now_ns + seconds * SECOND)
+        self.assertEqual(self.adapter.opens, 3)
+
+        # ...and now it waits twice as long (120s) before trying again
+        await self.watchdog.check(now_ns + 269 * SECOND)
+        self.assertEqual(self.adapter.transport.requester.scan_requests, 1)
+        with self.assertLogs("tilt", "WARNING"):
+            for seconds in (270, 300):
+                await self.watchdog.check(now_ns + seconds * SECOND)
+        self.assertEqual(self.adapter.opens, 4)
+
+    async def test_retries_adapter_that_couldnt_be_opened(self):
+        self.adapter.failed_opens = 2
+        with self.assertLogs("tilt", "ERROR"):
+            scanners = await ble_scanner.start_scanners([0], self.frames.append, include_failed=True)
+        self.assertFalse(scanners[0].running)
+        watchdog = ScanWatchdog(scanners)
+        now_ns = scanners[0].progress_ns
+
+        with self.assertLogs("tilt", "ERROR") as logs:
+            await watchdog.check(now_ns)
+        self.assertIn("Unable to reopen hci0 - [Errno 19] No such device. Retrying in 60 seconds", logs.output[0])
+        await watchdog.check(now_ns + 59 * SECOND)
+        self.assertEqual(self.adapter.opens, 2)
+        await watchdog.check(now_ns + 60 * SECOND)
+        self.assertEqual(self.adapter.opens, 3)
+        self.assertTrue(scanners[0].running)
+
+    async def test_start_times_out_if_adapter_doesnt_respond(self):
+        self.adapter.responding = False
+        scanner = Scanner(0, self.frames.append)
+        with mock.patch.object(Scanner, 'START_TIMEOUT', 0.01):
+            with self.assertRaises(OSError):
+                await scanner.start()
+        self.assertFalse(scanner.running)
+        self.assertTrue(self.adapter.transport.closed)
+
+    async def test_run_restarts_stalled_scan(self):
+        self.adapter.interval = 0.005
+        await self.start_watchdog(stall_timeout=0.05)
+        self.watchdog.CHECK_INTERVAL = 0.01
+        task = asyncio.create_task(self.watchdog.run())
+        try:
+            await asyncio.sleep(0.05)
+            self.assertGreater(len(self.frames), 0)
+            self.adapter.stalled = True
+            with self.assertLogs("tilt", "WARNING"):
+                for _ in range(200):
+                    await asyncio.sleep(0.01)
+                    if self.adapter.opens >= 2:
+                        break
+            self.assertEqual(self.adapter.opens, 2)
+
+            received = len(self.frames)
+            self.adapter.stalled = False
+            await asyncio.sleep(0.05)
+            self.assertGreater(len(self.frames), received)
+        finally:
+            task.cancel()
+            await self.scanner.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
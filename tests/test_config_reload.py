@@ -0,0 +1,139 @@
+import asyncio
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+import supervisor
+from config_reload import ConfigReloader, EnvFile
+
+
+def reload_in_child(path: str, applied: dict, ready, edited, results):
+    """A (spawned) child process's side of EnvFileTests.test_reload_in_child_process - set up the same way as
+    tiltbridge_junior.pipeline_process"""
+    env_file = EnvFile(path)
+    env_file.load()  # As tiltbridge_junior does when it is imported
+    env_file.inherit(applied)
+    env_file.load()
+    ready.set()
+    edited.wait(10)
+    ConfigReloader(env_file, lambda changed: results.put(sorted(changed))).check()
+    results.put(os.environ.get("TILTBRIDGE_JR_VERBOSE"))
+
+
+class EnvFileTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, '.env')
+        patcher = mock.patch.dict(os.environ, {"MQTT_TARGET_HOST": "from-docker"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, contents: str):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        # Make sure the change is visible, even if the filesystem's timestamps are coarse
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 10 ** 9))
+
+    def test_load_and_reload(self):
+        self.write("TILTBRIDGE_JR_VERBOSE=true\nMQTT_TARGET_HOST=from-file\nMQTT_TARGET_PORT=1883\n")
+        env_file = EnvFile(self.path)
+        self.assertTrue(env_file.modified())
+        self.assertEqual(env_file.load(), {"TILTBRIDGE_JR_VERBOSE", "MQTT_TARGET_PORT"})
+        self.assertEqual(os.environ["TILTBRIDGE_JR_VERBOSE"], "true")
+        self.assertEqual(os.environ["MQTT_TARGET_HOST"], "from-docker")  # The environment takes precedence
+        self.assertFalse(env_file.modified())
+
+        self.write("TILTBRIDGE_JR_VERBOSE=true\nMQTT_TARGET_HOST=changed\nFERMENTRACK_LEGACY_TARGET_ENABLED=true\n")
+        self.assertTrue(env_file.modified())
+        self.assertEqual(env_file.load(), {"MQTT_TARGET_PORT", "FERMENTRACK_LEGACY_TARGET_ENABLED"})
+        self.assertNotIn("MQTT_TARGET_PORT", os.environ)  # Removed from the file, so back to its default
+        self.assertEqual(os.environ["MQTT_TARGET_HOST"], "from-docker")
+        self.assertEqual(env_file.load(), set())
+
+    def test_reload_in_child_process(self):
+        # When running split, the pipeline process is spawned with the environment the supervisor loaded the file into
+        self.write("TILTBRIDGE_JR_VERBOSE=false\n")
+        env_file = EnvFile(self.path)
+        env_file.load()
+        ready, edited, results = supervisor.CONTEXT.Event(), supervisor.CONTEXT.Event(), supervisor.CONTEXT.Queue()
+        child = supervisor.CONTEXT.Process(target=reload_in_child,
+                                           args=(self.path, env_file.applied, ready, edited, results))
+        child.start()
+        try:
+            self.assertTrue(ready.wait(30))
+            self.write("TILTBRIDGE_JR_VERBOSE=true\n")
+            edited.set()
+            self.assertEqual(results.get(timeout=10), ["TILTBRIDGE_JR_VERBOSE"])
+            self.assertEqual(results.get(timeout=10), "true")
+        finally:
+            child.join(10)
+
+    def test_missing_file(self):
+        env_file = EnvFile(self.path)
+        self.assertEqual(env_file.load(), set())
+        self.assertFalse(env_file.modified())
+        self.write("TILTBRIDGE_JR_VERBOSE=true\n")
+        self.assertTrue(env_file.modified())
+
+
+class ConfigReloaderTests(AsyncTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, '.env')
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write(1)
+        self.env_file = EnvFile(self.path)
+        self.env_file.load()
+        self.reloads = []
+
+    def write(self, send_frequency: int):
+        with open(self.path, 'w') as f:
+            f.write(f"MQTT_TARGET_SEND_FREQUENCY={send_frequency}\n")
+        os.utime(self.path, ns=(0, send_frequency * 10 ** 9))
+
+    async def run_reloader(self, poll_interval: float, action):
+        task = asyncio.create_task(ConfigReloader(self.env_file, self.reloads.append, poll_interval).run())
+        await asyncio.sleep(0.01)
+        action()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def test_reloads_on_sighup(self):
+        self.write(2)
+        with self.assertLogs("tilt", "WARNING"):
+            await self.run_reloader(0, lambda: os.kill(os.getpid(), signal.SIGHUP))
+        self.assertEqual(self.reloads, [{"MQTT_TARGET_SEND_FREQUENCY"}])
+        self.assertEqual(os.environ["MQTT_TARGET_SEND_FREQUENCY"], "2")
+        # The signal handler is removed when the reloader stops
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+    async def test_reloads_when_file_changes(self):
+        await self.run_reloader(0.01, lambda: None)
+        self.assertEqual(self.reloads, [])
+        with self.assertLogs("tilt", "WARNING"):
+            await self.run_reloader(0.01, lambda: self.write(3))
+        self.assertEqual(self.reloads, [{"MQTT_TARGET_SEND_FREQUENCY"}])
+
+    async def test_error_applying_changes_is_logged(self):
+        def reload(changed):
+            raise ValueError("could not convert string to float: 'often'")
+
+        with open(self.path, 'w') as f:
+            f.write("MQTT_TARGET_SEND_FREQUENCY=often\n")
+        with self.assertLogs("tilt", "ERROR") as logs:
+            ConfigReloader(self.env_file, reload).check()
+        self.assertIn("Unable to apply the new configuration - could not convert string to float: 'often'",
+                      logs.output[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
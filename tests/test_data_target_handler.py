@@ -0,0 +1,352 @@
+import asyncio
+import datetime
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+from TiltHydrometer import TiltHydrometer
+import data_targets.data_target_handler as data_target_handler
+from data_targets.data_target import DataTarget
+
+
+class RecordingTarget(DataTarget):
+    """Data target that records what it was sent instead of sending it anywhere"""
+    name = "Recording Target"
+    SEND_FREQUENCY = datetime.timedelta(seconds=0)
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def load_config(self):
+        self.enabled = True
+
+    async def send(self, payload):
+        self.sent.append(payload)
+
+
+class DisabledTarget(RecordingTarget):
+    name = "Disabled Target"
+
+    def load_config(self):
+        self.enabled = False
+
+
+class HungTarget(RecordingTarget):
+    """Data target whose sends never complete"""
+    name = "Hung Target"
+
+    async def send(self, payload):
+        await asyncio.Event().wait()
+
+
+class SlowTarget(RecordingTarget):
+    """Data target whose sends take until release is set, configured from the SLOW_TARGET_* environment variables"""
+    name = "Slow Target"
+    ENV_PREFIXES = ("SLOW_TARGET_",)
+    release = None  # type: asyncio.Event or None
+
+    def load_config(self):
+        self.enabled = os.environ.get("SLOW_TARGET_ENABLED", "true") == "true"
+        self.url = os.environ.get("SLOW_TARGET_URL")
+        self.closed = False
+
+    async def send(self, payload):
+        self.started = True
+        await self.release.wait()
+        await super().send(payload)
+
+    def close(self):
+        self.closed = True
+
+
+class StuckTarget(SlowTarget):
+    """Slow target whose close() blocks until unstuck is set, like a target waiting on a send stuck in a thread"""
+    name = "Stuck Target"
+    unstuck = threading.Event()
+
+    def close(self):
+        self.unstuck.wait(5)
+        super().close()
+
+
+class OtherTarget(RecordingTarget):
+    name = "Other Target"
+    ENV_PREFIXES = ("OTHER_TARGET_",)
+
+
+class DataTargetHandlerTests(AsyncTestCase):
+    def setUp(self):
+        self.saved_target_classes = list(data_target_handler.target_classes)
+        self.tilts = {'Red': TiltHydrometer('Red')}
+        self.tilts['Red'].process_decoded_values(1050, 68, -70, 197)
+
+    def tearDown(self):
+        data_target_handler.target_classes[:] = self.saved_target_classes
+        data_target_handler.targets = []
+        data_target_handler.next_send_due = data_target_handler.NEVER
+        data_target_handler.last_snapshot = None
+        data_target_handler.dirty = False
+        data_target_handler.flush_requested = None
+        data_target_handler.immediate_send_gravity_delta = None
+        data_target_handler.immediate_send_temp_delta = None
+        data_target_handler.reschedule_requested = False
+
+    def load_targets(self, *target_classes):
+        data_target_handler.target_classes[:] = target_classes
+        data_target_handler.load_config()
+        for target in data_target_handler.targets:
+            target.queue = asyncio.Queue(maxsize=1)
+        return data_target_handler.targets
+
+    def test_load_config_only_keeps_enabled_targets(self):
+        data_target_handler.target_classes[:] = []
+        data_target_handler.register_target(RecordingTarget)
+        data_target_handler.register_target(DisabledTarget)
+        data_target_handler.register_target(RecordingTarget)  # Registering twice shouldn't create two targets
+        data_target_handler.load_config()
+
+        self.assertEqual(len(data_target_handler.targets), 1)
+        self.assertIsInstance(data_target_handler.targets[0], RecordingTarget)
+
+    async def test_flush_skips_targets_when_not_due(self):
+        target, = self.load_targets(RecordingTarget)
+        target.send_frequency = datetime.timedelta(hours=1)
+        target.data_last_sent = time.monotonic_ns()
+
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        data_target_handler.flush(self.tilts)
+        self.assertTrue(target.queue.empty())
+        self.assertEqual(data_target_handler.next_send_due, target.data_last_sent + target.send_frequency_ns)
+
+        # The new data is still sent once the target comes due
+        target.data_last_sent -= 2 * 3600 * 10 ** 9
+        data_target_handler.flush(self.tilts)
+        self.assertEqual(target.queue.qsize(), 1)
+
+    async def test_schedule_ignores_wall_clock_steps(self):
+        target, = self.load_targets(RecordingTarget)
+        target.send_frequency = datetime.timedelta(hours=1)
+        with mock.patch('time.monotonic_ns', return_value=10 ** 12):
+            target.data_last_sent = time.monotonic_ns()
+            data_target_handler.mark_dirty(self.tilts['Red'])
+
+            # The wall clock jumping forward a day (e.g. when NTP first syncs) doesn't make the target due...
+            with mock.patch('time.time', return_value=time.time() + 24 * 3600):
+                data_target_handler.flush(self.tilts)
+            self.assertTrue(target.queue.empty())
+            self.assertEqual(data_target_handler.next_send_due, 10 ** 12 + 3600 * 10 ** 9)
+
+        # ...only an hour passing does
+        with mock.patch('time.monotonic_ns', return_value=10 ** 12 + 3600 * 10 ** 9 + 1):
+            data_target_handler.flush(self.tilts)
+        self.assertEqual(target.queue.qsize(), 1)
+
+    async def test_flush_skips_send_when_nothing_changed(self):
+        target, = self.load_targets(RecordingTarget)
+
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        data_target_handler.flush(self.tilts)
+        first = target.queue.get_nowait()
+
+        data_target_handler.flush(self.tilts)
+        self.assertTrue(target.queue.empty())
+
+        self.tilts['Red'].process_decoded_values(1049, 68, -70, 197)
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        data_target_handler.flush(self.tilts)
+        self.assertIsNot(target.queue.get_nowait(), first)
+
+    async def test_significant_change_is_sent_immediately(self):
+        data_target_handler.target_classes[:] = [RecordingTarget]
+        data_target_handler.load_config()
+        target, = data_target_handler.targets
+        target.send_frequency = datetime.timedelta(hours=1)
+        data_target_handler.immediate_send_gravity_delta = (2, 20)  # 0.002 SG
+        data_target_handler.immediate_send_temp_delta = (0x10000, 0x10000)
+
+        run_task = asyncio.create_task(data_target_handler.run(self.tilts))
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(target.sent), 0)
+
+        # A hydrometer's first reading has never been sent, so it counts as a significant change
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(target.sent), 1)
+
+        # Small changes wait for the next scheduled send...
+        self.tilts['Red'].process_decoded_values(1049, 68, -70, 197)
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(target.sent), 1)
+
+        # ...but a large one is sent straight away
+        self.tilts['Red'].process_decoded_values(1047, 68, -70, 197)
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        await asyncio.sleep(0.01)
+        run_task.cancel()
+        await asyncio.gather(run_task, return_exceptions=True)
+
+        self.assertEqual(len(target.sent), 2)
+        self.assertEqual(target.sent[1].tilts[0]['raw_gravity'], '1.047')
+
+    async def test_hung_target_doesnt_delay_other_targets(self):
+        data_target_handler.target_classes[:] = [HungTarget, RecordingTarget]
+        data_target_handler.load_config()
+        hung_target, recording_target = data_target_handler.targets
+
+        with mock.patch.object(data_target_handler, 'MIN_FLUSH_INTERVAL', 0.001):
+            run_task = asyncio.create_task(data_target_handler.run(self.tilts))
+            await asyncio.sleep(0.01)
+
+            for gravity in (1049, 1048, 1047):
+                self.tilts['Red'].process_decoded_values(gravity, 68, -70, 197)
+                data_target_handler.mark_dirty(self.tilts['Red'])
+                await asyncio.sleep(0.01)
+            run_task.cancel()
+            await asyncio.gather(run_task, return_exceptions=True)
+
+        # The initial (empty) snapshot, plus one for each new reading
+        self.assertEqual(len(recording_target.sent), 4)
+        self.assertEqual(recording_target.sent[-1].tilts[0]['color'], 'Red')
+        self.assertEqual(hung_target.queue.qsize(), 1)  # The hung target only ever holds the latest snapshot
+
+    async def test_targets_share_snapshot(self):
+        data_target_handler.target_classes[:] = [RecordingTarget, DisabledTarget]
+        data_target_handler.register_target(type('SecondRecordingTarget', (RecordingTarget,), {}))
+        data_target_handler.load_config()
+        for target in data_target_handler.targets:
+            target.queue = asyncio.Queue(maxsize=1)
+
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        data_target_handler.flush(self.tilts)
+        first, second = [target.queue.get_nowait() for target in data_target_handler.targets]
+        self.assertIs(first, second)
+
+
+class ReloadConfigTests(AsyncTestCase):
+    def setUp(self):
+        self.saved_target_classes = list(data_target_handler.target_classes)
+        data_target_handler.target_classes[:] = [SlowTarget, OtherTarget]
+        patcher = mock.patch.object(data_target_handler, 'MIN_FLUSH_INTERVAL', 0.001)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tilts = {'Red': TiltHydrometer('Red')}
+        self.tilts['Red'].process_decoded_values(1050, 68, -70, 197)
+
+    def tearDown(self):
+        data_target_handler.target_classes[:] = self.saved_target_classes
+        data_target_handler.targets = []
+        data_target_handler.next_send_due = data_target_handler.NEVER
+        data_target_handler.last_snapshot = None
+        data_target_handler.dirty = False
+        data_target_handler.flush_requested = None
+        data_target_handler.reschedule_requested = False
+
+    async def start(self):
+        with mock.patch.dict(os.environ, {"SLOW_TARGET_URL": "http://old/"}):
+            data_target_handler.load_config()
+        # Created here, rather than in setUp(), so that it belongs to the test's event loop
+        SlowTarget.release = asyncio.Event()
+        self.run_task = asyncio.create_task(data_target_handler.run(self.tilts))
+        await asyncio.sleep(0.01)
+        return data_target_handler.targets
+
+    async def stop(self):
+        self.run_task.cancel()
+        await asyncio.gather(self.run_task, return_exceptions=True)
+
+    def reload(self, env: dict):
+        with mock.patch.dict(os.environ, env):
+            data_target_handler.reload_config(env.keys())
+
+    async def test_only_changed_targets_are_replaced(self):
+        slow, other = await self.start()
+        self.reload({"OTHER_TARGET_URL": "http://new/"})
+        await asyncio.sleep(0.01)
+        new_slow, new_other = data_target_handler.targets
+        self.assertIs(new_slow, slow)
+        self.assertIsNot(new_other, other)
+        await self.stop()
+
+    async def test_replacement_waits_for_previous_target_to_finish_sending(self):
+        old, _ = await self.start()
+        await asyncio.sleep(0.01)
+        self.assertTrue(old.started)  # The initial snapshot is being sent
+
+        # The new target replaces the old one straight away, but doesn't send until the old one is done
+        self.reload({"SLOW_TARGET_URL": "http://new/"})
+        new, _ = data_target_handler.targets
+        self.assertEqual(new.url, "http://new/")
+        self.assertEqual(new.data_last_sent, old.data_last_sent)
+        await asyncio.sleep(0.01)
+        self.assertIsNone(new.queue)
+        self.assertFalse(old.closed)
+
+        SlowTarget.release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(old.sent), 1)  # The send in progress wasn't lost
+        self.assertTrue(old.closed)
+        self.assertIsNotNone(new.queue)
+
+        # ...and then the new target picks up from there
+        self.tilts['Red'].process_decoded_values(1049, 68, -70, 197)
+        data_target_handler.mark_dirty(self.tilts['Red'])
+        data_target_handler.flush(self.tilts, force=True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(new.sent[-1].tilts[0]['raw_gravity'], '1.049')
+        await self.stop()
+
+    async def test_stuck_target_does_not_block_the_loop(self):
+        data_target_handler.target_classes[:] = [StuckTarget]
+        StuckTarget.unstuck.clear()
+        self.addCleanup(StuckTarget.unstuck.set)
+        old, = await self.start()
+        self.assertTrue(old.started)  # ...and never finishes, as release is never set
+
+        with mock.patch.object(data_target_handler, 'HAND_OVER_TIMEOUT', 0.05), self.assertLogs("tilt", "WARNING"):
+            self.reload({"SLOW_TARGET_URL": "http://new/"})
+            new, = data_target_handler.targets
+            # The event loop keeps running while the old target is closing
+            started = time.monotonic()
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertFalse(old.closed)
+            # ...and the replacement starts once the old target has had long enough to close
+            await asyncio.sleep(0.1)
+            self.assertIsNotNone(new.queue)
+
+        StuckTarget.unstuck.set()
+        await asyncio.sleep(0.05)
+        self.assertTrue(old.closed)
+        await self.stop()
+
+    async def test_enable_and_disable_targets(self):
+        with mock.patch.dict(os.environ, {"SLOW_TARGET_ENABLED": "false"}):
+            data_target_handler.target_classes[:] = [SlowTarget]
+            await self.start()
+        self.assertEqual(data_target_handler.targets, [])
+
+        # The scheduler wakes up to send to a newly enabled target
+        SlowTarget.release.set()
+        with mock.patch.object(SlowTarget, 'SEND_FREQUENCY', datetime.timedelta(seconds=0.01)):
+            self.reload({"SLOW_TARGET_ENABLED": "true"})
+        target, = data_target_handler.targets
+        await asyncio.sleep(0.05)
+        self.assertGreater(len(target.sent), 0)
+
+        self.reload({"SLOW_TARGET_ENABLED": "false"})
+        self.assertEqual(data_target_handler.targets, [])
+        await asyncio.sleep(0.01)
+        self.assertTrue(target.closed)
+        self.assertNotIn(target, data_target_handler.workers)
+        await self.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
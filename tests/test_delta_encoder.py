@@ -0,0 +1,69 @@
+import json
+import unittest
+
+from TiltHydrometer import TiltHydrometer
+from data_targets.delta_encoder import DeltaEncoder
+from data_targets.legacy_fermentrack_target import LegacyFermentrackTarget
+from data_targets.snapshot import Snapshot
+
+SECOND = 10 ** 9
+
+
+class DeltaEncoderTests(unittest.TestCase):
+    def setUp(self):
+        self.encoder = DeltaEncoder(300 * SECOND)
+        self.tilts = {'Red': TiltHydrometer('Red', 'aa:bb:cc:dd:ee:ff'), 'Blue': TiltHydrometer('Blue')}
+        self.tilts['Red'].process_decoded_values(1050, 68, -70, 197)
+        self.tilts['Blue'].process_decoded_values(1040, 65, -80, 197)
+
+    def encode(self, now_ns: int):
+        snapshot = Snapshot.build(self.tilts)
+        return self.encoder.encode(snapshot, now_ns, LegacyFermentrackTarget.encode_payload(snapshot))
+
+    def test_first_payload_is_full(self):
+        payload, pending = self.encode(0)
+        body = json.loads(payload)
+        self.assertNotIn('delta', body)
+        self.assertEqual(body['tilts'], [tilt.to_dict() for tilt in self.tilts.values()])
+
+    def test_only_changes_sent(self):
+        self.encoder.acknowledge(self.encode(0)[1])
+        # Nothing has changed since the last acknowledged payload
+        payload, pending = self.encode(SECOND)
+        self.assertIsNone(payload)
+
+        self.tilts['Red'].process_decoded_values(1050, 68, -75, 197)
+        payload, pending = self.encode(2 * SECOND)
+        self.assertEqual(json.loads(payload), {'tilts': [{'color': 'Red', 'mac': 'aa:bb:cc:dd:ee:ff', 'rssi': -75}],
+                                               'tiltbridge_junior': True, 'delta': True})
+
+        # Until it is acknowledged, the next delta is still relative to the last acknowledged payload
+        self.tilts['Blue'].process_decoded_values(1040, 66, -80, 197)
+        payload, pending = self.encode(3 * SECOND)
+        changed = {tilt['color']: tilt for tilt in json.loads(payload)['tilts']}
+        self.assertEqual(changed['Red'], {'color': 'Red', 'mac': 'aa:bb:cc:dd:ee:ff', 'rssi': -75})
+        self.assertEqual(set(changed['Blue']), {'color', 'mac', 'raw_temp', 'smoothed_temp'})
+
+        self.encoder.acknowledge(pending)
+        self.assertIsNone(self.encode(4 * SECOND)[0])
+
+    def test_new_hydrometer_sent_in_full(self):
+        self.encoder.acknowledge(self.encode(0)[1])
+        self.tilts['Green'] = TiltHydrometer('Green')
+        self.tilts['Green'].process_decoded_values(1030, 70, -60, 197)
+        payload, pending = self.encode(SECOND)
+        self.assertEqual(json.loads(payload)['tilts'], [self.tilts['Green'].to_dict()])
+
+    def test_periodic_resync(self):
+        self.encoder.acknowledge(self.encode(0)[1])
+        self.tilts['Red'].process_decoded_values(1049, 68, -70, 197)
+        self.assertIn(b'"delta":true', self.encode(299 * SECOND)[0])
+        self.assertNotIn(b'delta', self.encode(300 * SECOND)[0])
+
+        self.encoder.acknowledge(self.encode(10 * SECOND)[1])
+        self.encoder.reset()
+        self.assertNotIn(b'delta', self.encode(11 * SECOND)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+import error_reporting
+
+
+class ErrorReportingTests(unittest.TestCase):
+    def test_enabled_from_env(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("TILTBRIDGE_JR_SENTRY_ENABLED", None)
+            self.assertTrue(error_reporting.enabled_from_env())
+        for value, expected in (('true', True), ('True', True), ('false', False)):
+            with mock.patch.dict(os.environ, {"TILTBRIDGE_JR_SENTRY_ENABLED": value}):
+                self.assertEqual(error_reporting.enabled_from_env(), expected)
+
+    def test_capture_before_init_is_ignored(self):
+        with mock.patch('error_reporting._sentry', None):
+            error_reporting.capture_exception(ValueError("unpack requires a buffer of 4 bytes"))
+
+    def test_capture_after_init(self):
+        with mock.patch('error_reporting._sentry') as mock_sentry:
+            error = ValueError("unpack requires a buffer of 4 bytes")
+            error_reporting.capture_exception(error)
+            mock_sentry.capture_exception.assert_called_once_with(error)
+
+    def test_startup_doesnt_import_slow_modules(self):
+        """sentry_sdk and requests are only imported once scanning has started (or before the first send)"""
+        result = subprocess.run([sys.executable, '-c', "import sys, tiltbridge_junior; "
+                                                       "print(sorted({'sentry_sdk', 'requests'} & set(sys.modules)))"],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+
+if __name__ == '__main__':
+    unittest.main()
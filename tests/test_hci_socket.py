@@ -0,0 +1,116 @@
+import asyncio
+import socket
+import struct
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+import ble_capture
+import hci_socket
+import tilt_decoder
+
+
+COMMAND_COMPLETE = b'\x04\x0e\x04\x01\x03\x0c\x00'  # Command complete for HCI_Reset
+TILT_MAC = b'\xc9\xf7\xd0\xcf\x7a\xdf'
+
+
+def frames_through_filter(frames):
+    """Send each frame through a socketpair with the iBeacon BPF program attached, standing in for the HCI socket.
+    Returns the frames that make it through."""
+    sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        hci_socket.attach_bpf(receiver, hci_socket.ibeacon_bpf_program())
+        receiver.setblocking(False)
+        received = []
+        for frame in frames:
+            sender.send(frame)
+            try:
+                received.append(receiver.recv(hci_socket.MAX_FRAME_SIZE))
+            except BlockingIOError:
+                pass  # Dropped by the filter
+        return received
+    finally:
+        sender.close()
+        receiver.close()
+
+
+class RecordingProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.frames = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.frames.append(data)
+
+
+class HCIFilterTests(unittest.TestCase):
+    def test_hci_filter(self):
+        type_mask, event_mask_low, event_mask_high, opcode = struct.unpack("IIIh2x", hci_socket.hci_filter())
+        self.assertEqual(type_mask, 1 << 4)  # HCI event packets only
+        self.assertEqual(event_mask_low, (1 << 0x0e) | (1 << 0x0f))  # Command complete and command status
+        self.assertEqual(event_mask_high, 1 << (0x3e - 32))  # LE meta events
+        self.assertEqual(opcode, 0)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "BPF filters are tested on a Unix socketpair")
+class BPFFilterTests(unittest.TestCase):
+    def test_passes_tilts_and_command_responses(self):
+        tilt = ble_capture.build_tilt_frame('Red', TILT_MAC, 68, 1050, 197, -70)
+        extended_tilt = ble_capture.build_tilt_frame('Blue', TILT_MAC, 680, 10500, 197, -70, extended=True)
+        # Without the flags AD structure first
+        tilt_no_flags = ble_capture.build_adv_report(TILT_MAC, tilt[17:-1], -70)
+        multiple_reports = tilt[:4] + b'\x02' + tilt[5:]
+
+        frames = [COMMAND_COMPLETE, tilt, extended_tilt, tilt_no_flags, multiple_reports]
+        self.assertEqual(frames_through_filter(frames), frames)
+
+    def test_drops_everything_else(self):
+        frames = [
+            b'\x02\x01\x20\x05\x00\x01\x00\x02\x00\x00',  # ACL data
+            b'\x04\x05\x04\x00\x40\x00\x13',  # Disconnection complete
+            b'\x04\x3e\x13\x01\x00\x40\x00\x00\x00' + TILT_MAC + b'\x00' * 6,  # LE connection complete
+            ble_capture.build_adv_report(TILT_MAC, b'\x02\x01\x06', -70),
+            ble_capture.build_adv_report(TILT_MAC, b'\x02\x01\x06\x03\x03\xaa\xfe\x05\x16\xaa\xfe\x00\xe7', -70),
+            ble_capture.build_adv_report(TILT_MAC, b'', -70),
+        ]
+        self.assertEqual(frames_through_filter(frames), [])
+
+    def test_no_tilts_dropped_from_replay(self):
+        frames = [frame for _, frame in ble_capture.synthetic_frames(2000, tilt_fraction=0.2)]
+        tilt_frames = [frame for frame in frames if isinstance(tilt_decoder.decode_tilt_frame(frame), tuple)]
+        received = frames_through_filter(frames)
+
+        self.assertLess(len(received), len(frames) / 2)
+        self.assertTrue(set(tilt_frames).issubset(received))
+
+
+class HCISocketTransportTests(AsyncTestCase):
+    async def test_drains_all_waiting_frames_per_wakeup(self):
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        frames = [ble_capture.build_tilt_frame('Red', TILT_MAC, 68, 1050 + x, 197, -70) for x in range(5)]
+        for frame in frames:
+            sender.send(frame)
+
+        protocol = RecordingProtocol()
+        with mock.patch.object(hci_socket.HCISocketTransport, '_read_ready', autospec=True,
+                               side_effect=hci_socket.HCISocketTransport._read_ready) as mock_read_ready:
+            transport = hci_socket.HCISocketTransport(receiver, protocol)
+            await asyncio.sleep(0.01)
+            self.assertIs(protocol.transport, transport)
+            self.assertEqual(protocol.frames, frames)
+            self.assertEqual(mock_read_ready.call_count, 1)
+
+            transport.write(COMMAND_COMPLETE)
+            self.assertEqual(sender.recv(hci_socket.MAX_FRAME_SIZE), COMMAND_COMPLETE)
+            transport.close()
+
+        self.assertTrue(transport.is_closing())
+        sender.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+import http_server
+from history import DAY, History, INDEX_ENTRY, Rollup, Rows, TIERS_BY_NAME, device_id
+from TiltHydrometer import TiltHydrometer
+
+START = 1700000000 - 1700000000 % DAY  # The start of a day, so segments line up with the test's timestamps
+
+
+def make_rows(timestamps, gravity=1.050, temp=68.0, rssi=-70) -> Rows:
+    rows = Rows()
+    for timestamp in timestamps:
+        rows.append(timestamp, gravity, temp, 1, rssi)
+    return rows
+
+
+class RowsTests(unittest.TestCase):
+    def test_encode_decode(self):
+        rows = make_rows([START, START + 5, START + 10], gravity=1.0425, temp=67.5, rssi=-81)
+        decoded = Rows.decode(rows.encode(), len(rows))
+        self.assertEqual(decoded.to_dict(), rows.to_dict())
+        self.assertEqual(decoded.to_dict()['gravity'], [1.0425] * 3)
+
+        partial = Rows.decode(rows.encode(1, 3), 2)
+        self.assertEqual(partial.timestamp.tolist(), [START + 5, START + 10])
+
+
+class RollupTests(unittest.TestCase):
+    def test_completed_buckets(self):
+        rollup = Rollup(60)
+        rows = Rows()
+        rows.append(START, 1.050, 68, 1, -70)
+        rows.append(START + 30, 1.052, 70, 1, -80)
+        rows.append(START + 60, 1.040, 60, 1, -60)
+        completed = rollup.add(rows)
+        # The second bucket isn't complete until a reading arrives after it
+        self.assertEqual(completed.timestamp.tolist(), [START])
+        self.assertAlmostEqual(completed.gravity[0], 1.051, places=5)
+        self.assertEqual(completed.temp[0], 69)
+        self.assertEqual(completed.count[0], 2)
+        self.assertEqual(completed.rssi[0], -75)
+
+        completed = rollup.add(make_rows([START + 120]))
+        self.assertEqual(completed.timestamp.tolist(), [START + 60])
+        self.assertAlmostEqual(completed.gravity[0], 1.040, places=5)
+
+    def test_weighted_by_count(self):
+        rollup = Rollup(900)
+        rows = Rows()
+        rows.append(START, 1.000, 60, 3, -70)
+        rows.append(START + 60, 1.100, 70, 1, -70)
+        rows.append(START + 900, 1.000, 60, 1, -70)
+        completed = rollup.add(rows)
+        self.assertAlmostEqual(completed.gravity[0], 1.025, places=5)
+        self.assertEqual(completed.count[0], 4)
+
+
+class HistoryTests(AsyncTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = History(self.directory.name)
+        self.device = device_id('Red', 'AA:BB:CC:DD:EE:FF')
+
+    def tearDown(self):
+        self.history.executor.shutdown()
+        self.directory.cleanup()
+
+    def test_device_id(self):
+        self.assertEqual(self.device, 'red_aabbccddeeff')
+        self.assertEqual(device_id('Green', None), 'green_unknown')
+
+    def test_query_across_blocks(self):
+        # One block per flush - the index finds the blocks in range without reading the others
+        for block in range(10):
+            self.history.write([(self.device, make_rows(range(START + block * 100, START + block * 100 + 100, 5),
+                                                         gravity=1.0 + block / 100))], START + 1000)
+        index_path = os.path.join(self.directory.name, self.device, 'raw', f"{START}.idx")
+        self.assertEqual(os.path.getsize(index_path), 10 * INDEX_ENTRY.size)
+
+        rows = self.history.query(self.device, START + 250, START + 405, TIERS_BY_NAME['raw'])
+        self.assertEqual(rows.timestamp.tolist(), list(range(START + 250, START + 406, 5)))
+        self.assertAlmostEqual(rows.gravity[0], 1.02, places=5)
+        self.assertAlmostEqual(rows.gravity[-1], 1.04, places=5)
+
+        self.assertEqual(len(self.history.query(self.device, START + 2000, START + 3000, TIERS_BY_NAME['raw'])), 0)
+        self.assertEqual(len(self.history.query('blue_unknown', START, START + 3000, TIERS_BY_NAME['raw'])), 0)
+
+    def test_query_across_segments(self):
+        timestamps = [START + DAY - 10, START + DAY - 5, START + DAY, START + DAY + 5]
+        self.history.write([(self.device, make_rows(timestamps))], START + DAY)
+        # Rows on either side of midnight go to separate segment files
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, self.device, 'raw', f"{START + DAY}.dat")))
+        rows = self.history.query(self.device, START, START + 2 * DAY, TIERS_BY_NAME['raw'])
+        self.assertEqual(rows.timestamp.tolist(), timestamps)
+
+    def test_rollups_written(self):
+        # Two hours of readings every 5 seconds
+        self.history.write([(self.device, make_rows(range(START, START + 7200, 5)))], START + 7200)
+        minutes = self.history.query(self.device, START, START + 7200, TIERS_BY_NAME['1m'])
+        # The last minute of each tier is still open
+        self.assertEqual(len(minutes), 119)
+        self.assertEqual(minutes.count[0], 12)
+        self.assertEqual(len(self.history.query(self.device, START, START + 7200, TIERS_BY_NAME['15m'])), 7)
+        hours = self.history.query(self.device, START, START + 7200, TIERS_BY_NAME['1h'])
+        self.assertEqual(hours.timestamp.tolist(), [START])
+        self.assertEqual(hours.count[0], 720)
+
+    def test_prune(self):
+        self.history.write([(self.device, make_rows([START, START + 60, START + 120]))], START)
+        self.history.prune(START + 3 * DAY + 1)
+        # The raw segment is past its 2 day retention, but the rollups aren't
+        self.assertEqual(len(self.history.query(self.device, START, START + DAY, TIERS_BY_NAME['raw'])), 0)
+        self.assertEqual(len(self.history.query(self.device, START, START + DAY, TIERS_BY_NAME['1m'])), 2)
+
+    def test_choose_tier(self):
+        now = START + 30 * DAY
+        self.assertEqual(self.history.choose_tier(now - 3600, now, now).name, 'raw')
+        self.assertEqual(self.history.choose_tier(now - DAY, now, now).name, '1m')
+        self.assertEqual(self.history.choose_tier(now - 10 * DAY, now, now).name, '15m')
+        self.assertEqual(self.history.choose_tier(now - 20 * DAY, now, now).name, '15m')
+        self.assertEqual(self.history.choose_tier(now - 29 * DAY, now, now).name, '1h')
+
+    async def test_record_and_serve(self):
+        red = TiltHydrometer('Red', 'AA:BB:CC:DD:EE:FF')
+        self.history.record(red, 1050, 68, -70)
+        self.history.record(red, 10480, 681, -72)  # A Tilt Pro reading
+        self.history.record(red, 1001, 999, -70)  # Firmware version, not a reading
+        await self.history.flush()
+        self.assertEqual(self.history.buffers, {})
+
+        request = http_server.Request('GET', '/api/history', 'color=Red&mac=AA:BB:CC:DD:EE:FF', {})
+        response = await self.history.serve_history(request, None)
+        self.assertEqual(response.status, 200)
+        body = json.loads(response.body)
+        self.assertEqual(body['device'], self.device)
+        self.assertEqual(body['resolution'], '1m')
+        # Nothing has rolled up into a minute yet
+        self.assertEqual(body['timestamp'], [])
+
+        request.query += '&resolution=raw'
+        body = json.loads((await self.history.serve_history(request, None)).body)
+        self.assertEqual(body['gravity'], [1.05, 1.048])
+        self.assertEqual(body['temp'], [68.0, 68.1])
+        self.assertEqual(body['rssi'], [-70, -72])
+        self.assertLessEqual(abs(body['timestamp'][0] - time.time()), 5)
+
+    async def test_serve_bad_request(self):
+        for query in ('', 'color=Red&start=yesterday', 'color=Red&resolution=5m',
+                      f'color=Red&start={START + 1}&end={START}'):
+            response = await self.history.serve_history(http_server.Request('GET', '/api/history', query, {}), None)
+            self.assertEqual(response.status, 400)
+
+    async def test_serve_clamps_range(self):
+        now = int(time.time())
+        query = f'color=Red&start=0&end={now + 10 * DAY}&resolution=raw'
+        request = http_server.Request('GET', '/api/history', query, {})
+        with mock.patch.object(self.history, 'query', wraps=self.history.query) as query:
+            response = await self.history.serve_history(request, None)
+        self.assertEqual(response.status, 200)
+        _, start, end, tier = query.call_args[0]
+        self.assertAlmostEqual(start, now - tier.retention, delta=5)
+        self.assertAlmostEqual(end, now, delta=5)
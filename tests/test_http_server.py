@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+
+from aiounittest import AsyncTestCase
+
+import http_server
+
+
+async def hello(request, writer):
+    return http_server.Response(200, b'hello ' + request.query.encode(), 'text/plain')
+
+
+class HTTPServerTests(AsyncTestCase):
+    async def request(self, server, *requests) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b''.join(requests))
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 1)
+        writer.close()
+        return response
+
+    async def test_serves_routes_over_keep_alive(self):
+        server = http_server.HTTPServer()
+        server.route('/hello', hello)
+        await server.start('127.0.0.1', 0)
+        try:
+            response = await self.request(server, b'GET /hello?a HTTP/1.1\r\nHost: x\r\n\r\n',
+                                          b'GET /hello?b HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        finally:
+            await server.stop()
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertIn(b'Content-Type: text/plain\r\n', response)
+        self.assertIn(b'Content-Length: 7\r\n', response)
+        self.assertTrue(response.endswith(b'\r\n\r\nhello b'))
+        self.assertIn(b'hello a', response)
+
+    async def test_errors(self):
+        server = http_server.HTTPServer()
+        server.route('/hello', hello)
+        await server.start('127.0.0.1', 0)
+        try:
+            not_found = await self.request(server, b'GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n')
+            not_allowed = await self.request(server, b'POST /hello HTTP/1.1\r\nConnection: close\r\n\r\n')
+            head = await self.request(server, b'HEAD /hello HTTP/1.1\r\nConnection: close\r\n\r\n')
+        finally:
+            await server.stop()
+
+        self.assertTrue(not_found.startswith(b'HTTP/1.1 404 Not Found\r\n'))
+        self.assertTrue(not_allowed.startswith(b'HTTP/1.1 405 Method Not Allowed\r\n'))
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(head.endswith(b'\r\n\r\n'))  # No body for HEAD
+
+
+if __name__ == '__main__':
+    unittest.main()
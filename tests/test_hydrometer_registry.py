@@ -0,0 +1,58 @@
+import unittest
+import time
+
+from hydrometer_registry import HydrometerRegistry
+
+
+RED_UUID = bytes.fromhex('a495bb10c5b14b44b5121370f02d74de')
+YELLOW_UUID = bytes.fromhex('a495bb70c5b14b44b5121370f02d74de')
+UNKNOWN_UUID = bytes.fromhex('a495bb71c5b14b44b5121370f02d74de')
+MAC_1 = b'\xc9\xf7\xd0\xcf\x7a\xdf'
+MAC_2 = b'\x01\x02\x03\x04\x05\x06'
+
+
+class HydrometerRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = HydrometerRegistry()
+
+    def test_lookup_creates_hydrometer(self):
+        self.assertEqual(len(self.registry), 0)
+        tilt = self.registry.lookup(YELLOW_UUID, MAC_1)
+        self.assertEqual(tilt.color, 'Yellow')
+        self.assertEqual(tilt.mac, 'df:7a:cf:d0:f7:c9')
+        self.assertIs(self.registry[('Yellow', 'df:7a:cf:d0:f7:c9')], tilt)
+        self.assertIs(self.registry.lookup(YELLOW_UUID, MAC_1), tilt)  # Subsequent lookups return the same hydrometer
+        self.assertEqual(len(self.registry), 1)
+
+    def test_same_color_different_mac(self):
+        """Two Tilts of the same color need to be tracked separately"""
+        tilt_1 = self.registry.lookup(RED_UUID, MAC_1)
+        tilt_2 = self.registry.lookup(RED_UUID, MAC_2)
+        self.assertIsNot(tilt_1, tilt_2)
+
+        tilt_1.process_decoded_values(1050, 68, -70, 197)
+        tilt_2.process_decoded_values(1020, 70, -70, 197)
+        self.assertEqual(list(tilt_1.gravity_list), [1050])
+        self.assertEqual(list(tilt_2.gravity_list), [1020])
+        self.assertEqual({tilt['mac'] for tilt in (t.to_dict() for t in self.registry.values())},
+                         {'df:7a:cf:d0:f7:c9', '06:05:04:03:02:01'})
+
+    def test_lookup_unknown_uuid(self):
+        self.assertIsNone(self.registry.lookup(UNKNOWN_UUID, MAC_1))
+        self.assertEqual(len(self.registry), 0)
+
+    def test_evict_expired(self):
+        fresh = self.registry.lookup(RED_UUID, MAC_1)
+        fresh.process_decoded_values(1050, 68, -70, 197)
+        stale = self.registry.lookup(RED_UUID, MAC_2)
+        stale.process_decoded_values(1050, 68, -70, 197)
+        stale.last_value_received_ns = time.monotonic_ns() - 24 * 3600 * 10 ** 9
+
+        self.assertEqual(self.registry.evict_expired(), 1)
+        self.assertEqual(list(self.registry.values()), [fresh])
+        # An evicted hydrometer is recreated (with a fresh smoothing window) the next time it is seen
+        self.assertIsNot(self.registry.lookup(RED_UUID, MAC_2), stale)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,34 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
 import unittest
-from datetime import datetime, timedelta
+from datetime import timedelta
 from unittest import mock
 
+from aiounittest import AsyncTestCase
+
 from TiltHydrometer import TiltHydrometer
 from data_targets.legacy_fermentrack_target import LegacyFermentrackTarget
+from data_targets.outbox import Outbox
+from data_targets.snapshot import Snapshot
 
 
-class LegacyFermentrackTargetTests(unittest.TestCase):
+class LegacyFermentrackTargetTests(AsyncTestCase):
     def setUp(self):
         self.target = LegacyFermentrackTarget()
         self.target.enabled = True
         self.target.target_url = "https://example.com"
+        # Normally created by run() - the sender task
+        self.target.queue = asyncio.Queue(maxsize=1)
+
+    def process(self, tilts: dict):
+        """What the scheduler does for each target when it flushes"""
+        self.target.process_snapshot(Snapshot.build(tilts), time.monotonic_ns())
 
-    def test_convert_tilts_to_dict(self):
+    def test_snapshot_tilts(self):
         tilts = {
             'Red': TiltHydrometer('Red'),
             'Green': TiltHydrometer('Green')
@@ -25,27 +41,31 @@ class LegacyFermentrackTargetTests(unittest.TestCase):
             tilts['Green'].to_dict()
         ]
 
-        converted_dict = self.target.convert_tilts_to_list(tilts)
-        self.assertEqual(converted_dict, expected_list)
+        self.assertEqual(Snapshot.build(tilts).tilts, expected_list)
 
     @mock.patch('data_targets.legacy_fermentrack_target.requests')
-    def test_process_data_last_sent_updates_when_sent(self, mock_requests):
+    async def test_process_data_last_sent_updates_when_sent(self, mock_requests):
         tilts = {
             'Red': TiltHydrometer('Red'),
             'Green': TiltHydrometer('Green')
         }
 
         # Set the data_last_sent value to oustide the FERMENTRACK_SEND_FREQUENCY window and cache it
-        self.target.data_last_sent = datetime.now() - self.target.FERMENTRACK_SEND_FREQUENCY - timedelta(seconds=1)
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
         old_last_sent = self.target.data_last_sent
 
-        self.target.process(tilts)
+        self.process(tilts)
         self.assertGreater(self.target.data_last_sent, old_last_sent)
-        mock_requests.post.assert_called_once()
+        # process_snapshot() should only queue the snapshot - sending happens on the sender task
+        self.assertEqual(self.target.queue.qsize(), 1)
+        mock_requests.Session.return_value.post.assert_not_called()
+
+        await self.target.send(self.target.queue.get_nowait())
+        mock_requests.Session.return_value.post.assert_called_once()
 
 
     @mock.patch('data_targets.legacy_fermentrack_target.requests')
-    def test_process_data_last_sent_doesnt_update_when_not_sent(self, mock_requests):
+    async def test_process_data_last_sent_doesnt_update_when_not_sent(self, mock_requests):
         """Test that the data_last_sent value doesn't update when we don't send data (because we're not due to send
         data)"""
         tilts = {
@@ -54,19 +74,19 @@ class LegacyFermentrackTargetTests(unittest.TestCase):
         }
 
         # Cache the data_last_sent value and make sure we have time to process the test
-        self.target.data_last_sent = datetime.now()
+        self.target.data_last_sent = time.monotonic_ns()
         old_last_sent = self.target.data_last_sent
         self.assertGreater(self.target.FERMENTRACK_SEND_FREQUENCY, timedelta(seconds=2))  # The test won't work if we don't have time to process
 
-        self.target.process(tilts)
+        self.process(tilts)
 
         # Requests.post shouldn't be called & the data_last_sent shouldn't change since we're inside the window
         self.assertEqual(self.target.data_last_sent, old_last_sent)
-        mock_requests.post.assert_not_called()
+        self.assertTrue(self.target.queue.empty())
 
 
     @mock.patch('data_targets.legacy_fermentrack_target.requests')
-    def test_process_data_doesnt_send_when_no_url(self, mock_requests):
+    async def test_process_data_doesnt_send_when_no_url(self, mock_requests):
         tilts = {
             'Red': TiltHydrometer('Red'),
             'Green': TiltHydrometer('Green')
@@ -74,17 +94,17 @@ class LegacyFermentrackTargetTests(unittest.TestCase):
 
         # Set the data_last_sent value to oustide the FERMENTRACK_SEND_FREQUENCY window and cache it
         self.target.target_url = None
-        self.target.data_last_sent = datetime.now() - self.target.FERMENTRACK_SEND_FREQUENCY - timedelta(seconds=1)
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
         old_last_sent = self.target.data_last_sent
 
-        self.target.process(tilts)
+        self.process(tilts)
 
         self.assertEqual(self.target.data_last_sent, old_last_sent)
-        mock_requests.post.assert_not_called()
+        self.assertTrue(self.target.queue.empty())
 
 
     @mock.patch('data_targets.legacy_fermentrack_target.requests')
-    def test_process_data_doesnt_send_when_not_enabled(self, mock_requests):
+    async def test_process_data_doesnt_send_when_not_enabled(self, mock_requests):
         tilts = {
             'Red': TiltHydrometer('Red'),
             'Green': TiltHydrometer('Green')
@@ -92,30 +112,191 @@ class LegacyFermentrackTargetTests(unittest.TestCase):
 
         # Set the data_last_sent value to oustide the FERMENTRACK_SEND_FREQUENCY window and cache it
         self.target.enabled = False
-        self.target.data_last_sent = datetime.now() - self.target.FERMENTRACK_SEND_FREQUENCY - timedelta(seconds=1)
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
         old_last_sent = self.target.data_last_sent
 
-        self.target.process(tilts)
+        self.process(tilts)
 
         self.assertEqual(self.target.data_last_sent, old_last_sent)
-        mock_requests.post.assert_not_called()
+        self.assertTrue(self.target.queue.empty())
 
 
     @mock.patch('data_targets.legacy_fermentrack_target.requests')
-    def test_process_send_data(self, mock_requests):
+    async def test_process_send_data(self, mock_requests):
         tilts = {
             'Red': TiltHydrometer('Red'),
             'Green': TiltHydrometer('Green')
         }
         tilts['Red'].process_decoded_values(4000, 72, -80, 197)
         tilts['Green'].process_decoded_values(5000, 68, -85, 190)
+        mock_post = mock_requests.Session.return_value.post
+
+        sender_task = asyncio.create_task(self.target.run())
+        await asyncio.sleep(0)  # Let the sender task start up
 
         # In order to ensure that the data is sent, we need to set the last sent time to be longer than the send frequency
-        self.target.data_last_sent = datetime.now() - self.target.FERMENTRACK_SEND_FREQUENCY - timedelta(seconds=1)
-        self.target.process(tilts)
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
+        self.process(tilts)
+
+        for _ in range(100):
+            if mock_post.called:
+                break
+            await asyncio.sleep(0.01)
+        sender_task.cancel()
+
+        expected_tilt_dict = {'tilts': Snapshot.build(tilts).tilts, 'tiltbridge_junior': True,}
+        mock_post.assert_called_once_with(self.target.target_url, data=mock.ANY,
+                                          headers={'Content-Type': 'application/json'}, timeout=5)
+        self.assertEqual(json.loads(mock_post.call_args.kwargs['data']), expected_tilt_dict)
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_process_replaces_stale_snapshot(self, mock_requests):
+        """If Fermentrack hasn't picked up the last snapshot, the queued snapshot should be replaced, not added to"""
+        tilts = {'Red': TiltHydrometer('Red')}
+        tilts['Red'].process_decoded_values(4000, 72, -80, 197)
+
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
+        self.process(tilts)
+        tilts['Red'].process_decoded_values(4010, 72, -80, 197)
+        self.target.data_last_sent = time.monotonic_ns() - self.target.send_frequency_ns - 10 ** 9
+        self.process(tilts)
+
+        self.assertEqual(self.target.queue.qsize(), 1)
+        self.assertEqual(self.target.queue.get_nowait().tilts[0]['raw_gravity'], '4.01')
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_send_reuses_session(self, mock_requests):
+        await self.target.send(Snapshot.build({}))
+        await self.target.send(Snapshot.build({}))
+        mock_requests.Session.assert_called_once()
+        self.assertEqual(mock_requests.Session.return_value.post.call_count, 2)
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_send_handles_exception(self, mock_requests):
+        mock_requests.Session.return_value.post.side_effect = Exception("Connection refused")
+        await self.target.send(Snapshot.build({}))  # Should log, not raise
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_failed_sends_are_backfilled_in_bulk(self, mock_requests):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.target.backfill_url = "https://example.com/backfill/"
+            self.target.outbox = Outbox(os.path.join(tempdir, 'outbox.sqlite3'), self.target.name)
+            self.target.BACKFILL_BATCH_SIZE = 2
+            mock_post = mock_requests.Session.return_value.post
+            tilts = {'Red': TiltHydrometer('Red')}
+
+            # Fermentrack is down - every snapshot ends up in the outbox
+            mock_post.return_value.status_code = 500
+            for gravity in (1050, 1049, 1048):
+                tilts['Red'].process_decoded_values(gravity, 68, -70, 197)
+                await self.target.send(Snapshot.build(tilts))
+            self.assertEqual(len(self.target.outbox), 3)
+
+            # Once it's back, the next send is followed by the backlog, in batches
+            mock_post.reset_mock()
+            mock_post.return_value.status_code = 200
+            tilts['Red'].process_decoded_values(1047, 68, -70, 197)
+            await self.target.send(Snapshot.build(tilts))
+            self.target.close()
+
+            self.assertEqual([c.args[0] for c in mock_post.call_args_list],
+                             [self.target.target_url, self.target.backfill_url, self.target.backfill_url])
+            backfilled = [json.loads(c.kwargs['data']) for c in mock_post.call_args_list[1:]]
+            self.assertEqual([len(body['snapshots']) for body in backfilled], [2, 1])
+            self.assertEqual([s['tilts'][0]['raw_gravity'] for body in backfilled for s in body['snapshots']],
+                             ['1.05', '1.049', '1.048'])
+            self.assertIn('timestamp', backfilled[0]['snapshots'][0])
+            reopened = Outbox(os.path.join(tempdir, 'outbox.sqlite3'), self.target.name)
+            self.assertEqual(len(reopened), 0)
+            reopened.close()
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_failed_sends_are_dropped_without_backfill(self, mock_requests):
+        mock_requests.Session.return_value.post.return_value.status_code = 500
+        await self.target.send(Snapshot.build({}))
+        self.assertIsNone(self.target.outbox)
+
+    def make_tilts(self, count: int) -> dict:
+        tilts = {}
+        for i, color in enumerate(list(TiltHydrometer.tilt_colors)[:count]):
+            tilts[color] = TiltHydrometer(color)
+            tilts[color].process_decoded_values(1050 - i, 68, -70, 197)
+        return tilts
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_gzip_once_server_accepts_it(self, mock_requests):
+        mock_post = mock_requests.Session.return_value.post
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.headers = {'Accept-Encoding': 'gzip, deflate'}
+        snapshot = Snapshot.build(self.make_tilts(4))
+
+        await self.target.send(snapshot)
+        self.assertEqual(mock_post.call_args.kwargs['headers'], {'Content-Type': 'application/json'})
+
+        await self.target.send(snapshot)
+        self.assertEqual(mock_post.call_args.kwargs['headers'], {'Content-Type': 'application/json',
+                                                                 'Content-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(mock_post.call_args.kwargs['data']),
+                         LegacyFermentrackTarget.encode_payload(snapshot))
+
+        # Small bodies aren't worth compressing
+        await self.target.send(Snapshot.build({}))
+        self.assertEqual(mock_post.call_args.kwargs['headers'], {'Content-Type': 'application/json'})
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_gzip_turned_off_if_rejected(self, mock_requests):
+        mock_post = mock_requests.Session.return_value.post
+        rejected, accepted = mock.Mock(status_code=415, headers={}), mock.Mock(status_code=200, headers={})
+        mock_post.side_effect = [rejected, accepted, accepted]
+        self.target.gzip = True
+        snapshot = Snapshot.build(self.make_tilts(4))
+        failures = self.target.metric_send_failures.value
+
+        await self.target.send(snapshot)
+        # Retried uncompressed straight away, and never compressed again
+        self.assertEqual([c.kwargs['headers'].get('Content-Encoding') for c in mock_post.call_args_list],
+                         ['gzip', None])
+        self.assertEqual(self.target.metric_send_failures.value, failures)
+        await self.target.send(snapshot)
+        self.assertEqual(mock_post.call_args.kwargs['data'], LegacyFermentrackTarget.encode_payload(snapshot))
+
+    def test_accepts_gzip(self):
+        self.assertTrue(LegacyFermentrackTarget.accepts_gzip('gzip'))
+        self.assertTrue(LegacyFermentrackTarget.accepts_gzip('deflate, GZIP;q=0.5'))
+        self.assertFalse(LegacyFermentrackTarget.accepts_gzip('gzip;q=0, identity'))
+        self.assertFalse(LegacyFermentrackTarget.accepts_gzip('deflate'))
+        self.assertFalse(LegacyFermentrackTarget.accepts_gzip(None))
+
+    @mock.patch('data_targets.legacy_fermentrack_target.requests')
+    async def test_delta_resyncs_after_failure(self, mock_requests):
+        with mock.patch.dict(os.environ, {'FERMENTRACK_LEGACY_TARGET_ENABLED': 'true',
+                                          'FERMENTRACK_LEGACY_TARGET_URL': 'https://example.com/tiltbridge/',
+                                          'FERMENTRACK_LEGACY_TARGET_DELTA': 'true',
+                                          'FERMENTRACK_LEGACY_TARGET_GZIP': 'false'}):
+            self.target.load_config()
+        mock_post = mock_requests.Session.return_value.post
+        mock_post.return_value.status_code = 200
+        tilts = self.make_tilts(2)
+
+        await self.target.send(Snapshot.build(tilts))
+        self.assertEqual(len(json.loads(mock_post.call_args.kwargs['data'])['tilts']), 2)
+        tilts['Red'].process_decoded_values(1040, 68, -70, 197)
+        await self.target.send(Snapshot.build(tilts))
+        self.assertEqual(json.loads(mock_post.call_args.kwargs['data'])['tilts'],
+                         [{'color': 'Red', 'mac': None, 'raw_gravity': '1.04', 'smoothed_gravity': '1.045'}])
+
+        # Nothing new - nothing sent
+        await self.target.send(Snapshot.build(tilts))
+        self.assertEqual(mock_post.call_count, 2)
 
-        expected_tilt_dict = {'tilts': self.target.convert_tilts_to_list(tilts), 'tiltbridge_junior': True,}
-        mock_requests.post.assert_called_once_with(self.target.target_url, json=expected_tilt_dict, timeout=5)
+        mock_post.return_value.status_code = 500
+        tilts['Red'].process_decoded_values(1041, 68, -70, 197)
+        await self.target.send(Snapshot.build(tilts))
+        mock_post.return_value.status_code = 200
+        await self.target.send(Snapshot.build(tilts))
+        body = json.loads(mock_post.call_args.kwargs['data'])
+        self.assertNotIn('delta', body)
+        self.assertEqual(len(body['tilts']), 2)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import log_writer
+from log_writer import LogWriter, RateLimitFilter
+
+
+def record(msg: str, lineno: int = 1, *args) -> logging.LogRecord:
+    return logging.LogRecord("tilt", logging.INFO, "tiltbridge_junior.py", lineno, msg, args, None)
+
+
+class RateLimitFilterTests(unittest.TestCase):
+    def test_limits_each_call_site(self):
+        rate_limit = RateLimitFilter(2, interval=60)
+        with mock.patch('log_writer.time.monotonic_ns', return_value=0):
+            self.assertEqual([rate_limit.filter(record("Found Tilt")) for _ in range(4)], [True, True, False, False])
+            # Another line of code has a limit of its own
+            self.assertTrue(rate_limit.filter(record("Sent 1 Tilt(s) to Fermentrack", lineno=2)))
+
+        with mock.patch('log_writer.time.monotonic_ns', return_value=60 * 10 ** 9):
+            allowed = record("Found Tilt: %s", 1, 'Red')
+            self.assertTrue(rate_limit.filter(allowed))
+            self.assertEqual(allowed.getMessage(), "Found Tilt: Red (2 similar message(s) suppressed)")
+            self.assertTrue(rate_limit.filter(record("Found Tilt")))
+            self.assertFalse(rate_limit.filter(record("Found Tilt")))
+
+
+class LogWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'log', 'tiltbridge-jr.log')
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, 'handlers', list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        self.addCleanup(self.directory.cleanup)
+
+    def test_writes_records_in_background(self):
+        writer = LogWriter(self.path)
+        writer.start()
+        logging.getLogger("tilt").warning("Unable to connect to MQTT broker %s:%s", 'localhost', 1883)
+        writer.stop()
+        with open(self.path) as f:
+            self.assertRegex(f.read(), r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d WARNING : Unable to connect to MQTT broker "
+                                       r"localhost:1883\n$")
+
+    def test_rotates_by_size(self):
+        writer = LogWriter(self.path, max_bytes=1000, backup_count=2, rate_limit=0)
+        writer.start()
+        for x in range(100):
+            logging.getLogger("tilt").error("Error sending data to Fermentrack: %d", x)
+        writer.stop()
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.path))),
+                         ['tiltbridge-jr.log', 'tiltbridge-jr.log.1', 'tiltbridge-jr.log.2'])
+        for name in os.listdir(os.path.dirname(self.path)):
+            self.assertLessEqual(os.path.getsize(os.path.join(os.path.dirname(self.path), name)), 1000)
+        with open(self.path) as f:
+            self.assertTrue(f.read().endswith("Error sending data to Fermentrack: 99\n"))
+
+    def test_from_env(self):
+        with mock.patch.dict(os.environ, {"TILTBRIDGE_JR_LOG_FILE": self.path, "TILTBRIDGE_JR_LOG_MAX_BYTES": "2048",
+                                          "TILTBRIDGE_JR_LOG_BACKUP_COUNT": "5", "TILTBRIDGE_JR_LOG_RATE_LIMIT": "0"}):
+            writer = log_writer.log_writer_from_env()
+        self.assertEqual(writer.path, self.path)
+        self.assertEqual((writer.file_handler.maxBytes, writer.file_handler.backupCount), (2048, 5))
+        self.assertEqual(writer.rate_limit, 0)
+        writer.file_handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import metrics
+from tiltbridge_junior import process_ble_beacon
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.registered = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registered
+
+    def test_counter(self):
+        counter = metrics.Counter("test_events_total", "Events", ("kind",))
+        counter.labels("a").inc()
+        counter.labels("a").inc(2)
+        counter.labels("b\"c")
+
+        self.assertEqual(counter.render(), [
+            '# HELP test_events_total Events',
+            '# TYPE test_events_total counter',
+            'test_events_total{kind="a"} 3',
+            'test_events_total{kind="b\\"c"} 0',
+        ])
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("test_depth", "Depth")
+        gauge.set(2)
+        self.assertEqual(gauge.render()[-1], 'test_depth 2')
+        gauge.set_function(lambda: 7)
+        self.assertEqual(gauge.render()[-1], 'test_depth 7')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 5.65',
+            'test_seconds_count 4',
+        ])
+
+    def test_render_includes_pipeline_metrics(self):
+        received = metrics.frames_received.value
+        not_tilt = metrics.frames_dropped_not_tilt.value
+
+        process_ble_beacon(b'\x04\x3e\x0c\x02\x01\x00\x00\x01\x02\x03\x04\x05\x06\x00\xc0')
+
+        self.assertEqual(metrics.frames_received.value, received + 1)
+        self.assertEqual(metrics.frames_dropped_not_tilt.value, not_tilt + 1)
+        rendered = metrics.render().decode()
+        self.assertIn(f'tiltbridge_frames_dropped_total{{reason="not_tilt"}} {not_tilt + 1}\n', rendered)
+        self.assertIn('# TYPE tiltbridge_target_send_seconds histogram\n', rendered)
+
+
+if __name__ == '__main__':
+    unittest.main()
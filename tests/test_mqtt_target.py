@@ -0,0 +1,222 @@
+import asyncio
+import json
+import struct
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+from TiltHydrometer import TiltHydrometer
+from data_targets import mqtt_client
+from data_targets.mqtt_target import MQTTTarget
+from data_targets.snapshot import Snapshot
+
+
+class FakeBroker:
+    """Just enough of an MQTT broker to accept a connection and record what is published to it"""
+
+    def __init__(self, ack: bool = True, connack: bool = True):
+        self.ack = ack
+        self.connack = connack
+        self.server = None
+        self.handlers = set()
+        self.connects = 0
+        self.published = []  # (topic, payload, qos, retain)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        # The client sends DISCONNECT when it is closed, so every connection should be wrapping up
+        await asyncio.wait_for(asyncio.gather(*self.handlers), 1)
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                header, body = await mqtt_client.read_packet(reader)
+                packet_type = header & 0xf0
+                if packet_type == mqtt_client.CONNECT:
+                    self.connects += 1
+                    if self.connack:
+                        writer.write(mqtt_client.packet(mqtt_client.CONNACK, b'\x00\x00'))
+                elif packet_type == mqtt_client.PUBLISH:
+                    qos, retain = (header >> 1) & 0x03, bool(header & 0x01)
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos > 0:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        if self.ack:
+                            writer.write(mqtt_client.packet(mqtt_client.PUBACK, packet_id))
+                    self.published.append((topic, body[offset:], qos, retain))
+                elif packet_type == mqtt_client.DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class MQTTTargetTests(AsyncTestCase):
+    def setUp(self):
+        self.target = MQTTTarget()
+        self.target.enabled = True
+        self.target.host = '127.0.0.1'
+        self.tilts = {
+            'Red': TiltHydrometer('Red'),
+            'Green': TiltHydrometer('Green'),
+        }
+        self.tilts['Red'].process_decoded_values(1050, 68, -80, 197)
+        self.tilts['Red'].mac = 'AA:BB:CC:DD:EE:FF'
+        self.tilts['Green'].process_decoded_values(1040, 70, -85, 12)
+        # Metric children are shared by every instance of a target
+        self.failures = self.target.metric_send_failures.value
+
+    async def start_broker(self, ack: bool = True, connack: bool = True) -> FakeBroker:
+        broker = FakeBroker(ack, connack)
+        self.target.port = await broker.start()
+        return broker
+
+    async def stop_broker(self, broker: FakeBroker):
+        self.target.close()
+        await broker.stop()
+
+    def test_device_id(self):
+        self.assertEqual(MQTTTarget.device_id(self.tilts['Red'].to_dict()), 'red_AABBCCDDEEFF')
+        self.assertEqual(MQTTTarget.device_id(self.tilts['Green'].to_dict()), 'green_unknown')
+
+    async def test_publishes_state_and_discovery(self):
+        broker = await self.start_broker()
+        try:
+            await self.target.send(Snapshot.build(self.tilts))
+        finally:
+            await self.stop_broker(broker)
+
+        topics = [topic for topic, _, _, _ in broker.published]
+        sensors = len(MQTTTarget.SENSORS)
+        self.assertEqual(len(topics), 2 * (sensors + 1))
+        self.assertIn('tiltbridge_junior/red_AABBCCDDEEFF/state', topics)
+        self.assertIn('homeassistant/sensor/tiltbridge_junior_red_AABBCCDDEEFF_gravity/config', topics)
+        # Everything is retained, so subscribers (and Home Assistant) get the latest state when they connect
+        self.assertTrue(all(retain for _, _, _, retain in broker.published))
+
+        published = {topic: payload for topic, payload, _, _ in broker.published}
+        state = json.loads(published['tiltbridge_junior/red_AABBCCDDEEFF/state'])
+        self.assertEqual(state['gravity'], 1.050)
+        self.assertEqual(state['temperature'], 68.0)
+        config = json.loads(published['homeassistant/sensor/tiltbridge_junior_red_AABBCCDDEEFF_temperature/config'])
+        self.assertEqual(config['state_topic'], 'tiltbridge_junior/red_AABBCCDDEEFF/state')
+        self.assertEqual(config['unit_of_measurement'], '°F')
+        # No bridge device is published, so there's nothing for via_device to point at
+        self.assertNotIn('via_device', config['device'])
+
+    async def test_only_publishes_changes(self):
+        self.target.qos = 1  # So that each send() has been received by the broker when it returns
+        broker = await self.start_broker()
+        try:
+            snapshot = Snapshot.build(self.tilts)
+            await self.target.send(snapshot)
+            first_batch = len(broker.published)
+
+            # Nothing has changed, so nothing is published (and discovery isn't repeated)
+            await self.target.send(Snapshot.build(self.tilts))
+            self.assertEqual(len(broker.published), first_batch)
+
+            self.tilts['Red'].process_decoded_values(1052, 68, -80, 197)
+            await self.target.send(Snapshot.build(self.tilts, snapshot))
+        finally:
+            await self.stop_broker(broker)
+
+        self.assertEqual([topic for topic, _, _, _ in broker.published[first_batch:]],
+                         ['tiltbridge_junior/red_AABBCCDDEEFF/state'])
+        self.assertEqual(broker.connects, 1)
+
+    async def test_discovery_disabled(self):
+        self.target.discovery_prefix = None
+        broker = await self.start_broker()
+        try:
+            await self.target.send(Snapshot.build(self.tilts))
+            await asyncio.sleep(0.05)
+        finally:
+            await self.stop_broker(broker)
+        self.assertEqual(len(broker.published), 2)
+
+    async def test_qos1_waits_for_acks(self):
+        self.target.qos = 1
+        broker = await self.start_broker()
+        try:
+            await self.target.send(Snapshot.build(self.tilts))
+            # With QoS 1, send() only returns once the broker has acknowledged every message
+            self.assertEqual(len(broker.published), 2 * (len(MQTTTarget.SENSORS) + 1))
+            self.assertTrue(all(qos == 1 for _, _, qos, _ in broker.published))
+            self.assertEqual(self.target.client.pending_acks, {})
+        finally:
+            await self.stop_broker(broker)
+        self.assertEqual(self.target.metric_send_failures.value - self.failures, 0)
+
+    async def test_qos1_unacknowledged_is_retried(self):
+        self.target.qos = 1
+        broker = await self.start_broker(ack=False)
+        mqtt_client.MQTTClient.ACK_TIMEOUT, ack_timeout = 0.1, mqtt_client.MQTTClient.ACK_TIMEOUT
+        try:
+            await self.target.send(Snapshot.build(self.tilts))
+        finally:
+            mqtt_client.MQTTClient.ACK_TIMEOUT = ack_timeout
+            await self.stop_broker(broker)
+
+        self.assertEqual(self.target.metric_send_failures.value - self.failures, 1)
+        # Nothing was marked as published, so it is all sent again next time
+        self.assertEqual(self.target.published_state, {})
+        self.assertEqual(self.target.discovered, set())
+
+    async def test_connection_failure(self):
+        broker = await self.start_broker()
+        await broker.stop()
+
+        await self.target.send(Snapshot.build(self.tilts))
+        self.assertEqual(self.target.metric_send_failures.value - self.failures, 1)
+        self.assertEqual(self.target.published_state, {})
+
+        # Reconnection attempts are rate limited
+        await self.target.send(Snapshot.build(self.tilts))
+        self.assertEqual(self.target.metric_send_failures.value - self.failures, 2)
+        self.target.close()
+
+    async def test_reconnects_after_connection_lost(self):
+        broker = await self.start_broker()
+        try:
+            await self.target.send(Snapshot.build(self.tilts))
+            client = self.target.client
+            ping_task = client.ping_task
+            with self.assertLogs("tilt", "WARNING"):
+                client.reader.feed_eof()  # As if the broker had gone away
+                await asyncio.sleep(0.01)
+            self.assertFalse(client.connected)
+            self.assertTrue(ping_task.cancelled())  # It doesn't carry on pinging a closed connection
+
+            self.target.last_connect_attempt = None
+            self.tilts['Red'].process_decoded_values(1052, 68, -80, 197)
+            await self.target.send(Snapshot.build(self.tilts))
+            self.assertIsNot(self.target.client, client)
+            self.assertTrue(self.target.client.connected)
+        finally:
+            await self.stop_broker(broker)
+        self.assertEqual(broker.connects, 2)
+
+    async def test_connection_not_acknowledged(self):
+        broker = await self.start_broker(connack=False)
+        try:
+            with mock.patch.object(mqtt_client.MQTTClient, 'ACK_TIMEOUT', 0.05), \
+                    self.assertLogs("tilt", "ERROR") as logs:
+                await self.target.send(Snapshot.build(self.tilts))
+            self.assertIn("Timed out connecting to the broker", logs.output[0])
+            # The half-open connection was closed, rather than treated as connected
+            self.assertFalse(self.target.client.connected)
+            self.assertEqual(self.target.metric_send_failures.value - self.failures, 1)
+        finally:
+            await self.stop_broker(broker)
@@ -0,0 +1,83 @@
+import datetime
+import os
+import tempfile
+import time
+import unittest
+
+from data_targets.outbox import Outbox
+
+
+class OutboxTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'outbox.sqlite3')
+        self.outbox = Outbox(self.path, 'Test Target')
+
+    def tearDown(self):
+        self.outbox.close()
+        self.tempdir.cleanup()
+
+    def stored(self, outbox: Outbox = None) -> int:
+        outbox = outbox or self.outbox
+        return outbox.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def test_appends_are_batched(self):
+        for x in range(Outbox.COMMIT_SIZE - 1):
+            self.outbox.append(b'%d' % x)
+        self.assertEqual(self.stored(), 0)  # Nothing written to disk yet
+        self.assertEqual(len(self.outbox), Outbox.COMMIT_SIZE - 1)
+
+        self.outbox.append(b'last')
+        self.assertEqual(self.stored(), Outbox.COMMIT_SIZE)
+        self.assertEqual(len(self.outbox), Outbox.COMMIT_SIZE)
+
+    def test_peek_and_remove_in_order(self):
+        for x in range(5):
+            self.outbox.append(b'%d' % x)
+
+        entries = self.outbox.peek(3)
+        self.assertEqual([payload for _, _, payload in entries], [b'0', b'1', b'2'])
+        self.assertEqual(len(self.outbox), 5)  # peek doesn't remove anything
+
+        self.outbox.remove(entries)
+        self.assertEqual([payload for _, _, payload in self.outbox.peek(10)], [b'3', b'4'])
+        self.assertEqual(len(self.outbox), 2)
+
+    def test_evicts_oldest_when_full(self):
+        self.outbox.max_entries = 3
+        for x in range(5):
+            self.outbox.append(b'%d' % x)
+        self.outbox.commit()
+
+        self.assertEqual([payload for _, _, payload in self.outbox.peek(10)], [b'2', b'3', b'4'])
+        self.assertEqual(len(self.outbox), 3)
+
+    def test_evicts_expired(self):
+        self.outbox.max_age = datetime.timedelta(hours=1)
+        self.outbox.append(b'old', created=time.time() - 2 * 60 * 60)
+        self.outbox.append(b'new')
+        self.outbox.commit()
+
+        self.assertEqual([payload for _, _, payload in self.outbox.peek(10)], [b'new'])
+
+    def test_survives_restart(self):
+        self.outbox.append(b'unsent')
+        self.outbox.close()  # Pending appends are written on close
+
+        self.outbox = Outbox(self.path, 'Test Target')
+        self.assertEqual(len(self.outbox), 1)
+        self.assertEqual(self.outbox.peek(10)[0][2], b'unsent')
+
+    def test_targets_are_separate(self):
+        other = Outbox(self.path, 'Other Target')
+        try:
+            self.outbox.append(b'mine')
+            other.append(b'theirs')
+            self.assertEqual([payload for _, _, payload in self.outbox.peek(10)], [b'mine'])
+            self.assertEqual([payload for _, _, payload in other.peek(10)], [b'theirs'])
+        finally:
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
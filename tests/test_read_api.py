@@ -0,0 +1,75 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+import http_server
+from hydrometer_registry import HydrometerRegistry
+from read_api import ReadAPI
+
+
+class ReadAPITests(AsyncTestCase):
+    def setUp(self):
+        self.tilts = HydrometerRegistry()
+        self.red = self.tilts.lookup(bytes.fromhex('a495bb10c5b14b44b5121370f02d74de'), b'\x01\x02\x03\x04\x05\x06')
+        self.red.process_decoded_values(1050, 68, -70, 197)
+        self.api = ReadAPI(self.tilts)
+        self.api.REFRESH_INTERVAL = 0
+
+    async def get(self, if_none_match=None) -> http_server.Response:
+        headers = {'if-none-match': if_none_match} if if_none_match else {}
+        return await self.api.serve_tilts(http_server.Request('GET', '/api/tilts', '', headers), None)
+
+    async def test_serves_readings_with_etag(self):
+        response = await self.get()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.body), {'tilts': [self.red.to_dict()]})
+        etag = response.headers['ETag']
+
+        # Nothing has changed
+        not_modified = await self.get(etag)
+        self.assertEqual(not_modified.status, 304)
+        self.assertEqual(not_modified.body, b'')
+
+        self.red.process_decoded_values(1049, 68, -70, 197)
+        changed = await self.get(etag)
+        self.assertEqual(changed.status, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertEqual(json.loads(changed.body)['tilts'][0]['raw_gravity'], '1.049')
+
+    async def test_response_is_shared_between_requests(self):
+        self.api.REFRESH_INTERVAL = 60
+        first = await self.get()
+        with mock.patch('read_api.Snapshot.build') as mock_build:
+            second = await self.get()
+        mock_build.assert_not_called()
+        self.assertIs(first.body, second.body)
+
+    async def test_stream(self):
+        self.api.STREAM_INTERVAL = 0.01
+        server = http_server.HTTPServer()
+        self.api.add_routes(server)
+        await server.start('127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(b'GET /api/tilts/stream HTTP/1.1\r\n\r\n')
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 1)
+            first = await asyncio.wait_for(reader.readuntil(b'\n\n'), 1)
+
+            self.red.process_decoded_values(1049, 68, -70, 197)
+            second = await asyncio.wait_for(reader.readuntil(b'\n\n'), 1)
+            writer.close()
+        finally:
+            await server.stop()
+
+        self.assertIn(b'Content-Type: text/event-stream\r\n', head)
+        self.assertIn(b'event: tilts\n', first)
+        data = [line for line in second.split(b'\n') if line.startswith(b'data: ')][0]
+        self.assertEqual(json.loads(data[6:])['tilts'][0]['raw_gravity'], '1.049')
+
+
+if __name__ == '__main__':
+    unittest.main()
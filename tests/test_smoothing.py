@@ -0,0 +1,197 @@
+import os
+import statistics
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+import metrics
+import smoothing
+from hydrometer_registry import HydrometerRegistry
+from TiltHydrometer import TiltHydrometer
+
+SECOND = 10 ** 9
+
+
+class TimeWindowSmootherTests(unittest.TestCase):
+    def test_weighted_by_time(self):
+        smoother = smoothing.TimeWindowSmoother(300 * SECOND)
+        smoother.add(1000, 0)
+        self.assertEqual(smoother.value(), 1000)
+        # 1000 for 100s, then a burst of readings of 1100 over 10s - the burst shouldn't dominate
+        smoother.add(1100, 100 * SECOND)
+        for second in range(101, 111):
+            smoother.add(1100, second * SECOND)
+        self.assertEqual(smoother.value(), round((1000 * 100 + 1100 * 10) / 110))
+
+    def test_old_readings_leave_the_window(self):
+        smoother = smoothing.TimeWindowSmoother(60 * SECOND)
+        for second in range(0, 120, 10):
+            smoother.add(1000 if second < 60 else 1010, second * SECOND)
+        # The reading at 50s was the latest until 60s, so it counts for the first 10s of the window
+        self.assertEqual(smoother.value(), round((1000 * 10 + 1010 * 50) / 60))
+        self.assertEqual(smoother.weighted_sum, (1000 * 10 + 1010 * 50) * SECOND)
+
+        smoother.clear()
+        self.assertEqual(smoother.value(), 0)
+
+
+class EWMASmootherTests(unittest.TestCase):
+    def test_weighted_by_time_between_readings(self):
+        smoother = smoothing.EWMASmoother(60 * SECOND)
+        smoother.add(1000, 0)
+        smoother.add(1100, 30 * SECOND)  # One time constant later
+        self.assertAlmostEqual(smoother.average, 1000 + 100 * (1 - 1 / 2.718281828), places=3)
+
+        # Many readings close together move the average about as far as one reading after the same time
+        burst = smoothing.EWMASmoother(60 * SECOND)
+        burst.add(1000, 0)
+        for second in range(1, 31):
+            burst.add(1100, second * SECOND)
+        self.assertAlmostEqual(burst.average, smoother.average, delta=0.5)
+
+    def test_clear(self):
+        smoother = smoothing.EWMASmoother(60 * SECOND)
+        smoother.add(1000, 0)
+        smoother.clear()
+        smoother.add(1050, SECOND)
+        self.assertEqual(smoother.value(), 1050)
+
+
+class MedianSmootherTests(unittest.TestCase):
+    def test_rolling_median(self):
+        smoother = smoothing.MedianSmoother(5)
+        values = [1050, 1048, 1200, 1049, 1047, 1046, 900, 1045, 1044]
+        for i, value in enumerate(values):
+            smoother.add(value, i)
+            window = values[max(0, i - 4):i + 1]
+            self.assertEqual(sorted(window), smoother.sorted)
+            self.assertEqual(smoother.value(), round(statistics.median(window)))
+
+    def test_count_within(self):
+        smoother = smoothing.MedianSmoother(10)
+        for value in (1040, 1045, 1049, 1050, 1050, 1051, 1060):
+            smoother.add(value, 0)
+        self.assertEqual(smoother.count_within(1050, 0), 2)
+        self.assertEqual(smoother.count_within(1050, 1), 4)
+        self.assertEqual(smoother.count_within(1050, 10), 7)
+
+
+class HampelSmootherTests(unittest.TestCase):
+    def test_outliers_replaced_by_median(self):
+        smoother = smoothing.HampelSmoother(10, 3)
+        outliers = metrics.hydrometer_outliers.value
+        for value in [1050, 1051, 1050, 1049, 1050, 1051, 1050]:
+            smoother.add(value, 0)
+        smoother.add(1200, 0)  # A bad packet
+        self.assertEqual(smoother.value(), 1050)
+        self.assertEqual(metrics.hydrometer_outliers.value, outliers + 1)
+        self.assertEqual(smoother.cleaned_sum, 1050 * 2 + 1051 * 2 + 1049 + 1050 * 3)
+
+    def test_matches_reference_filter(self):
+        window, threshold = 15, 2
+        values = [1040 + (x * 7) % 23 for x in range(100)]
+        values[20], values[50], values[51] = 1200, 900, 1300
+        smoother = smoothing.HampelSmoother(window, threshold)
+        cleaned = []
+        for i, value in enumerate(values):
+            smoother.add(value, 0)
+            previous = values[max(0, i - window):i]
+            if len(previous) >= smoothing.HampelSmoother.MIN_READINGS:
+                median = smoothing.round_div(sum(sorted(previous)[(len(previous) - 1) // 2:len(previous) // 2 + 1]),
+                                             2 - len(previous) % 2)
+                deviations = sorted(abs(x - median) for x in previous)
+                mad = deviations[(len(deviations) - 1) // 2]
+                if abs(value - median) > threshold * max(smoothing.HampelSmoother.MAD_SCALE * mad, 1):
+                    value = median
+            cleaned.append(value)
+            self.assertEqual(smoother.value(), smoothing.round_div(sum(cleaned[-window:]), len(cleaned[-window:])))
+
+    def test_step_change_accepted(self):
+        smoother = smoothing.HampelSmoother(10, 3)
+        for value in [1050] * 10 + [1060] * 5:
+            smoother.add(value, 0)
+        self.assertLess(smoother.value(), 1055)
+        # Once the new level is the majority of the window it is no longer an outlier, and once the readings that were
+        # treated as outliers have left the window, the step is fully reflected
+        for value in [1060] * 10:
+            smoother.add(value, 0)
+        self.assertEqual(smoother.value(), 1060)
+
+
+class StrategyTests(unittest.TestCase):
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            smoothing.Strategy('mode')
+
+    def test_apply(self):
+        tilt = TiltHydrometer('Red')
+        smoothing.Strategy('median', window=5).apply(tilt)
+        self.assertEqual(tilt.smoothing_window, 5)
+        for gravity in (1050, 1052, 1300, 1051, 1049):
+            tilt.process_decoded_values(gravity, 68, -70, 197)
+        self.assertEqual(tilt.smoothed_gravity(), Decimal('1.051'))
+        self.assertEqual(tilt.smoothed_temp(), Decimal(68))
+        self.assertEqual(list(tilt.gravity_list), [1050, 1052, 1300, 1051, 1049])
+
+        # Switching between a Tilt Classic and Pro clears the smoothers along with the window
+        tilt.process_decoded_values(10500, 680, -70, 197)
+        self.assertEqual(tilt.smoothed_gravity(), Decimal('1.0500'))
+        self.assertEqual(tilt.smoothed_temp(), Decimal('68.0'))
+
+    def test_time_strategy_extends_expiry(self):
+        tilt = TiltHydrometer('Red')
+        smoothing.Strategy('time', seconds=3600).apply(tilt)
+        self.assertEqual(tilt.cache_expiry_ns, 7200 * SECOND)
+        smoothing.Strategy('ewma', seconds=10).apply(tilt)
+        self.assertEqual(tilt.cache_expiry_ns, 288 * SECOND)
+
+    def test_config_from_env(self):
+        with mock.patch.dict(os.environ, {'TILTBRIDGE_JR_SMOOTHING': 'EWMA', 'TILTBRIDGE_JR_SMOOTHING_SECONDS': '120',
+                                          'TILTBRIDGE_JR_SMOOTHING_RED': 'hampel',
+                                          'TILTBRIDGE_JR_SMOOTHING_BLUE': 'bogus'}):
+            config = smoothing.config_from_env()
+        self.assertEqual(config.default.name, 'ewma')
+        self.assertEqual(config.default.seconds, 120)
+        self.assertEqual(config.strategy_for('Red').name, 'hampel')
+        self.assertIs(config.strategy_for('Blue'), config.default)
+
+    def test_registry_applies_strategy(self):
+        registry = HydrometerRegistry(smoothing.SmoothingConfig(colors={'Red': smoothing.Strategy('ewma')}))
+        red = registry.lookup(bytes.fromhex('a495bb10c5b14b44b5121370f02d74de'), b'\x01\x02\x03\x04\x05\x06')
+        green = registry.lookup(bytes.fromhex('a495bb20c5b14b44b5121370f02d74de'), b'\x01\x02\x03\x04\x05\x06')
+        self.assertIsInstance(red.gravity_smoother, smoothing.EWMASmoother)
+        self.assertIsNone(green.gravity_smoother)
+
+    def test_registry_switches_changed_strategies(self):
+        registry = HydrometerRegistry(smoothing.SmoothingConfig())
+        red = registry.lookup(bytes.fromhex('a495bb10c5b14b44b5121370f02d74de'), b'\x01\x02\x03\x04\x05\x06')
+        green = registry.lookup(bytes.fromhex('a495bb20c5b14b44b5121370f02d74de'), b'\x01\x02\x03\x04\x05\x06')
+        for gravity in (1050, 1052, 1300, 1051, 1049):
+            red.process_decoded_values(gravity, 68, -70, 197)
+            green.process_decoded_values(gravity, 68, -70, 197)
+
+        # A change to a parameter the mean doesn't use (seconds) leaves Green alone
+        switched = registry.set_smoothing(smoothing.SmoothingConfig(smoothing.Strategy('mean', seconds=60), colors={
+            'Red': smoothing.Strategy('median', window=3)}))
+        self.assertEqual(switched, 1)
+        self.assertIsInstance(red.gravity_smoother, smoothing.MedianSmoother)
+        # Red carries on from the newest readings in its window
+        self.assertEqual(list(red.gravity_list), [1300, 1051, 1049])
+        self.assertEqual(red.smoothed_gravity(), Decimal('1.051'))
+        red.process_decoded_values(1048, 68, -70, 197)
+        self.assertEqual(list(red.gravity_list), [1051, 1049, 1048])
+        self.assertEqual(red.smoothed_gravity(), Decimal('1.049'))
+        self.assertIsNone(green.gravity_smoother)
+        self.assertEqual(list(green.gravity_list), [1050, 1052, 1300, 1051, 1049])
+
+        # Readings carried over to a time-based smoother start it off at their mean
+        registry.set_smoothing(smoothing.SmoothingConfig(colors={'Red': smoothing.Strategy('ewma', seconds=60)}))
+        self.assertIsInstance(red.gravity_smoother, smoothing.EWMASmoother)
+        self.assertEqual(red.smoothed_gravity(), Decimal('1.049'))
+        self.assertEqual(red.smoothed_temp(), Decimal(68))
+
+        # The window still reaches a hydrometer using a time-based smoother
+        switched = registry.set_smoothing(smoothing.SmoothingConfig(colors={
+            'Red': smoothing.Strategy('ewma', window=30, seconds=60)}))
+        self.assertEqual(switched, 1)
+        self.assertEqual(red.smoothing_window, 30)
@@ -0,0 +1,48 @@
+import json
+import unittest
+import time
+
+from TiltHydrometer import TiltHydrometer
+from data_targets.snapshot import Snapshot
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.tilts = {
+            'Red': TiltHydrometer('Red'),
+            'Green': TiltHydrometer('Green'),
+        }
+        self.tilts['Red'].process_decoded_values(1050, 68, -80, 197)
+        self.tilts['Green'].process_decoded_values(10500, 680, -85, 12)
+
+    def test_build(self):
+        snapshot = Snapshot.build(self.tilts)
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.tilts, [self.tilts['Red'].to_dict(), self.tilts['Green'].to_dict()])
+        self.assertEqual(json.loads(snapshot.tilts_json), snapshot.tilts)
+
+    def test_build_skips_expired(self):
+        self.tilts['Green'].last_value_received_ns = time.monotonic_ns() - 24 * 3600 * 10 ** 9
+        snapshot = Snapshot.build(self.tilts)
+        self.assertEqual(snapshot.tilts, [self.tilts['Red'].to_dict()])
+        self.assertEqual(json.loads(snapshot.tilts_json), snapshot.tilts)
+
+    def test_build_reuses_unchanged_snapshot(self):
+        snapshot = Snapshot.build(self.tilts)
+        self.assertIs(Snapshot.build(self.tilts, snapshot), snapshot)
+
+        self.tilts['Red'].process_decoded_values(1051, 68, -80, 197)
+        new_snapshot = Snapshot.build(self.tilts, snapshot)
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertEqual(new_snapshot.tilts[0]['raw_gravity'], '1.051')
+        # Hydrometers without new readings reuse their cached serialization
+        self.assertIs(new_snapshot.tilts[1], snapshot.tilts[1])
+
+    def test_build_empty(self):
+        snapshot = Snapshot.build({})
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(json.loads(snapshot.tilts_json), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import asyncio
+import signal
+import sys
+import time
+import unittest
+
+import supervisor
+from supervisor import CONTEXT, SupervisedProcess, Supervisor
+
+SECOND = 10 ** 9
+
+
+def exit_with(code: int):
+    sys.exit(code)
+
+
+def sleep_forever():
+    time.sleep(60)
+
+
+def wait_for_terminate(ready, cleaned_up):
+    async def main():
+        ready.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            cleaned_up.set()
+
+    supervisor.run_until_terminated(main())
+
+
+def wait_for_hangup(ready, hung_up):
+    signal.signal(signal.SIGHUP, lambda signum, frame: hung_up.set())
+    ready.set()
+    time.sleep(60)
+
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.restarts = 0
+
+    def count_restart(self):
+        self.restarts += 1
+
+    def test_restarts_exited_process(self):
+        child = SupervisedProcess("exiting", exit_with, (3,), on_restart=self.count_restart)
+        supervisor_ = Supervisor([child])
+        child.start()
+        child.process.join()
+        with self.assertLogs("tilt", "ERROR") as logs:
+            supervisor_.check()
+        self.assertIn("exiting process exited with code 3 - restarting it", logs.output[0])
+        self.assertEqual(self.restarts, 1)
+        self.assertIsNotNone(child.process)
+
+        # Failing again straight away gets a delay before the next restart
+        child.process.join()
+        now_ns = child.started_ns + SECOND
+        with self.assertLogs("tilt", "ERROR") as logs:
+            supervisor_.check(now_ns)
+        self.assertIn("restarting it in 1 seconds", logs.output[0])
+        self.assertIsNone(child.process)
+        supervisor_.check(now_ns + SECOND // 2)
+        self.assertIsNone(child.process)
+        supervisor_.check(now_ns + SECOND)
+        self.assertIsNotNone(child.process)
+        self.assertEqual(self.restarts, 2)
+        supervisor_.stop()
+
+    def test_restarts_hung_process(self):
+        child = SupervisedProcess("hung", sleep_forever, heartbeat=lambda: 0, on_restart=self.count_restart)
+        supervisor_ = Supervisor([child])
+        supervisor_.HEARTBEAT_TIMEOUT = 1
+        child.start()
+        first = child.process
+        supervisor_.check(child.started_ns + SECOND // 2)
+        self.assertIs(child.process, first)
+
+        with self.assertLogs("tilt", "ERROR") as logs:
+            supervisor_.check(child.started_ns + 2 * SECOND)
+        self.assertIn("hasn't sent a heartbeat for 2 seconds", logs.output[0])
+        self.assertFalse(first.is_alive())
+        self.assertIsNot(child.process, first)
+        self.assertEqual(self.restarts, 1)
+        supervisor_.stop()
+        self.assertIsNone(child.process)
+
+    def test_stop_lets_process_clean_up(self):
+        ready, cleaned_up = CONTEXT.Event(), CONTEXT.Event()
+        child = SupervisedProcess("clean", wait_for_terminate, (ready, cleaned_up))
+        child.start()
+        process = child.process
+        self.assertTrue(ready.wait(10))
+        Supervisor([child]).stop()
+        self.assertTrue(cleaned_up.is_set())
+        self.assertEqual(process.exitcode, 0)
+
+    def test_forwards_sighup(self):
+        ready, hung_up = CONTEXT.Event(), CONTEXT.Event()
+        child = SupervisedProcess("reloading", wait_for_hangup, (ready, hung_up))
+        supervisor_ = Supervisor([child])
+        child.start()
+        self.assertTrue(ready.wait(10))
+        supervisor_._forward_signal(signal.SIGHUP, None)
+        self.assertTrue(hung_up.wait(10))
+        self.assertTrue(child.process.is_alive())
+        supervisor_.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import struct
+import unittest
+
+import ble_capture
+import tilt_decoder
+from tiltbridge_junior import decode_with_aioblescan
+from TiltHydrometer import TiltHydrometer
+
+
+# Real packet from a Yellow Tilt Pro (Gravity: 10345, Temperature: 728, TX Pwr: 197, RSSI: -65)
+TILT_PRO_FRAME = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
+# The same packet, with the UUID changed to a495bb71-c5b1-4b44-b512-1370f02d74de (not a valid color)
+INVALID_COLOR_FRAME = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbq\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
+# The same packet, delivered as an LE Extended Advertising Report (as seen on adapters that support extended scanning)
+TILT_PRO_EXT_FRAME = b'\x04>8\r\x01\x10\x00\x01\xc9\xf7\xd0\xcfz\xdf\x01\x00\xff\x7f\xbf\x00\x00\x00\x00\x00\x00\x00\x00\x00\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5'
+# An iBeacon that isn't a Tilt (UUID doesn't end in 1370f02d74de)
+OTHER_IBEACON_FRAME = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xdf\x02\xd8(i\xc5\xbf'
+# A non-Apple manufacturer specific data advertisement of the same length
+NON_APPLE_FRAME = b'\x04>*\x02\x01\x00\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x06\x1a\xff\x06\x00\x01\t \x02\xd0\x1b\x8bG\xb7\xa1\x02\xb3\x9b\xc2\xdf\x0c\xa6\xbbb\x16\x8a\x8c\xe7\xc8\xb5'
+
+
+class TiltDecoderTests(unittest.TestCase):
+    def test_decode_tilt_frame(self):
+        uuid, mac, temp, gravity, tx_pwr, rssi = tilt_decoder.decode_tilt_frame(TILT_PRO_FRAME)
+        self.assertEqual(TiltHydrometer.color_lookup_table_bytes[uuid], 'Yellow')
+        self.assertEqual(tilt_decoder.format_mac(mac), 'df:7a:cf:d0:f7:c9')
+        self.assertEqual((temp, gravity, tx_pwr, rssi), (728, 10345, 197, -65))
+
+    def test_decode_matches_aioblescan(self):
+        """The fast path needs to give identical results to the aioblescan path for every frame it handles"""
+        for frame in (TILT_PRO_FRAME, INVALID_COLOR_FRAME, TILT_PRO_EXT_FRAME, OTHER_IBEACON_FRAME, NON_APPLE_FRAME):
+            with self.subTest(frame=frame):
+                self.assertEqual(tilt_decoder.decode_tilt_frame(frame), decode_with_aioblescan(frame))
+
+    def test_decode_memoryview(self):
+        self.assertEqual(tilt_decoder.decode_tilt_frame(memoryview(TILT_PRO_FRAME)),
+                         tilt_decoder.decode_tilt_frame(TILT_PRO_FRAME))
+
+    def test_decode_rejects_non_tilt(self):
+        self.assertIsNone(tilt_decoder.decode_tilt_frame(b''))
+        self.assertIsNone(tilt_decoder.decode_tilt_frame(b'1234567890'))
+        self.assertIsNone(tilt_decoder.decode_tilt_frame(OTHER_IBEACON_FRAME))
+        self.assertIsNone(tilt_decoder.decode_tilt_frame(NON_APPLE_FRAME))
+
+    def test_decode_multiple_reports_falls_back(self):
+        # Bump num_reports to 2 - the fast path only handles single-report events
+        frame = TILT_PRO_FRAME[:4] + b'\x02' + TILT_PRO_FRAME[5:]
+        self.assertIs(tilt_decoder.decode_tilt_frame(frame), tilt_decoder.FALLBACK)
+
+    def test_decode_inconsistent_length_falls_back(self):
+        # Claim more advertising data than the frame actually contains
+        frame = TILT_PRO_FRAME[:13] + b'\x30' + TILT_PRO_FRAME[14:]
+        self.assertIs(tilt_decoder.decode_tilt_frame(frame), tilt_decoder.FALLBACK)
+
+
+class DecodeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = tilt_decoder.DecodeCache(size=2)
+
+    def test_matches_decode_tilt_frame(self):
+        frames = [frame for _, frame in ble_capture.synthetic_frames(2000, tilt_fraction=0.5)]
+        frames += [INVALID_COLOR_FRAME, TILT_PRO_EXT_FRAME, OTHER_IBEACON_FRAME, NON_APPLE_FRAME, b'']
+        cache = tilt_decoder.DecodeCache()
+        for frame in frames:
+            with self.subTest(frame=frame):
+                self.assertEqual(cache.decode(frame), tilt_decoder.decode_tilt_frame(frame))
+        self.assertGreater(cache.hits.value, 0)
+
+    def test_repeat_reads_fresh_rssi(self):
+        self.assertEqual(self.cache.decode(TILT_PRO_FRAME)[5], -65)
+        self.assertEqual((self.cache.hits.value, self.cache.misses.value), (0, 1))
+        stronger = TILT_PRO_FRAME[:-1] + b'\xd0'  # RSSI -48
+        self.assertEqual(self.cache.decode(stronger), tilt_decoder.decode_tilt_frame(stronger))
+        self.assertEqual((self.cache.hits.value, self.cache.misses.value), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        gravity_frames = [TILT_PRO_FRAME[:-4] + struct.pack('>H', gravity) + TILT_PRO_FRAME[-2:]
+                          for gravity in (10340, 10341, 10342)]
+        self.cache.decode(gravity_frames[0])
+        self.cache.decode(gravity_frames[1])
+        self.cache.decode(gravity_frames[0])  # gravity_frames[1] is now the least recently used
+        self.cache.decode(gravity_frames[2])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.decode(gravity_frames[0])[3], 10340)
+        self.assertEqual(self.cache.hits.value, 2)
+        self.assertEqual(self.cache.decode(gravity_frames[1])[3], 10341)
+        self.assertEqual(self.cache.misses.value, 4)
+
+    def test_only_caches_single_legacy_reports(self):
+        multiple_reports = TILT_PRO_FRAME[:4] + b'\x02' + TILT_PRO_FRAME[5:]
+        for frame in (TILT_PRO_EXT_FRAME, multiple_reports, INVALID_COLOR_FRAME):
+            self.cache.decode(frame)
+        self.assertEqual(len(self.cache), 1)  # Only the invalid color, which is still decoded by the fast path
+        # Frames that can't be from a Tilt don't count as lookups at all
+        self.cache.decode(NON_APPLE_FRAME)
+        self.cache.decode(b'')
+        self.assertEqual(self.cache.misses.value, 2)
+
+    def test_memoryview_isnt_cached(self):
+        self.assertEqual(self.cache.decode(memoryview(TILT_PRO_FRAME)), tilt_decoder.decode_tilt_frame(TILT_PRO_FRAME))
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
+import asyncio
+import logging
 import unittest
 from unittest import mock
 from aiounittest import AsyncTestCase
 
-from tiltbridge_junior import process_ble_beacon, tilts
+import metrics
+import tilt_decoder
+import tiltbridge_junior
+from beacon_dedup import BeaconDeduplicator
+from beacon_ring import BeaconRing
+from tiltbridge_junior import async_main, process_ble_beacon, process_ring, tilts
 
 class TestProcessBLEBeacon(AsyncTestCase):
     async def test_process_ble_beacon_with_data(self):
@@ -15,17 +22,18 @@ class TestProcessBLEBeacon(AsyncTestCase):
         # RSSI: -65
         mock_data = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
 
-        tilts['Yellow'].raw_gravity = 0
 
         # mock the call to tilts['Yellow'].process_decoded_values as that is what we want to test was called
         # (the functionality of process_decoded_values is tested elsewhere)
         with mock.patch('tiltbridge_junior.TiltHydrometer.process_decoded_values') as mock_process_decoded_values:
-            with mock.patch('tiltbridge_junior.data_target_handler.process_data') as mock_process_data:
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
                 process_ble_beacon(mock_data)  # Call the function under test
 
                 # Assert that process_decoded_values was called with the correct values
                 mock_process_decoded_values.assert_called_with(10345, 728, -65, 197)
-                mock_process_data.assert_called_once_with(tilts)
+                # Tilts are tracked by both color and MAC address
+                self.assertIn(('Yellow', 'df:7a:cf:d0:f7:c9'), tilts)
+                mock_mark_dirty.assert_called_once_with(tilts[('Yellow', 'df:7a:cf:d0:f7:c9')])
 
 
     async def test_process_ble_beacon_no_data(self):
@@ -33,10 +41,10 @@ class TestProcessBLEBeacon(AsyncTestCase):
         mock_data = b''
 
         with mock.patch('tiltbridge_junior.TiltHydrometer.process_decoded_values') as mock_process_decoded_values:
-            with mock.patch('tiltbridge_junior.data_target_handler.process_data') as mock_process_data:
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
                 self.assertFalse(process_ble_beacon(mock_data))  # Since there was no data, this should return false
                 mock_process_decoded_values.assert_not_called()  # ...and we should never get to this point
-                mock_process_data.assert_not_called()
+                mock_mark_dirty.assert_not_called()
 
 
     async def test_process_ble_beacon_small_data(self):
@@ -44,10 +52,10 @@ class TestProcessBLEBeacon(AsyncTestCase):
         mock_data = b'1234567890'
 
         with mock.patch('tiltbridge_junior.TiltHydrometer.process_decoded_values') as mock_process_decoded_values:
-            with mock.patch('tiltbridge_junior.data_target_handler.process_data') as mock_process_data:
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
                 self.assertFalse(process_ble_beacon(mock_data))  # Since the data was small, this should return false
                 mock_process_decoded_values.assert_not_called()  # ...and we should never get to this point
-                mock_process_data.assert_not_called()
+                mock_mark_dirty.assert_not_called()
 
 
     async def test_process_ble_beacon_invalid_color(self):
@@ -58,13 +66,92 @@ class TestProcessBLEBeacon(AsyncTestCase):
         mock_data = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbq\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
 
         with mock.patch('tiltbridge_junior.TiltHydrometer.process_decoded_values') as mock_process_decoded_values:
-            with mock.patch('tiltbridge_junior.data_target_handler.process_data') as mock_process_data:
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
                 self.assertFalse(process_ble_beacon(mock_data))  # Since the color wasn't valid, this should return false
                 mock_process_decoded_values.assert_not_called()  # ...and we should never get to this point
-                mock_process_data.assert_not_called()
+                mock_mark_dirty.assert_not_called()
+
+    async def test_process_ble_beacon_duplicate(self):
+        """Test that the same advertisement received through a second adapter is only counted once, but that the best
+        RSSI is kept"""
+        # The same Tilt Pro advertisement, once at -65 dBm and once at -60 dBm
+        mock_data = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
+        stronger_data = mock_data[:-1] + b'\xc4'
+
+        with mock.patch('tiltbridge_junior.deduplicator', BeaconDeduplicator()):
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
+                process_ble_beacon(mock_data)
+                tilt = tilts[('Yellow', 'df:7a:cf:d0:f7:c9')]
+                readings = tilt._ring_count
+
+                self.assertFalse(process_ble_beacon(stronger_data))
+                self.assertEqual(tilt._ring_count, readings)  # Not added to the smoothing window again
+                self.assertEqual(tilt.rssi, -60)
+                mock_mark_dirty.assert_called_once_with(tilt)
 
 
+class TestSplitProcesses(AsyncTestCase):
+    # A real packet from a Tilt Pro Hydrometer (Yellow, gravity 10345, temperature 728)
+    mock_data = b'\x04>*\x02\x01\x03\x01\xc9\xf7\xd0\xcfz\xdf\x1e\x02\x01\x04\x1a\xffL\x00\x02\x15\xa4\x95\xbbp\xc5\xb1KD\xb5\x12\x13p\xf0-t\xde\x02\xd8(i\xc5\xbf'
 
+    def setUp(self):
+        self.ring = BeaconRing.create(16)
+
+    def tearDown(self):
+        self.ring.close()
+
+    async def test_process_ring(self):
+        self.ring.put(tilt_decoder.decode_tilt_frame(self.mock_data))
+        self.ring.publish_counters((100, 90, 5, 4, 8, 2, 1, 0))
+        self.ring.count_restart('pipeline')
+
+        with mock.patch('tiltbridge_junior.TiltHydrometer.process_decoded_values') as mock_process_decoded_values, \
+                mock.patch('tiltbridge_junior.deduplicator', BeaconDeduplicator()):
+            with mock.patch('tiltbridge_junior.data_target_handler.mark_dirty') as mock_mark_dirty:
+                self.assertEqual(process_ring(self.ring), 1)
+                mock_process_decoded_values.assert_called_with(10345, 728, -65, 197)
+                mock_mark_dirty.assert_called_once_with(tilts[('Yellow', 'df:7a:cf:d0:f7:c9')])
+                self.assertEqual(process_ring(self.ring), 0)
+
+        # The ingestion process's counters are served by the pipeline process
+        self.assertEqual(metrics.frames_received.value, 100)
+        self.assertEqual(metrics.frames_dropped_not_tilt.value, 90)
+        self.assertEqual(metrics.pipeline_restarts.value, 1)
+        self.assertEqual(metrics.decode_cache_hits.value, 8)
+
+    async def test_async_main_reads_ring(self):
+        with mock.patch('tiltbridge_junior.ble_scanner.start_scanners') as mock_start_scanners:
+            with mock.patch('tiltbridge_junior.process_tilt_frame') as mock_process_tilt_frame:
+                main_task = asyncio.create_task(async_main(ring=self.ring))
+                self.ring.put(tilt_decoder.decode_tilt_frame(self.mock_data))
+                await asyncio.sleep(0.2)
+                main_task.cancel()
+                await asyncio.gather(main_task, return_exceptions=True)
+
+        mock_start_scanners.assert_not_called()
+        mock_process_tilt_frame.assert_called_once_with(tilt_decoder.decode_tilt_frame(self.mock_data))
+        self.assertGreater(self.ring.heartbeat('reader'), 0)
+
+
+class TestReloadConfig(AsyncTestCase):
+    def tearDown(self):
+        tiltbridge_junior.LOG.setLevel(logging.WARN)
+
+    async def test_reload_config(self):
+        env = {"TILTBRIDGE_JR_VERBOSE": "true", "TILTBRIDGE_JR_DEDUP_WINDOW": "1", "TILTBRIDGE_JR_HTTP_PORT": "8080"}
+        with mock.patch.dict('os.environ', env), mock.patch('tiltbridge_junior.deduplicator', BeaconDeduplicator()), \
+                mock.patch('tiltbridge_junior.data_target_handler.reload_config') as mock_reload_targets, \
+                mock.patch.object(tilts, 'set_smoothing') as mock_set_smoothing:
+            tiltbridge_junior.reload_config({"TILTBRIDGE_JR_VERBOSE", "TILTBRIDGE_JR_DEDUP_WINDOW"})
+            self.assertEqual(tiltbridge_junior.LOG.level, logging.INFO)
+            self.assertEqual(tiltbridge_junior.deduplicator.window, 1)
+            mock_reload_targets.assert_called_once_with({"TILTBRIDGE_JR_VERBOSE", "TILTBRIDGE_JR_DEDUP_WINDOW"})
+            mock_set_smoothing.assert_not_called()  # The smoothing settings didn't change
+
+            with self.assertLogs("tilt", "WARNING") as logs:
+                tiltbridge_junior.reload_config({"TILTBRIDGE_JR_HTTP_PORT"})
+        self.assertIn("Restart TiltBridge Junior for changes to TILTBRIDGE_JR_HTTP_PORT to take effect",
+                      logs.output[0])
 
 if __name__ == "__main__":
     unittest.main()
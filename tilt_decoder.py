@@ -0,0 +1,158 @@
+import struct
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+# This module decodes Tilt iBeacon advertisements directly from the raw HCI frames handed to us by aioblescan, without
+# building an aiobs.HCI_Event. The vast majority of advertisements in range of the scanner are not Tilts, so the goal
+# here is to reject those with as few byte comparisons as possible, and to only pay for struct unpacking when we have
+# something that looks like a Tilt.
+#
+# Frames we can't confidently handle (multiple reports in one event, inconsistent lengths) return FALLBACK, in which
+# case the caller should hand the frame to the (much slower) aioblescan decoder instead.
+
+HCI_EVENT_PKT = 0x04
+EVT_LE_META_EVENT = 0x3e
+EVT_LE_ADVERTISING_REPORT = 0x02
+EVT_LE_EXTENDED_ADVERTISING_REPORT = 0x0d
+
+AD_TYPE_MANUFACTURER_SPECIFIC = 0xff
+
+# Apple's company ID (0x004c, little endian) followed by the iBeacon type (0x02) and remaining length (0x15)
+IBEACON_PREFIX = b'\x4c\x00\x02\x15'  # type: bytes
+# Every Tilt UUID ends with the same six bytes (a495bbX0-c5b1-4b44-b512-1370f02d74de)
+TILT_UUID_SUFFIX = b'\x13\x70\xf0\x2d\x74\xde'  # type: bytes
+# Length byte of an iBeacon manufacturer specific data AD structure (type + company ID + iBeacon payload)
+IBEACON_AD_LENGTH = 0x1a
+
+# LE Advertising Report (subevent 0x02) with a single report:
+#   pkt type, event code, param len, subevent, num reports, event type, addr type, addr (6), data len, data..., rssi
+ADV_REPORT_MAC_OFFSET = 7
+ADV_REPORT_DATA_LEN_OFFSET = 13
+# LE Extended Advertising Report (subevent 0x0d) with a single report:
+#   pkt type, event code, param len, subevent, num reports, event type (2), addr type, addr (6), primary phy,
+#   secondary phy, adv sid, tx power, rssi, adv interval (2), direct addr type, direct addr (6), data len, data...
+EXT_ADV_REPORT_MAC_OFFSET = 8
+EXT_ADV_REPORT_RSSI_OFFSET = 18
+EXT_ADV_REPORT_DATA_LEN_OFFSET = 28
+
+_unpack_major_minor_tx = struct.Struct('>HHB').unpack_from
+_unpack_rssi = struct.Struct('b').unpack_from
+
+# Returned by decode_tilt_frame when the frame is valid HCI, but not in a layout the fast path handles
+FALLBACK = object()
+
+# (uuid, mac, temp, gravity, tx_pwr, rssi)
+TiltFrame = Tuple[bytes, bytes, int, int, int, int]
+
+
+def format_mac(mac: bytes) -> str:
+    """Format a MAC address as broadcast in an HCI frame (least significant byte first) as aa:bb:cc:dd:ee:ff"""
+    return ':'.join('{:02x}'.format(b) for b in reversed(mac))
+
+
+def decode_tilt_frame(data: bytes) -> Optional[TiltFrame]:
+    """Decode a raw HCI LE Advertising Report into (uuid, mac, temp, gravity, tx_pwr, rssi) if it is a Tilt beacon.
+
+    Returns None if the frame is definitely not a Tilt, or FALLBACK if the frame should be passed to the aioblescan
+    decoder instead. The UUID and MAC are returned as the raw bytes from the frame (16 and 6 bytes respectively); the
+    UUID is not checked against the list of known colors here."""
+    if not isinstance(data, bytes):
+        data = bytes(data)  # memoryview/bytearray - bytes gives us startswith() without slicing
+    data_len = len(data)
+
+    if data_len < 15 or data[0] != HCI_EVENT_PKT or data[1] != EVT_LE_META_EVENT:
+        return None
+
+    subevent = data[3]
+    if subevent == EVT_LE_ADVERTISING_REPORT:
+        if data[4] != 1:
+            return FALLBACK
+        mac_offset = ADV_REPORT_MAC_OFFSET
+        ad_start = ADV_REPORT_DATA_LEN_OFFSET + 1
+        ad_end = ad_start + data[ADV_REPORT_DATA_LEN_OFFSET]
+        rssi_offset = ad_end  # RSSI trails the advertising data
+        if rssi_offset >= data_len:
+            return FALLBACK
+    elif subevent == EVT_LE_EXTENDED_ADVERTISING_REPORT:
+        if data[4] != 1:
+            return FALLBACK
+        if data_len <= EXT_ADV_REPORT_DATA_LEN_OFFSET:
+            return FALLBACK
+        mac_offset = EXT_ADV_REPORT_MAC_OFFSET
+        ad_start = EXT_ADV_REPORT_DATA_LEN_OFFSET + 1
+        ad_end = ad_start + data[EXT_ADV_REPORT_DATA_LEN_OFFSET]
+        rssi_offset = EXT_ADV_REPORT_RSSI_OFFSET
+        if ad_end > data_len:
+            return FALLBACK
+    else:
+        # Some other LE meta event (connection complete, etc.) - never a Tilt
+        return None
+
+    # Walk the AD structures looking for an iBeacon manufacturer specific data block
+    offset = ad_start
+    while offset < ad_end:
+        ad_len = data[offset]
+        if ad_len == 0:
+            break
+        if (ad_len == IBEACON_AD_LENGTH and offset + ad_len < ad_end and
+                data[offset + 1] == AD_TYPE_MANUFACTURER_SPECIFIC and data.startswith(IBEACON_PREFIX, offset + 2)):
+            uuid_offset = offset + 6
+            if not data.startswith(TILT_UUID_SUFFIX, uuid_offset + 10):
+                return None  # An iBeacon, but not a Tilt
+            temp, gravity, tx_pwr = _unpack_major_minor_tx(data, uuid_offset + 16)
+            return (data[uuid_offset:uuid_offset + 16], data[mac_offset:mac_offset + 6], temp, gravity, tx_pwr,
+                    _unpack_rssi(data, rssi_offset)[0])
+        offset += ad_len + 1
+
+    return None
+
+
+class DecodeCache:
+    """A bounded LRU memo of decoded Tilt beacons. A Tilt broadcasts the same advertisement many times over before its
+    reading changes, and the only part of the frame that differs between the repeats is the RSSI - so the frame minus
+    its RSSI maps straight to the decoded (uuid, mac, temp, gravity, tx_pwr), and a repeat only needs its RSSI read.
+
+    Only single report LE Advertising Reports (where the RSSI is the last byte of the frame) are cached. Frames that
+    can't be one from a Tilt are handed straight to decode_tilt_frame after checking a single byte."""
+
+    DEFAULT_SIZE = 256
+
+    def __init__(self, size: int = DEFAULT_SIZE, hits: metrics.CounterChild or None = None,
+                 misses: metrics.CounterChild or None = None):
+        self.size = size  # type: int
+        # Frame minus RSSI -> (uuid, mac, temp, gravity, tx_pwr), least recently used first
+        self.entries = {}  # type: Dict[bytes, Tuple[bytes, bytes, int, int, int]]
+        # Lookups of frames that could be from a Tilt, found in the cache or not
+        self.hits = hits if hits is not None else metrics.CounterChild()  # type: metrics.CounterChild
+        self.misses = misses if misses is not None else metrics.CounterChild()  # type: metrics.CounterChild
+
+    def __len__(self):
+        return len(self.entries)
+
+    def decode(self, data: bytes) -> Optional[TiltFrame]:
+        """Decode a frame the same as decode_tilt_frame, using the cache where possible"""
+        # A Tilt's frame ends with the UUID (whose last byte is always 0xde), major, minor, tx power and RSSI. Checking
+        # that one byte rules out nearly every other frame, and the cache key checks the rest.
+        if len(data) < 15 or data[-7] != 0xde or type(data) is not bytes:
+            return decode_tilt_frame(data)
+
+        key = data[:-1]
+        entries = self.entries
+        beacon = entries.pop(key, None)
+        if beacon is not None:
+            entries[key] = beacon  # Now the most recently used
+            self.hits.value += 1
+            return beacon + (_unpack_rssi(data, len(key))[0],)
+
+        self.misses.value += 1
+        decoded = decode_tilt_frame(data)
+        if (decoded is not None and decoded is not FALLBACK and data[3] == EVT_LE_ADVERTISING_REPORT and
+                data[ADV_REPORT_DATA_LEN_OFFSET] + ADV_REPORT_DATA_LEN_OFFSET + 2 == len(data)):
+            if len(entries) >= self.size:
+                del entries[next(iter(entries))]
+            entries[key] = decoded[:5]
+        return decoded
+
+    def clear(self):
+        self.entries.clear()
@@ -1,97 +1,209 @@
 #!/usr/bin/python
 
-import os, sys
-import sentry_sdk
+import os, signal, sys
 import time, datetime, getopt
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
 import asyncio
 import aioblescan as aiobs
 from TiltHydrometer import TiltHydrometer
+from hydrometer_registry import HydrometerRegistry
+import tilt_decoder
+import ble_capture
+import ble_scanner
+import config_reload
+import error_reporting
+import history
+import http_server
+import log_writer
+import metrics
+import read_api
+import smoothing
+import supervisor
+from beacon_dedup import BeaconDeduplicator
+from beacon_ring import BeaconRing
 import logging
-from dotenv import load_dotenv
+from dotenv import find_dotenv
 import data_targets.data_target_handler as data_target_handler
 
-load_dotenv()  # take environment variables from .env.
+# take environment variables from .env (and again whenever it changes - see config_reload)
+env_file = config_reload.EnvFile(find_dotenv())
+env_file.load()
 
-# Initialize logging
-sentry_sdk.init(
-    "https://9a5f70908aee4f879e0f7f9ec81ef618@sentry.optictheory.com/10",
-    traces_sample_rate=0.0
-)
-
-
-logging.basicConfig(filename='log/tiltbridge-jr.log', level=logging.WARN,
-                    format='%(asctime)s %(levelname)-8s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+# Log records are written to log/tiltbridge-jr.log by a background thread once we start running (see log_writer)
 LOG = logging.getLogger("tilt")
 LOG.setLevel(logging.WARN)
 
-# I'm trying to output things that are install-specific (or environmental) to log files that a user can access, while
-# not logging those to Sentry. The "tilt" logger in this case shouldn't be sent to Sentry, but should be logged to
-# stderr.
-sentry_sdk.integrations.logging.ignore_logger("tilt")
+# Every Tilt we've seen, keyed by (color, MAC). Hydrometers are created as they are first seen.
+tilts = HydrometerRegistry()  # type: HydrometerRegistry
 
-# Create a list of TiltHydrometer objects for us to use
-tilts = {x: TiltHydrometer(x) for x in TiltHydrometer.tilt_colors}  # type: Dict[str, TiltHydrometer]
+metrics.hydrometers.set_function(lambda: len(tilts))
 
+# How often to clear out hydrometers we haven't heard from in a while
+EVICTION_INTERVAL = 600  # seconds
 
-# Configuration variables
-bluetooth_device = 0
+# When reading frames in a separate process (see run_split_processes), how often the pipeline process collects the
+# beacons waiting in the ring, and how often each process sends a heartbeat to the supervisor
+RING_POLL_INTERVAL = 0.1  # seconds
+HEARTBEAT_INTERVAL = 1  # seconds
+
+# The frame counters kept by the ingestion process when running split, in the order of beacon_ring.INGEST_COUNTERS
+INGEST_METRICS = (metrics.frames_received, metrics.frames_dropped_not_tilt, metrics.frames_fallback,
+                  metrics.frames_dropped_fallback, metrics.decode_cache_hits, metrics.decode_cache_misses,
+                  metrics.scan_rescans, metrics.scan_reopens)
+
+# Tilts repeat the same advertisement until their reading changes, so repeats are decoded from a cache
+decode_cache = tilt_decoder.DecodeCache(hits=metrics.decode_cache_hits,
+                                        misses=metrics.decode_cache_misses)  # type: tilt_decoder.DecodeCache
+
+
+# Catches the same advertisement arriving through more than one bluetooth adapter, so it's only counted once
+deduplicator = BeaconDeduplicator()  # type: BeaconDeduplicator
 
-def load_config_file():
-    """This function loads a config file using environment variables. The config file
-    contains script level settings (such as verbose, and bluetooth_device) as well as configuration information for data
-    targets such as Fermentrack"""
-    global bluetooth_device
 
+# Configuration variables
+bluetooth_devices = [0]  # The HCI device number of every bluetooth adapter to scan on
+capture_file = None  # If set, every HCI frame received is also written to this file (see ble_capture)
+http_host = "0.0.0.0"
+http_port = None  # If set, metrics (/metrics) and the read API (/api/tilts) are served over HTTP on this port
+kernel_filter = False  # If set, the kernel drops frames that can't be Tilts before they reach us (see hci_socket)
+tilt_history = None  # If set, every reading is recorded (see history), and served at /api/history
+split_processes = False  # If set, frames are read in a separate process from the rest of the pipeline
+report_errors = False  # If set, errors are reported to Sentry once scanning has started (see error_reporting)
+# Seconds without a frame from an adapter before its scan is restarted (see ble_scanner.ScanWatchdog) - 0 to never
+scan_stall_timeout = ble_scanner.ScanWatchdog.STALL_TIMEOUT
+# Seconds between checks of the .env file for changes (see config_reload) - 0 to only reload it on SIGHUP
+config_reload_interval = config_reload.POLL_INTERVAL
+
+# Settings that are only read at startup, so changing them in the .env file needs a restart (by name, or prefix)
+RESTART_REQUIRED = ("TILTBRIDGE_JR_BLUETOOTH_DEVICE", "TILTBRIDGE_JR_KERNEL_FILTER", "TILTBRIDGE_JR_SCAN_STALL_TIMEOUT",
+                    "TILTBRIDGE_JR_CAPTURE_FILE", "TILTBRIDGE_JR_SPLIT_PROCESSES", "TILTBRIDGE_JR_SENTRY_ENABLED",
+                    "TILTBRIDGE_JR_HTTP_", "TILTBRIDGE_JR_HISTORY_", "TILTBRIDGE_JR_LOG_",
+                    "TILTBRIDGE_JR_CONFIG_RELOAD_INTERVAL")
+
+
+def load_verbose_config():
     # Read the verbose setting from the environment variable
     verbose_env = os.environ.get("TILTBRIDGE_JR_VERBOSE")
     verbose = verbose_env.lower() == 'true' if verbose_env else False
 
-    if verbose:
-        LOG.setLevel(logging.INFO)
+    LOG.setLevel(logging.INFO if verbose else logging.WARN)
 
-    # Read the bluetooth_device setting from the environment variable
-    bluetooth_device_env = os.environ.get("TILTBRIDGE_JR_BLUETOOTH_DEVICE")
-    bluetooth_device = int(bluetooth_device_env) if bluetooth_device_env else 0
 
-    # Load the data target configuration
-    data_target_handler.load_config()
+def load_dedup_config():
+    # Read the deduplication window (in seconds) from the environment variable
+    dedup_window_env = os.environ.get("TILTBRIDGE_JR_DEDUP_WINDOW")
+    deduplicator.window = float(dedup_window_env) if dedup_window_env else BeaconDeduplicator.DEFAULT_WINDOW
 
 
-def process_ble_beacon(data):
-    # While I'm not a fan of globals, not sure how else we can store state here easily
-    global tilts
+def load_scan_config():
+    """Loads the settings needed to scan for Tilts (everything the ingestion process needs when running split) from
+    environment variables"""
+    global bluetooth_devices, capture_file, kernel_filter, report_errors, scan_stall_timeout, split_processes
+
+    load_verbose_config()
+
+    # Read the bluetooth_devices setting from the environment variable - either a single device, or a comma separated
+    # list of devices to scan on at the same time (e.g. "0,1")
+    bluetooth_devices = ble_scanner.parse_devices(os.environ.get("TILTBRIDGE_JR_BLUETOOTH_DEVICE"))
+
+    # Read the kernel filter setting from the environment variable
+    kernel_filter_env = os.environ.get("TILTBRIDGE_JR_KERNEL_FILTER")
+    kernel_filter = kernel_filter_env.lower() == 'true' if kernel_filter_env else False
 
+    # Read the capture file setting from the environment variable (used to record frames for replay/benchmarking)
+    capture_file = os.environ.get("TILTBRIDGE_JR_CAPTURE_FILE") or None
+
+    # Read the split processes setting from the environment variable
+    split_processes_env = os.environ.get("TILTBRIDGE_JR_SPLIT_PROCESSES")
+    split_processes = split_processes_env.lower() == 'true' if split_processes_env else False
+
+    # Read the scan watchdog setting from the environment variable
+    scan_stall_timeout_env = os.environ.get("TILTBRIDGE_JR_SCAN_STALL_TIMEOUT")
+    scan_stall_timeout = (float(scan_stall_timeout_env) if scan_stall_timeout_env
+                          else ble_scanner.ScanWatchdog.STALL_TIMEOUT)
+
+    # Read the error reporting setting from the environment variable
+    report_errors = error_reporting.enabled_from_env()
+
+
+def load_config_file():
+    """This function loads a config file using environment variables. The config file
+    contains script level settings (such as verbose, and bluetooth_devices) as well as configuration information for
+    data targets such as Fermentrack"""
+    global config_reload_interval, http_host, http_port, tilt_history
+
+    load_scan_config()
+
+    # Read the HTTP server settings from the environment variables
+    http_host = os.environ.get("TILTBRIDGE_JR_HTTP_HOST") or "0.0.0.0"
+    http_port_env = os.environ.get("TILTBRIDGE_JR_HTTP_PORT")
+    http_port = int(http_port_env) if http_port_env else None
+
+    load_dedup_config()
+
+    # Read the smoothing strategy (for hydrometers seen from now on) from the environment variables
+    tilts.smoothing = smoothing.config_from_env()
+
+    # Read the history settings from the environment variables
+    tilt_history = history.history_from_env()
+
+    # Load the data target configuration
+    data_target_handler.load_config()
+
+    # Read the config reload setting from the environment variable
+    config_reload_interval_env = os.environ.get("TILTBRIDGE_JR_CONFIG_RELOAD_INTERVAL")
+    config_reload_interval = (float(config_reload_interval_env) if config_reload_interval_env
+                              else config_reload.POLL_INTERVAL)
+
+
+def reload_config(changed: Set[str]):
+    """Apply changes to the configuration (the names of the environment variables that changed) while running. Only
+    what the changed settings affect is reconfigured - the bluetooth adapters are left scanning throughout."""
+    restart_required = sorted(name for name in changed if name.startswith(RESTART_REQUIRED))
+    if len(restart_required) > 0:
+        LOG.warning(f"Restart TiltBridge Junior for changes to {', '.join(restart_required)} to take effect")
+
+    if "TILTBRIDGE_JR_VERBOSE" in changed:
+        load_verbose_config()
+    if "TILTBRIDGE_JR_DEDUP_WINDOW" in changed:
+        load_dedup_config()
+    if any(name.startswith(("TILTBRIDGE_JR_SMOOTHING", "TILTBRIDGE_JR_OUTLIER_THRESHOLD")) for name in changed):
+        switched = tilts.set_smoothing(smoothing.config_from_env())
+        if switched > 0:
+            LOG.info(f"Switched the smoothing of {switched} Tilt(s)")
+            for tilt in tilts.values():
+                data_target_handler.mark_dirty(tilt)  # So that the next snapshot has the newly smoothed values
+    data_target_handler.reload_config(changed)
+
+
+def decode_with_aioblescan(data) -> Optional[tilt_decoder.TiltFrame]:
+    """Decode a frame using aioblescan. This is much slower than tilt_decoder.decode_tilt_frame, and is only used for
+    frames the fast path can't handle. Returns the same (uuid, mac, temp, gravity, tx_pwr, rssi) tuple, or None."""
     ev = aiobs.HCI_Event()
     try:
         xx = ev.decode(data)
     except:
         # "unpack requires a buffer of 4 bytes" is the main trigger here, but I can't pin down the exact exception
-        return False
+        return None
 
     # To make things easier, let's convert the byte string to a hex string first
     if ev.raw_data is None:
         LOG.debug("Event has no raw data")
-        return False
+        return None
 
     raw_data_hex = ev.raw_data.hex()
 
     if len(raw_data_hex) < 80:  # Very quick filter to determine if this is potentially a valid Tilt device
-        LOG.debug("Small raw_data_hex: {}".format(raw_data_hex))
-        return False
+        LOG.debug("Small raw_data_hex: %s", raw_data_hex)
+        return None
     if "1370f02d74de" not in raw_data_hex:  # Another very quick filter (honestly, might not be faster than just looking at uuid below)
-        LOG.debug("Missing key in raw_data_hex: {}".format(raw_data_hex))
-        return False
+        LOG.debug("Missing key in raw_data_hex: %s", raw_data_hex)
+        return None
 
     # For testing/viewing raw announcements, uncomment the following
     # print("Raw data (hex) {}: {}".format(len(raw_data_hex), raw_data_hex))
     # ev.show(0)
 
-    # try:
-    #     mac_addr = ev.retrieve("peer")[0].val
-    # except:
-    #     pass
-
     try:
         # Let's use some of the functions of aioblesscan to tease out the mfg_specific_data payload
 
@@ -100,75 +212,300 @@ def process_ble_beacon(data):
             payload = manufacturer_data[0].payload
         else:
             # No manufacturer data is available
-            return False
+            return None
         payload = payload[1].val.hex()
 
         # ...and then dissect said payload into a UUID, temp, and gravity
-        uuid = payload[4:36]
-        color = TiltHydrometer.color_lookup(uuid)  # Map the uuid back to our TiltHydrometer object
-        if color is None:
-            LOG.error(f"Unable to find a TiltHydrometer color for UUID {uuid}")
-            return False
-
+        uuid = bytes.fromhex(payload[4:36])
         temp = int.from_bytes(bytes.fromhex(payload[36:40]), byteorder='big')
         gravity = int.from_bytes(bytes.fromhex(payload[40:44]), byteorder='big')
         # On the latest tilts, TX power is used for battery age in weeks
         tx_pwr = int.from_bytes(bytes.fromhex(payload[44:46]), byteorder='big', signed=False)
         rssi = ev.retrieve("rssi")[-1].val
+        # aioblescan formats the MAC for us - convert it back to the byte order in the frame
+        mac = bytes.fromhex(ev.retrieve("peer")[0].val.replace(":", ""))[::-1]
 
     except Exception as e:
         LOG.error(e)
-        sentry_sdk.capture_exception(e)
+        error_reporting.capture_exception(e)
         exit(1)
 
-    # LOG.info("Tilt Payload (hex): {}".format(raw_data_hex))
+    return uuid, mac, temp, gravity, tx_pwr, rssi
 
-    tilts[color].process_decoded_values(gravity, temp, rssi, tx_pwr)  # Process the data sent from the Tilt
 
-    # LOG.info("Color {} - MAC {}".format(color, mac_addr))
-    # LOG.info("Raw Data: `{}`".format(raw_data_hex))
-    LOG.info(f"Found Tilt: {color} - Temp: {temp}, Gravity: {gravity}, RSSI: {rssi}, TX Pwr: {tx_pwr}")
+def decode_ble_beacon(data) -> Optional[tilt_decoder.TiltFrame]:
+    """Decode a frame from the bluetooth adapter, returning None (and counting why) if it isn't a Tilt beacon"""
+    metrics.frames_received.value += 1
+    decoded = decode_cache.decode(data)
+    if decoded is tilt_decoder.FALLBACK:
+        # Something the fast path doesn't understand (e.g. multiple reports in one event) - let aioblescan have a go
+        metrics.frames_fallback.value += 1
+        decoded = decode_with_aioblescan(data)
+        if decoded is None:
+            metrics.frames_dropped_fallback.value += 1
+        return decoded
+    if decoded is None:
+        metrics.frames_dropped_not_tilt.value += 1
+    return decoded
+
+
+def process_ble_beacon(data):
+    decoded = decode_ble_beacon(data)
+    if decoded is None:
+        return False
+    return process_tilt_frame(decoded)
 
-    # Check if we need to send data to any targets
-    data_target_handler.process_data(tilts)
 
+def process_tilt_frame(decoded: tilt_decoder.TiltFrame):
+    """Process a decoded Tilt beacon - update the hydrometer's readings, and let the data targets know"""
+    # While I'm not a fan of globals, not sure how else we can store state here easily
+    global tilts
 
-async def async_main(args=None):
-    global bluetooth_device
+    uuid, mac, temp, gravity, tx_pwr, rssi = decoded
+    tilt = tilts.lookup(uuid, mac)  # Map the uuid/mac back to our TiltHydrometer object
+    if tilt is None:
+        metrics.frames_dropped_unknown_color.value += 1
+        LOG.error("Unable to find a TiltHydrometer color for UUID %s", uuid.hex())
+        return False
 
-    event_loop = asyncio.get_running_loop()
+    if deduplicator.is_duplicate((mac, uuid, temp, gravity, tx_pwr)):
+        # We've just processed this advertisement (received through another adapter) - only keep the better RSSI
+        metrics.frames_dropped_duplicate.value += 1
+        tilt.process_duplicate(rssi)
+        return False
 
-    # First create and configure a raw socket
-    try:
-        mysocket = aiobs.create_bt_socket(bluetooth_device)
-    except OSError as e:
-        # TODO - Hang here, send a message to Fermentrack, log some massive error - just don't exit
-        LOG.error("Unable to create socket - {}. Is there a bluetooth adapter attached in this configuration?".format(e))
-        while True:
-            time.sleep(60)  # Sleep forever since we can't do anything else. This is an external problem that will require restarting the container at a minimum
-        exit(1)
+    metrics.tilt_beacons.value += 1
+
+    tilt.process_decoded_values(gravity, temp, rssi, tx_pwr)  # Process the data sent from the Tilt
+    if tilt_history is not None:
+        tilt_history.record(tilt, gravity, temp, rssi)
+
+    if LOG.isEnabledFor(logging.INFO):  # Only in verbose mode - this is logged for every beacon
+        LOG.info("Found Tilt: %s (%s) - Temp: %s, Gravity: %s, RSSI: %s, TX Pwr: %s", tilt.color, tilt.mac, temp,
+                 gravity, rssi, tx_pwr)
+
+    # Let the data targets know there's new data to send
+    data_target_handler.mark_dirty(tilt)
+
+
+def process_ring(ring: BeaconRing) -> int:
+    """Process every beacon waiting in the ring from the ingestion process (see run_split_processes). Returns the
+    number of beacons processed."""
+    frames = ring.read()
+    for frame in frames:
+        process_tilt_frame(frame)
+    # Frames are counted by the ingestion process - copy its counts, so they're served with the rest of the metrics
+    for counter, value in zip(INGEST_METRICS, ring.counters()):
+        counter.value = value
+    metrics.frames_dropped_ring_full.value = ring.overflows
+    metrics.ingest_restarts.value = ring.restarts('ingest')
+    metrics.pipeline_restarts.value = ring.restarts('pipeline')
+    return len(frames)
+
+
+async def read_ring(ring: BeaconRing):
+    """Process beacons from the ingestion process as they arrive, sending a heartbeat to the supervisor each time"""
+    while True:
+        process_ring(ring)
+        ring.beat('reader')
+        await asyncio.sleep(RING_POLL_INTERVAL)
+
+
+async def serve_metrics(request: http_server.Request, writer) -> http_server.Response:
+    """Serve the pipeline metrics in the Prometheus text format"""
+    return http_server.Response(200, metrics.render(), metrics.CONTENT_TYPE)
+
+
+async def async_main(args=None, ring: Optional[BeaconRing] = None):
+    """The main loop. If ring is set, beacons are read from the ingestion process through the ring rather than from
+    the bluetooth adapter(s)."""
+    # Start scanning before anything else, so as few beacons as possible are missed while we start up
+    scanners = []
+    capture_writer = None
+    ring_task = None
+    watchdog_task = None
+    if ring is not None:
+        ring_task = asyncio.create_task(read_ring(ring))
+    else:
+        process = process_ble_beacon
+        if capture_file:
+            capture_writer = ble_capture.CaptureWriter(capture_file)
+            process = capture_writer.recording(process_ble_beacon)
+            LOG.info(f"Recording received frames to {capture_file}")
+
+        # Start scanning on every adapter. Each adapter has its own raw socket, but they all feed the same pipeline.
+        watchdog = scan_stall_timeout > 0
+        scanners = await ble_scanner.start_scanners(bluetooth_devices, process, kernel_filter, include_failed=watchdog)
+        if not any(scanner.running for scanner in scanners):
+            LOG.error("Unable to create a socket for any bluetooth device. Is there a bluetooth adapter attached in "
+                      "this configuration?" + (" Retrying in the background." if watchdog else ""))
+        if watchdog:
+            # Adapters can silently stop delivering advertisements - restart the scan on any that go quiet (and keep
+            # trying any that couldn't be opened)
+            watchdog_task = asyncio.create_task(ble_scanner.ScanWatchdog(scanners, scan_stall_timeout).run())
+
+    if report_errors:
+        error_reporting.start_in_background()
+
+    # Start the data target sender task - it sends on its own timers, independently of the BLE callback, so a slow or
+    # unreachable target can't stall packet ingestion
+    sender_task = asyncio.create_task(data_target_handler.run(tilts))
+
+    # Apply changes to the .env file as they're made (or on SIGHUP)
+    reload_task = asyncio.create_task(config_reload.ConfigReloader(env_file, reload_config,
+                                                                   config_reload_interval).run())
+
+    history_task = None
+    if tilt_history is not None:
+        history_task = asyncio.create_task(tilt_history.run())
+
+    server = None
+    if http_port is not None:
+        server = http_server.HTTPServer()
+        server.route("/metrics", serve_metrics)
+        read_api.ReadAPI(tilts).add_routes(server)
+        if tilt_history is not None:
+            tilt_history.add_routes(server)
+        await server.start(http_host, http_port)
 
-    # create a connection with the raw socket (Uses _create_connection_transport instead of create_connection as this now
-    # requires a STREAM socket) - previously was fac=event_loop.create_connection(aiobs.BLEScanRequester,sock=mysocket)
-    conn, btctrl = await event_loop._create_connection_transport(mysocket, aiobs.BLEScanRequester, None, None)
-    # Attach your processing
-    btctrl.process = process_ble_beacon  # Attach the handler to the bluetooth control loop
-    # Begin probing
-    await btctrl.send_scan_request()
     try:
         while True:
-            await asyncio.sleep(3600)
-            # TODO - Potentially check if we haven't detected anything here and restart the loop
+            await asyncio.sleep(EVICTION_INTERVAL)
+            evicted = tilts.evict_expired()
+            if evicted > 0:
+                LOG.info(f"Removed {evicted} Tilt(s) that haven't been seen recently")
     except KeyboardInterrupt:
             LOG.info('Keyboard interrupt')
     finally:
         LOG.debug('Closing event loop')
-        # event_loop.run_until_complete(btctrl.stop_scan_request())
-        await btctrl.stop_scan_request()
-        command = aiobs.HCI_Cmd_LE_Advertise(enable=False)
-        await btctrl.send_command(command)
-        conn.close()
+        if watchdog_task is not None:
+            watchdog_task.cancel()
+        for scanner in scanners:
+            await scanner.stop()
+        tasks = [task for task in (watchdog_task, ring_task, reload_task, sender_task, history_task)
+                 if task is not None]
+        for task in tasks:
+            task.cancel()
+        # Wait for them to finish cancelling, so that none are left pending when the event loop closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+        data_target_handler.close()
+        if server is not None:
+            await server.stop()
+        if history_task is not None:
+            await tilt_history.close()
+        if capture_writer is not None:
+            capture_writer.close()
+
+
+async def async_ingest(ring: BeaconRing):
+    """The main loop of the ingestion process when running split - frames from the bluetooth adapter(s) are decoded as
+    they arrive, and Tilt beacons are passed on to the pipeline process through the ring"""
+    put = ring.put
+
+    def ingest_ble_beacon(data):
+        decoded = decode_ble_beacon(data)
+        if decoded is not None:
+            put(decoded)
+
+    process = ingest_ble_beacon
+    capture_writer = None
+    if capture_file:
+        capture_writer = ble_capture.CaptureWriter(capture_file)
+        process = capture_writer.recording(ingest_ble_beacon)
+        LOG.info(f"Recording received frames to {capture_file}")
+
+    scanners = await ble_scanner.start_scanners(bluetooth_devices, process, kernel_filter,
+                                                include_failed=scan_stall_timeout > 0)
+    if not any(scanner.running for scanner in scanners):
+        # The supervisor restarts us (with an increasing delay), so the adapter is retried until it turns up
+        LOG.error("Unable to create a socket for any bluetooth device. Is there a bluetooth adapter attached in this "
+                  "configuration?")
+        sys.exit(1)
+
+    if report_errors:
+        error_reporting.start_in_background()
+
+    watchdog_task = None
+    if scan_stall_timeout > 0:
+        watchdog_task = asyncio.create_task(ble_scanner.ScanWatchdog(scanners, scan_stall_timeout).run())
 
-if __name__ == '__main__':
+    try:
+        while True:
+            ring.publish_counters(tuple(counter.value for counter in INGEST_METRICS))
+            ring.beat('writer')
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+    finally:
+        if watchdog_task is not None:
+            watchdog_task.cancel()
+        for scanner in scanners:
+            await scanner.stop()
+        if capture_writer is not None:
+            capture_writer.close()
+
+
+def ingest_process(ring_name: str, log_queue):
+    """Entry point of the ingestion process when running split"""
+    # The supervisor passes SIGHUP on to reload the configuration, none of which the ingestion process can change
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    log_writer.forward(log_queue)
+    load_scan_config()
+    ring = BeaconRing.attach(ring_name)
+    try:
+        supervisor.run_until_terminated(async_ingest(ring))
+    finally:
+        ring.close()
+
+
+def pipeline_process(ring_name: str, log_queue, env_applied: Dict[str, str]):
+    """Entry point of the pipeline process when running split. env_applied is what the supervisor applied from the
+    .env file, so that changes to the file can be picked up here (see config_reload.EnvFile.inherit)."""
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # Until the configuration reloader takes SIGHUP over
+    log_writer.forward(log_queue)
+    env_file.inherit(env_applied)
+    env_file.load()
     load_config_file()
-    asyncio.run(async_main())
+    ring = BeaconRing.attach(ring_name)
+    try:
+        supervisor.run_until_terminated(async_main(ring=ring))
+    finally:
+        ring.close()
+
+
+def run_split_processes():
+    """Run with frames read from the bluetooth adapter(s) and decoded in one process (ingest), and everything else -
+    hydrometers, data targets, history and HTTP - in another (pipeline), connected by a ring buffer in shared memory.
+
+    On a multi-core device the two run in parallel, so encoding and sending data to the targets never holds up reading
+    frames. Both are supervised by this process: either one is restarted if it exits, or stops sending heartbeats.
+
+    Both processes send their log records to this one, which writes them to the log file."""
+    ring = BeaconRing.create()
+    log_queue = supervisor.CONTEXT.Queue()
+    writer = log_writer.log_writer_from_env(log_queue)
+    writer.start()
+    if report_errors:
+        error_reporting.start_in_background()
+    try:
+        supervisor.Supervisor([
+            supervisor.SupervisedProcess("ingest", ingest_process, (ring.name, log_queue),
+                                         lambda: ring.heartbeat('writer'), lambda: ring.count_restart('ingest')),
+            supervisor.SupervisedProcess("pipeline", pipeline_process, (ring.name, log_queue, env_file.applied),
+                                         lambda: ring.heartbeat('reader'), lambda: ring.count_restart('pipeline')),
+        ]).run()
+    finally:
+        writer.stop()
+        ring.close()
+
+
+if __name__ == '__main__':
+    load_scan_config()
+    if split_processes:
+        run_split_processes()
+    else:
+        writer = log_writer.log_writer_from_env()
+        writer.start()
+        try:
+            load_config_file()
+            asyncio.run(async_main())
+        finally:
+            writer.stop()